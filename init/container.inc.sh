@@ -70,13 +70,9 @@ function container_helper_invoke_populate_volume_from_template
 {
     local directory="$1"
     [ "${directory}" != "" ] || return 1
-    # Modify the populate-volume-from-template program to tolerate
-    # chmod/chown failure.  We do this "inline" so that we do not
-    # write the root fs (which may be read-only).
-    sed \
-        's/\(\s*\(chown\|chmod\).*\)/\1 || ( echo "Failed to \2 $VOLUME" ; ls -ld "$VOLUME" )/' \
-        /usr/local/bin/populate-volume-from-template \
-        | /bin/sh -s "${directory}"
+    # Create what is missing from the template ("${directory}-template"),
+    # tolerating chmod/chown failures, without forking per entry
+    /usr/local/share/ipa-container/volume_sync.py --populate "${directory}"
 }
 
 function container_step_populate_tmp
@@ -331,7 +327,7 @@ function container_step_process_first_boot
     if ! container_helper_exist_ca_cert ; then
         if ! utils_is_a_file "${DATA}/ipa.csr" ; then
             # Do not refresh $DATA in the second stage of the external CA setup
-            /usr/local/bin/populate-volume-from-template "${DATA}"
+            container_helper_invoke_populate_volume_from_template "${DATA}"
             container_helper_create_machine_id
         fi
 
@@ -415,29 +411,10 @@ function container_step_volume_update
     if utils_is_a_file "${DATA}/build-id" ; then
         if ! cmp -s $DATA/build-id $DATA_TEMPLATE/build-id ; then
             echo "FreeIPA server is already configured but with different version, volume update."
-            /usr/local/bin/populate-volume-from-template $DATA
+            container_helper_invoke_populate_volume_from_template "${DATA}"
             container_helper_create_machine_id
-            # FIXME Fix this shellcheck hint when refactoring this
-            #       function for unit tests
-            # shellcheck disable=SC2162
-            sha256sum -c /etc/volume-data-autoupdate 2> /dev/null | awk -F': ' '/OK$/ { print $1 }' \
-                | while read f ; do
-                    rm -f "$DATA/$f"
-                    if [ -e "$DATA_TEMPLATE/$f" ] ; then
-                        ( cd $DATA_TEMPLATE && tar cf - "./$f" ) | ( cd $DATA && tar xvf - )
-                    fi
-                done
-            # FIXME Fix this shellcheck hint when refactoring this
-            #       function for unit tests
-            # shellcheck disable=SC2162,SC2002
-            cat /etc/volume-data-list | while read i ; do
-                if [ -e "${DATA_TEMPLATE}$i" ] && [ -e "$DATA$i" ] ; then
-                    chown "--reference=${DATA_TEMPLATE}$i" "${DATA}$i" \
-                        || ( echo "Failed to chown $VOLUME" ; ls -ld "$VOLUME" )
-                    chmod "--reference=${DATA_TEMPLATE}$i" "${DATA}$i" \
-                        || ( echo "Failed to chmod $VOLUME" ; ls -ld "$VOLUME" )
-                fi
-            done
+            /usr/local/share/ipa-container/volume_sync.py --update \
+                --data "${DATA}" --template "${DATA_TEMPLATE}"
             SYSTEMD_OPTS=--unit=ipa-server-upgrade.service
         fi
         if container_helper_exist_ca_cert ; then
@@ -501,6 +478,7 @@ function container_step_save_ipa_server_ip_if_provided
 
 function container_step_exec_init
 {
+    tasks_helper_timeline_summary
     # exec /usr/sbin/init --show-status=false ${SYSTEMD_OPTS}
     exec /usr/sbin/init --show-status=true ${SYSTEMD_OPTS}
 
@@ -6,6 +6,18 @@ IPA_DM_PASSWORD="${IPA_DM_PASSWORD:-${PASSWORD}}"
 # Freeipa admin passowrd
 IPA_ADMIN_PASSWORD="${IPA_ADMIN_PASSWORD:-${PASSWORD}}"
 
+# Compiled tmpfiles plan; it is stored in the data volume so that it
+# survives pod restarts
+TMPFILES_CACHE_FILE="${TMPFILES_CACHE_FILE:-/data/var/cache/ipa-container/tmpfiles.cache}"
+
+# Journal of the tmpfiles entries applied, so that a tmpfiles run that
+# is interrupted (e.g. the pod is killed) resumes on the next start
+TMPFILES_JOURNAL_FILE="${TMPFILES_JOURNAL_FILE:-/data/var/cache/ipa-container/tmpfiles.journal}"
+
+# Drop-ins generated for the units of the image, reused while the image
+# build does not change
+UNIT_DROPINS_CACHE_FILE="${UNIT_DROPINS_CACHE_FILE:-/data/var/cache/ipa-container/unit-dropins.cache}"
+
 function ocp4_step_enable_traces
 {
     test -z "$DEBUG_TRACE" || {
@@ -19,43 +31,9 @@ function ocp4_step_enable_traces
     }
 }
 
-function ocp4_helper_switch_starting_by_substr
-{
-    local _starting="$1"
-    local _substr="$2"
-    local _filename="$3"
-    sed -i "s/^${_starting}/${_substr}/g" "${_filename}"
-}
-
-function ocp4_step_systemd_units_set_private_devices_off
-{
-    ocp4_helper_switch_starting_by_substr "PrivateDevices=true" "PrivateDevices=off" "/usr/lib/systemd/system/dbus-broker.service"
-}
-
-function ocp4_step_systemd_units_set_private_system_off
-{
-    # FIXME Clean-up
-    # sed -i "s/^ProtectSystem=full/# ProtectSystem=full/g" "/usr/lib/systemd/system/dbus-broker.service"
-    ocp4_helper_switch_starting_by_substr "ProtectSystem=full" "# ProtectSystem=full" "/usr/lib/systemd/system/dbus-broker.service"
-}
-
-function ocp4_helper_turn_private_tmp_off_for_one_file
-{
-    local _filename="$1"
-    ocp4_helper_switch_starting_by_substr "PrivateTmp=on" "PrivateTmp=off" "${_filename}"
-    ocp4_helper_switch_starting_by_substr "PrivateTmp=yes" "PrivateTmp=off" "${_filename}"
-    ocp4_helper_switch_starting_by_substr "PrivateTmp=true" "PrivateTmp=off" "${_filename}"
-}
-
-function ocp4_helper_turn_private_tmp_off
+function ocp4_helper_generate_unit_dropins
 {
-    for _filename in "$@"; do
-        utils_path_exists "${_filename}" || {
-            tasks_helper_msg_warning "File '${_filename}' not found at '${FUNCNAME[0]}'"
-            continue
-        }
-        ocp4_helper_turn_private_tmp_off_for_one_file "${_filename}"
-    done
+    /usr/local/share/ipa-container/unit_dropins.py --cache "${UNIT_DROPINS_CACHE_FILE}" "$@"
 }
 
 # FIXME PrivateTmp=true allow that other services does not have access to other
@@ -74,31 +52,38 @@ function ocp4_helper_turn_private_tmp_off
 #       https://kubernetes.io/docs/tutorials/clusters/seccomp/#create-seccomp-profiles
 #
 #       Other syscalls could be needed.
-function ocp4_step_systemd_units_set_private_tmp_off
-{
-    ocp4_helper_turn_private_tmp_off /lib/systemd/system/dirsrv@.service \
-                                     /lib/systemd/system/ipa-custodia.service \
-                                     /usr/lib/systemd/system/dbus-broker.service \
-                                     /lib/systemd/system/httpd.service \
-                                     /lib/systemd/system/chronyd.service \
-                                     /lib/systemd/system/dbus-org.freedesktop.hostname1.service \
-                                     /lib/systemd/system/dbus-org.freedesktop.locale1.service \
-                                     /lib/systemd/system/dbus-org.freedesktop.login1.service \
-                                     /lib/systemd/system/dbus-org.freedesktop.oom1.service \
-                                     /lib/systemd/system/dbus-org.freedesktop.timedate1.service \
-                                     /lib/systemd/system/ipa-ccache-sweep.service \
-                                     /lib/systemd/system/ipa-dnskeysyncd.service \
-                                     /lib/systemd/system/ipa-ods-exporter.service \
-                                     /lib/systemd/system/systemd-coredump@.service \
-                                     /lib/systemd/system/systemd-hostnamed.service \
-                                     /lib/systemd/system/systemd-localed.service \
-                                     /lib/systemd/system/systemd-logind.service \
-                                     /lib/systemd/system/systemd-oomd.service \
-                                     /lib/systemd/system/systemd-resolved.service \
-                                     /lib/systemd/system/systemd-timedated.service \
-                                     /lib/systemd/system/logrotate.service \
-                                     /lib/systemd/system/named.service \
-                                     /lib/systemd/system/httpd@.service
+#
+#       The unit files are not modified: drop-ins turning the options off
+#       are written to /run/systemd/system, only for the units that set
+#       them (see unit_dropins.py).
+function ocp4_step_systemd_units_write_dropins
+{
+    ocp4_helper_generate_unit_dropins \
+        --private-tmp-off /lib/systemd/system/dirsrv@.service \
+                          /lib/systemd/system/ipa-custodia.service \
+                          /usr/lib/systemd/system/dbus-broker.service \
+                          /lib/systemd/system/httpd.service \
+                          /lib/systemd/system/chronyd.service \
+                          /lib/systemd/system/dbus-org.freedesktop.hostname1.service \
+                          /lib/systemd/system/dbus-org.freedesktop.locale1.service \
+                          /lib/systemd/system/dbus-org.freedesktop.login1.service \
+                          /lib/systemd/system/dbus-org.freedesktop.oom1.service \
+                          /lib/systemd/system/dbus-org.freedesktop.timedate1.service \
+                          /lib/systemd/system/ipa-ccache-sweep.service \
+                          /lib/systemd/system/ipa-dnskeysyncd.service \
+                          /lib/systemd/system/ipa-ods-exporter.service \
+                          /lib/systemd/system/systemd-coredump@.service \
+                          /lib/systemd/system/systemd-hostnamed.service \
+                          /lib/systemd/system/systemd-localed.service \
+                          /lib/systemd/system/systemd-logind.service \
+                          /lib/systemd/system/systemd-oomd.service \
+                          /lib/systemd/system/systemd-resolved.service \
+                          /lib/systemd/system/systemd-timedated.service \
+                          /lib/systemd/system/logrotate.service \
+                          /lib/systemd/system/named.service \
+                          /lib/systemd/system/httpd@.service \
+        --private-devices-off /usr/lib/systemd/system/dbus-broker.service \
+        --protect-system-off /usr/lib/systemd/system/dbus-broker.service
 }
 
 function ocp4_step_process_hostname
@@ -116,9 +101,19 @@ function ocp4_step_process_hostname
     fi
 }
 
+function ocp4_helper_run_tmpfiles
+{
+    /usr/local/share/ipa-container/tmpfiles.py "$@"
+}
+
+# Every start of the container is a boot: like systemd-tmpfiles-setup
+# does at boot, remove the paths of the r and R lines and the contents
+# of the directories of the D lines, before creating the paths, and
+# apply the lines marked with '!'
 function ocp4_step_systemd_tmpfiles_create
 {
-    /usr/local/share/ipa-container/tmpfiles.py --create
+    ocp4_helper_run_tmpfiles --create --remove --boot \
+        --cache "${TMPFILES_CACHE_FILE}" --journal "${TMPFILES_JOURNAL_FILE}"
 }
 
 function ocp4_helper_write_to_options_file
@@ -184,7 +179,7 @@ function ocp4_step_process_first_boot
     if ! container_helper_exist_ca_cert ; then
         if ! utils_is_a_file "${DATA}/ipa.csr" ; then
             # Do not refresh $DATA in the second stage of the external CA setup
-            /usr/local/bin/populate-volume-from-template "${DATA}"
+            container_helper_invoke_populate_volume_from_template "${DATA}"
             container_helper_create_machine_id
         fi
 
@@ -210,9 +205,7 @@ function ocp4_step_process_first_boot
 
 OCP4_LIST_TASKS=()
 # +ocp4:begin-list
-OCP4_LIST_TASKS+=("ocp4_step_systemd_units_set_private_tmp_off")
-OCP4_LIST_TASKS+=("ocp4_step_systemd_units_set_private_system_off")
-OCP4_LIST_TASKS+=("ocp4_step_systemd_units_set_private_devices_off")
+OCP4_LIST_TASKS+=("ocp4_step_systemd_units_write_dropins")
 OCP4_LIST_TASKS+=("ocp4_step_systemd_tmpfiles_create")
 # +ocp4:end-list
 
@@ -232,3 +225,12 @@ tasks_helper_add_after \
     "container_step_volume_update" \
     "${OCP4_LIST_TASKS[@]}"
 
+# The unit drop-ins and tmpfiles can run side by side
+tasks_helper_add_prerequisites \
+    "ocp4_step_systemd_units_write_dropins" \
+    "container_step_volume_update"
+
+tasks_helper_add_prerequisites \
+    "ocp4_step_systemd_tmpfiles_create" \
+    "container_step_volume_update"
+
@@ -4,12 +4,30 @@
 declare -a ARGS
 declare -a ARGS_ORIGINAL
 declare -a TASKS_LIST
+declare -A TASKS_PREREQUISITES
+declare -a TASKS_TIMELINE
+declare -a TASKS_TIMELINE_STEPS
+declare -a TASKS_TIMELINE_STEP_SECONDS
 
 ARGS=("$@")
 # shellcheck disable=SC2034
 ARGS_ORIGINAL=("$@")
 TASKS_LIST=()
 
+# Steps with declared prerequisites (see tasks_helper_add_prerequisites)
+# run concurrently, up to this many at once; 1 runs every step in order
+TASKS_MAX_JOBS="${TASKS_MAX_JOBS:-1}"
+TASKS_PREREQUISITES=()
+
+# JSON timeline of the steps run, rewritten after every step; it is
+# only written once its directory exists
+TASKS_TIMELINE_FILE="${TASKS_TIMELINE_FILE:-/run/ipa/init-timeline.json}"
+TASKS_TIMELINE=()
+TASKS_TIMELINE_STEPS=()
+TASKS_TIMELINE_STEP_SECONDS=()
+TASKS_TIMELINE_START=""
+TASKS_TIMELINE_FORKS=""
+
 function tasks_helper_check_level
 {
     local msg_level="$1"
@@ -149,6 +167,8 @@ function tasks_helper_update_step
     local list=()
     local task_to_match="$1"
     local task_to_set="$2"
+    local item index
+    local prerequisites=()
     shift 2
 
     tasks_helper_are_step_functions "${task_to_match}" || tasks_helper_error "'${task_to_match}' function to match is not a step function"
@@ -163,6 +183,48 @@ function tasks_helper_update_step
     done
 
     TASKS_LIST=("${list[@]}")
+
+    # The new step takes over the prerequisites of the old one, and its
+    # place in the prerequisites of other steps
+    if [ -n "${TASKS_PREREQUISITES[${task_to_match}]+set}" ] \
+    && [ -z "${TASKS_PREREQUISITES[${task_to_set}]+set}" ]; then
+        TASKS_PREREQUISITES["${task_to_set}"]="${TASKS_PREREQUISITES[${task_to_match}]}"
+    fi
+    for item in "${!TASKS_PREREQUISITES[@]}"; do
+        read -r -a prerequisites <<< "${TASKS_PREREQUISITES[${item}]}"
+        for index in "${!prerequisites[@]}"; do
+            if [ "${prerequisites[index]}" == "${task_to_match}" ]; then
+                prerequisites[index]="${task_to_set}"
+            fi
+        done
+        TASKS_PREREQUISITES["${item}"]="${prerequisites[*]}"
+    done
+}
+
+# Declare that step $1 only needs the steps $2... to have finished
+# (besides the steps before it in the list that have no prerequisites
+# declared, which always run on their own, in order).  With
+# TASKS_MAX_JOBS > 1 such a step runs in a subshell, concurrently with
+# others, so it must not set variables that later steps use.
+# Prerequisites that are not in the list when the steps are executed
+# are ignored; those listed after the step are an error.
+function tasks_helper_add_prerequisites
+{
+    local task="$1"
+    local prerequisites=()
+    shift 1
+
+    tasks_helper_are_step_functions "${task}" || tasks_helper_error "'${task}' is not a step function"
+    tasks_helper_are_step_functions "$@" || tasks_helper_error "Some prerequisites are not step functions:" "$@"
+
+    read -r -a prerequisites <<< "${TASKS_PREREQUISITES[${task}]:-}"
+    prerequisites+=("$@")
+    TASKS_PREREQUISITES["${task}"]="${prerequisites[*]}"
+}
+
+function tasks_helper_has_prerequisites
+{
+    [ -n "${TASKS_PREREQUISITES[$1]+set}" ]
 }
 
 function tasks_helper_add_after
@@ -205,14 +267,215 @@ function tasks_helper_add_before
     TASKS_LIST=("${list[@]}")
 }
 
+# Set the variable named $1 to the monotonic time since boot, in
+# hundredths of a second.  Builtins only, so that no process is forked.
+function tasks_helper_read_uptime
+{
+    local _uptime _idle
+    read -r _uptime _idle < /proc/uptime
+    printf -v "$1" "%d" "$(( 10#${_uptime%.*} * 100 + 10#${_uptime#*.} ))"
+}
+
+# Set the variable named $1 to the number of processes forked since
+# boot (the "processes" line of /proc/stat).  That count is system
+# wide, so it includes what runs beside the container.
+function tasks_helper_read_forks
+{
+    local _key _value
+    while read -r _key _value; do
+        if [ "${_key}" == "processes" ]; then
+            printf -v "$1" "%d" "${_value}"
+            return 0
+        fi
+    done < /proc/stat
+    printf -v "$1" "%d" 0
+}
+
+# Set the variable named $1 to the hundredths of a second $2, formatted
+# as seconds
+function tasks_helper_format_seconds
+{
+    printf -v "$1" "%d.%02d" "$(( $2 / 100 ))" "$(( $2 % 100 ))"
+}
+
+function tasks_helper_timeline_add
+{
+    local task="$1"
+    local start="$2"
+    local end="$3"
+    local status="$4"
+    local forks="$5"
+    local start_s end_s seconds item
+
+    tasks_helper_format_seconds start_s "${start}"
+    tasks_helper_format_seconds end_s "${end}"
+    tasks_helper_format_seconds seconds "$(( end - start ))"
+    printf -v item '{"step": "%s", "start": %s, "end": %s, "seconds": %s, "status": %d, "forks": %d}' \
+        "${task}" "${start_s}" "${end_s}" "${seconds}" "${status}" "${forks}"
+    TASKS_TIMELINE+=("${item}")
+    TASKS_TIMELINE_STEPS+=("${task}")
+    TASKS_TIMELINE_STEP_SECONDS+=("$(( end - start ))")
+}
+
+function tasks_helper_timeline_write
+{
+    local now forks start_s end_s seconds sep item
+    [ -d "${TASKS_TIMELINE_FILE%/*}" ] || return 0
+    tasks_helper_read_uptime now
+    tasks_helper_read_forks forks
+    tasks_helper_format_seconds start_s "${TASKS_TIMELINE_START}"
+    tasks_helper_format_seconds end_s "${now}"
+    tasks_helper_format_seconds seconds "$(( now - TASKS_TIMELINE_START ))"
+    {
+        printf '{\n  "start": %s,\n  "end": %s,\n  "seconds": %s,\n  "forks": %d,\n  "steps": [' \
+            "${start_s}" "${end_s}" "${seconds}" "$(( forks - TASKS_TIMELINE_FORKS ))"
+        sep=""
+        for item in "${TASKS_TIMELINE[@]}"; do
+            printf '%s\n    %s' "${sep}" "${item}"
+            sep=","
+        done
+        printf '\n  ]\n}\n'
+    } > "${TASKS_TIMELINE_FILE}" || tasks_helper_msg_warning "Failed to write '${TASKS_TIMELINE_FILE}'"
+}
+
+# Log a one-line summary of the timeline (e.g. before exec init)
+function tasks_helper_timeline_summary
+{
+    local now forks seconds slowest_seconds index
+    local slowest=-1
+    [ "${TASKS_TIMELINE_START}" != "" ] || return 0
+    tasks_helper_read_uptime now
+    tasks_helper_read_forks forks
+    for index in "${!TASKS_TIMELINE_STEP_SECONDS[@]}"; do
+        if [ "${slowest}" -lt 0 ] \
+        || [ "${TASKS_TIMELINE_STEP_SECONDS[index]}" -gt "${TASKS_TIMELINE_STEP_SECONDS[slowest]}" ]; then
+            slowest="${index}"
+        fi
+    done
+    tasks_helper_format_seconds seconds "$(( now - TASKS_TIMELINE_START ))"
+    if [ "${slowest}" -lt 0 ]; then
+        tasks_helper_msg_info "Startup timeline: no steps in ${seconds}s"
+        return 0
+    fi
+    tasks_helper_format_seconds slowest_seconds "${TASKS_TIMELINE_STEP_SECONDS[slowest]}"
+    tasks_helper_msg_info "Startup timeline: ${#TASKS_TIMELINE[@]} steps in ${seconds}s, $(( forks - TASKS_TIMELINE_FORKS )) forks; slowest: '${TASKS_TIMELINE_STEPS[slowest]}' (${slowest_seconds}s); see '${TASKS_TIMELINE_FILE}'"
+}
+
+# Run step number $1 of TASKS_LIST in this shell
+function tasks_helper_run_step
+{
+    # prefixed, because the step runs in the scope of these locals
+    local _task="${TASKS_LIST[$1]}"
+    local _task_start _task_end _task_status _task_forks_start _task_forks_end
+    tasks_helper_msg_info "Running step: '${_task}'"
+    tasks_helper_read_forks _task_forks_start
+    tasks_helper_read_uptime _task_start
+    _task_status=0
+    "${_task}" || _task_status=$?
+    tasks_helper_read_uptime _task_end
+    tasks_helper_read_forks _task_forks_end
+    tasks_helper_timeline_add "${_task}" "${_task_start}" "${_task_end}" "${_task_status}" "$(( _task_forks_end - _task_forks_start ))"
+    tasks_helper_timeline_write
+    [ "${_task_status}" -eq 0 ] || {
+        tasks_helper_msg_error "Executing step at: '${_task}'"
+        exit 1
+    }
+    _tasks_done["${_task}"]=1
+}
+
+# Start the pending steps whose prerequisites are done, while fewer
+# than TASKS_MAX_JOBS run
+function tasks_helper_start_ready_steps
+{
+    local _index _prerequisite _ready
+    local _pending=()
+    for _index in "${_tasks_pending[@]}"; do
+        _ready=1
+        if [ "${#_tasks_running[@]}" -ge "${TASKS_MAX_JOBS}" ]; then
+            _ready=0
+        fi
+        for _prerequisite in ${TASKS_PREREQUISITES[${TASKS_LIST[_index]}]}; do
+            if [ -n "${_tasks_seen[${_prerequisite}]+set}" ] \
+            && [ -z "${_tasks_done[${_prerequisite}]+set}" ]; then
+                _ready=0
+            fi
+        done
+        if [ "${_ready}" -eq 0 ]; then
+            _pending+=("${_index}")
+            continue
+        fi
+        tasks_helper_msg_info "Running step: '${TASKS_LIST[_index]}'"
+        tasks_helper_read_forks "_tasks_forks_start[_index]"
+        tasks_helper_read_uptime "_tasks_start[_index]"
+        ( "${TASKS_LIST[_index]}" || exit $? ) &
+        _tasks_running[$!]="${_index}"
+    done
+    _tasks_pending=("${_pending[@]}")
+}
+
+# Wait for one of the steps started by tasks_helper_start_ready_steps;
+# if it failed, stop the others and exit
+function tasks_helper_wait_step
+{
+    local _pid _index _status _end _forks
+    [ "${#_tasks_running[@]}" -gt 0 ] || tasks_helper_error "Prerequisites of these steps are never done: ${_tasks_pending[*]}"
+    _status=0
+    wait -n -p _pid "${!_tasks_running[@]}" || _status=$?
+    _index="${_tasks_running[${_pid}]}"
+    unset "_tasks_running[${_pid}]"
+    tasks_helper_read_uptime _end
+    tasks_helper_read_forks _forks
+    tasks_helper_timeline_add "${TASKS_LIST[_index]}" "${_tasks_start[_index]}" "${_end}" "${_status}" "$(( _forks - _tasks_forks_start[_index] ))"
+    tasks_helper_timeline_write
+    [ "${_status}" -eq 0 ] || {
+        tasks_helper_msg_error "Executing step at: '${TASKS_LIST[_index]}'"
+        if [ "${#_tasks_running[@]}" -gt 0 ]; then
+            kill "${!_tasks_running[@]}" 2>/dev/null || true
+            wait "${!_tasks_running[@]}" || true
+        fi
+        exit 1
+    }
+    _tasks_done["${TASKS_LIST[_index]}"]=1
+}
+
+# Run the pending steps, and wait until none is running
+function tasks_helper_finish_steps
+{
+    while [ "${#_tasks_pending[@]}" -gt 0 ] || [ "${#_tasks_running[@]}" -gt 0 ]; do
+        tasks_helper_start_ready_steps
+        tasks_helper_wait_step
+    done
+}
+
 function tasks_helper_execute
 {
-    for task in "${TASKS_LIST[@]}"; do
-        tasks_helper_msg_info "Running step: '${task}'"
-        "${task}" || {
-            tasks_helper_msg_error "Executing step at: '${task}'"
-            exit 1
-        }
+    local _index _task _prerequisite
+    local _tasks_pending=() _tasks_start=() _tasks_forks_start=()
+    local -A _tasks_seen=() _tasks_done=() _tasks_running=()
+    [[ "${TASKS_MAX_JOBS}" =~ ^[1-9][0-9]*$ ]] || tasks_helper_error "TASKS_MAX_JOBS must be a positive number: '${TASKS_MAX_JOBS}'"
+    tasks_helper_read_uptime TASKS_TIMELINE_START
+    tasks_helper_read_forks TASKS_TIMELINE_FORKS
+    TASKS_TIMELINE=()
+    TASKS_TIMELINE_STEPS=()
+    TASKS_TIMELINE_STEP_SECONDS=()
+    for _index in "${!TASKS_LIST[@]}"; do
+        _task="${TASKS_LIST[_index]}"
+        if [ "${TASKS_MAX_JOBS}" -gt 1 ] && tasks_helper_has_prerequisites "${_task}"; then
+            for _prerequisite in ${TASKS_PREREQUISITES[${_task}]}; do
+                if [ -z "${_tasks_seen[${_prerequisite}]+set}" ] \
+                && tasks_helper_has_step_task "${_prerequisite}"; then
+                    tasks_helper_error "'${_prerequisite}' must be listed before '${_task}'"
+                fi
+            done
+            _tasks_seen["${_task}"]=1
+            _tasks_pending+=("${_index}")
+            tasks_helper_start_ready_steps
+        else
+            tasks_helper_finish_steps
+            _tasks_seen["${_task}"]=1
+            tasks_helper_run_step "${_index}"
+        fi
     done
+    tasks_helper_finish_steps
     return 0
 }
@@ -5,33 +5,108 @@
 Script that processes systemd-tmpfiles config files, approximately
 in the manner described by `tmpfiles.d(5)`.
 
-Only creates files/dirs/links, chowns, chmods, sets attributes and
-ACLs.  Does not implement cleanup and removal.
-
-`!` (indicating post-boot unsafety) is ignored, because this script
-is only intended to be used at container startup.
-
-ONLY files in `/usr/lib/tmpfiles.d` are read - not the other
-directories.  Does not perform any conflict resolution (where the
-same target file is mentioned by multiple config files).
+Creates files/dirs/links, chowns, chmods, sets attributes and ACLs
+(`--create`), cleans up old files (`--clean`) and removes paths
+(`--remove`).  As in systemd-tmpfiles, `r` and `R` lines only act with
+`--remove`, and `D` lines then remove the contents of the directory.
+Removal and cleanup are done before creation.
+
+User and group names are resolved once each.  `--name-source=files`
+reads them from `/etc/passwd` and `/etc/group` instead of NSS, for use
+before sssd is running.  Lines that cannot be parsed are reported with
+their config file and line number, and skipped.
+
+As in systemd-tmpfiles, lines marked with `!` (unsafe after boot) are
+only applied with `--boot`.
+
+All configs are merged into a single plan, ordered by path.  When
+several lines conflict for the same path (e.g. two config files both
+create it), the line from the config file that sorts first wins, as
+described in `tmpfiles.d(5)`.
+
+With `--cache FILE` the parsed lines of every config are kept in FILE
+(as JSON) and reused as long as the config file and the values of the
+specifiers it uses do not change.  `--compile` only refreshes the
+cache (`PLAN_CACHE_FILE` unless `--cache` is given).  It is not run at
+image build: the cache is kept in the data volume, which hides what
+the image has below /data.
+
+With `--journal FILE` the entries applied are recorded in FILE until
+the run ends, and a run that was interrupted (e.g. the container was
+killed) is resumed: the recorded entries are only verified, and
+applied again if they differ.  `C` copies to a temporary name first,
+so an interrupted copy is started over.
+
+With `--jobs N` subtrees that share no path prefix are applied
+concurrently; parents are still applied before their children.
+
+ACLs and file attributes are set in-process, through the
+`system.posix_acl_*` extended attributes and the FS_IOC_SETFLAGS
+ioctl.  `setfacl` and `chattr` are only run when the native backend
+does not support the spec or the file system.
+
+Specifiers (`%b`, `%m`, ...) are resolved on first use, so a missing
+`/etc/machine-id` only fails the lines that use `%m`.  The os-release
+specifiers (`%A %B %M %o %w %W`) are supported.
+
+Paths are operated on relative to cached file descriptors of their
+parent directories (`openat()`, `fchownat()`, ...), and files are
+created with `O_EXCL`/`O_NOFOLLOW` instead of after an existence check.
+
+`C` copies trees in one `os.scandir()` walk, preserving ownership,
+mode and timestamps.  File contents are reflinked (FICLONE) where the
+file system supports it, else copied in the kernel.  With `--jobs N`
+the files of a tree are copied concurrently.
+
+`--verify` changes nothing: it checks every path of the plan with one
+`lstat()`, reports those that are missing or have the wrong type,
+ownership, mode, ACLs or symbolic link target, and exits with status
+1 if there are any (e.g. for a readiness probe).
+
+`--watch` keeps running after `--create`, re-applies the entries of
+paths that are removed, or whose ownership or mode is changed, and
+applies the new plan when a config is changed (see `PlanWatcher`).
+
+Output is buffered and written once, at the end of the run: errors,
+warnings (with the config file and line they concern), what was
+removed or cleaned, and a summary.  `--quiet` only logs errors,
+`--verbose` also every path, and `--log-format=json` logs JSON Lines
+records with the config file, line number, line type and errno as
+fields.
+
+`--stats` prints a JSON summary of the run: wall time, system calls
+(stat/chown/chmod/mkdir/open), forks and errors per config file and
+per line type, and the slowest lines.  `--trace-json FILE` writes one
+JSON object per parsed config and per applied line to FILE.
 
 """
 
 import argparse
+import atexit
 import collections
+import collections.abc
+import errno
+import fcntl
+import fnmatch
+import functools
 import glob
 import grp
-import itertools
-import operator
+import heapq
+import json
 import os
-import pathlib
 import pwd
 import re
-import shutil
+import select
+import shlex
 import stat
+import struct
 import subprocess
 import sys
-import tempfile
+import threading
+import time
+
+# concurrent.futures, hashlib and tempfile are imported where they are
+# used; they are slow to import and most runs do not need them
 
 TMPFILES_DIRS = (
     "/etc/tmpfiles.d",
@@ -41,6 +116,36 @@ TMPFILES_DIRS = (
 FACTORY_DIR = "/usr/share/factory"
 BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
 MACHINE_ID_FILE = "/etc/machine-id"
+OS_RELEASE_FILES = ("/etc/os-release", "/usr/lib/os-release")
+PASSWD_FILE = "/etc/passwd"
+GROUP_FILE = "/etc/group"
+DIR_FD_CACHE_SIZE = 64
+WALK_BATCH_SIZE = 512
+STATS_SLOWEST_LINES = 10
+
+# flush the log when this many messages are pending
+LOG_BUFFER_LINES = 4096
+
+# number of threads used for recursive actions (Z); set by --jobs
+RECURSIVE_JOBS = 1
+# in the data volume, like the cache of the OpenShift step (ocp4.inc.sh)
+PLAN_CACHE_FILE = "/data/var/cache/ipa-container/tmpfiles.cache"
+PLAN_CACHE_VERSION = 4
+# seconds without inotify events before re-applying entries (--watch)
+WATCH_DEBOUNCE = 0.2
+# at most this many seconds between writes to the journal, and entries
+# that take this long to apply are written right away (--journal)
+JOURNAL_WRITE_INTERVAL = 1.0
+JOURNAL_SLOW_ENTRY = 0.05
+FILE_KINDS = {
+    stat.S_IFREG: "regular file",
+    stat.S_IFDIR: "directory",
+    stat.S_IFLNK: "symbolic link",
+    stat.S_IFCHR: "character device",
+    stat.S_IFBLK: "block device",
+    stat.S_IFIFO: "fifo",
+    stat.S_IFSOCK: "socket",
+}
 
 
 def list_tmpfiles_configs():
@@ -68,59 +173,131 @@ def list_tmpfiles_configs():
     return conffiles
 
 
-def get_specifier_map():
-    """Create mapping from specifier to value"""
-    # $TMPDIR, $TEMP, $TMP, or /tmp
-    tmpdir = tempfile.gettempdir()
-
-    # specifier_user_id() calls getuid(), not geteuid()
-    uid = os.getuid()
-    username = pwd.getpwuid(uid).pw_name
-    gid = os.getgid()
-    groupname = grp.getgrgid(gid).gr_name
-
-    uname = os.uname()
-    # machine is "x86_64", systemd wants "x86-64"
-    arch = uname.machine.replace("_", "-")
-    hostname = uname.nodename
-    shortname = hostname.split(".", 1)[0]
-
+def read_os_release():
+    """
+    Parse os-release(5) (`/etc/os-release`, falling back to
+    `/usr/lib/os-release`) into a `dict`.  Return an empty `dict` if
+    neither exists.
+    """
+    for path in OS_RELEASE_FILES:
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            continue
+        fields = {}
+        with f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                key, value = line.split("=", 1)
+                try:
+                    value = "".join(shlex.split(value))
+                except ValueError:
+                    pass  # unbalanced quotes, keep as-is
+                fields[key] = value
+        return fields
+    return {}
+
+
+def _read_boot_id():
     with open(BOOT_ID_FILE) as f:
         # Kernel boot_id file has dashes, systemd strips dashes
-        boot_id = f.read().strip().replace("-", "")
+        return f.read().strip().replace("-", "")
 
+
+def _read_machine_id():
     with open(MACHINE_ID_FILE) as f:
-        machine_id = f.read().strip()
+        return f.read().strip()
 
-    return {
-        "a": arch,  # architecture
-        # "A": None,  # os-release IMAGE_VERSION or empty string
-        "b": boot_id,
-        # "B": None,  # os-release BUILD_ID or empty string
-        "C": "/var/cache",  # system cache dir
-        "g": groupname,  # user group name
-        "G": str(gid),  # user gid
-        "h": "/root",  # home dir
-        "H": hostname,  # node host name
-        "l": shortname,  # short host name
-        "L": "/var/log",  # system log dir
-        "m": machine_id,  # /etc/machine-id
-        # "M": None,  # os-release IMAGE_ID or empty string
-        # "o": None,  # os-release ID, never empty string (!)
-        "S": "/var/lib",  # system state dir
-        "t": "/run",  # system runtime dir
-        "T": tmpdir,  # system tmp dir
-        "u": username,  # user name
-        "U": str(uid),  # uid
-        "v": uname.release,  # Kernel release (uname -r)
-        "V": "/var/run",  # large file tmp dir
-        # "w": None,  # os-release VERSION_ID or empty string
-        # "W": None,  # os-release VARIANT_ID or empty string
-        "%": "%",  # %% -> %
-    }
 
+class SpecifierMap(collections.abc.Mapping):
+    """
+    Mapping from specifier to value.  Every value is resolved on first
+    use and memoized, so that running the script does not look up
+    users, read `/etc/machine-id` etc. unless a config needs it.
+
+    A value that cannot be resolved (e.g. `%m` before
+    `/etc/machine-id` exists) raises `ValueError`, which fails only the
+    lines that use it.
 
-SPECIFIERS = get_specifier_map()
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._os_release = None
+        self._resolvers = {
+            # machine is "x86_64", systemd wants "x86-64"
+            "a": lambda: os.uname().machine.replace("_", "-"),  # architecture
+            "A": lambda: self.os_release("IMAGE_VERSION"),
+            "b": _read_boot_id,
+            "B": lambda: self.os_release("BUILD_ID"),
+            "C": lambda: "/var/cache",  # system cache dir
+            # specifier_user_id() calls getuid(), not geteuid()
+            "g": lambda: grp.getgrgid(os.getgid()).gr_name,  # user group name
+            "G": lambda: str(os.getgid()),  # user gid
+            "h": lambda: "/root",  # home dir
+            "H": lambda: os.uname().nodename,  # node host name
+            "l": lambda: self["H"].split(".", 1)[0],  # short host name
+            "L": lambda: "/var/log",  # system log dir
+            "m": _read_machine_id,  # /etc/machine-id
+            "M": lambda: self.os_release("IMAGE_ID"),
+            # never empty, see os-release(5)
+            "o": lambda: self.os_release("ID") or "linux",
+            "S": lambda: "/var/lib",  # system state dir
+            "t": lambda: "/run",  # system runtime dir
+            # $TMPDIR, $TEMP, $TMP, or /tmp
+            "T": self._tmpdir,  # system tmp dir
+            "u": lambda: pwd.getpwuid(os.getuid()).pw_name,  # user name
+            "U": lambda: str(os.getuid()),  # uid
+            "v": lambda: os.uname().release,  # Kernel release (uname -r)
+            "V": lambda: "/var/run",  # large file tmp dir
+            "w": lambda: self.os_release("VERSION_ID"),
+            "W": lambda: self.os_release("VARIANT_ID"),
+            "%": lambda: "%",  # %% -> %
+        }
+
+    def __getitem__(self, spec):
+        try:
+            return self._values[spec]
+        except KeyError:
+            pass
+        resolver = self._resolvers[spec]
+        try:
+            value = resolver()
+        except (OSError, KeyError) as e:
+            raise ValueError(f"cannot resolve specifier '%{spec}': {e}")
+        self._values[spec] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._resolvers)
+
+    def __len__(self):
+        return len(self._resolvers)
+
+    def os_release(self, key):
+        """Return field `key` of os-release(5), or an empty string."""
+        if self._os_release is None:
+            self._os_release = read_os_release()
+        return self._os_release.get(key, "")
+
+    @staticmethod
+    def _tmpdir():
+        import tempfile
+
+        return tempfile.gettempdir()
+
+
+SPECIFIERS = SpecifierMap()
+
+
+def _specifier_value(spec):
+    """Return the value of `spec`, or None if it cannot be resolved."""
+    try:
+        return SPECIFIERS[spec]
+    except (KeyError, ValueError):
+        return None
 
 
 def resolve_specifiers(path):
@@ -135,191 +312,3044 @@ def resolve_specifiers(path):
         except KeyError:
             raise ValueError(f"Unsupported specififer '{spec}' in '{path}'.")
 
-    return re.sub(r"%([a-zA-Z%])", subst_cb, path)
+    return re.sub(r"%([a-zA-Z%])", subst_cb, path)
+
+
+class NameResolver:
+    """
+    Resolve user and group names to ids, once per name.
+
+    With `source="nss"` names are looked up through NSS (`pwd`/`grp`),
+    which in the FreeIPA image may go to sssd.  With `source="files"`
+    `/etc/passwd` and `/etc/group` are parsed once and NSS is never
+    used, which is safe at early boot, before sssd is running.
+
+    """
+
+    def __init__(self, source="nss"):
+        self.source = source
+        self.lookups = 0  # number of names looked up (incl. memoized)
+        self._cache = {}
+        self._files = {}
+
+    def _read_db(self, path):
+        """Return a `dict` mapping names to ids from a passwd-like file."""
+        if path not in self._files:
+            db = {}
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split(":")
+                    if len(fields) >= 3 and fields[0] not in db:
+                        try:
+                            db[fields[0]] = int(fields[2])
+                        except ValueError:
+                            pass
+            self._files[path] = db
+        return self._files[path]
+
+    def _resolve(self, kind, name):
+        if self.source == "files":
+            db = self._read_db(PASSWD_FILE if kind == "user" else GROUP_FILE)
+            return db[name]
+        elif kind == "user":
+            return pwd.getpwnam(name).pw_uid
+        else:
+            return grp.getgrnam(name).gr_gid
+
+    def lookup(self, kind, name):
+        """Return the id of the `kind` ("user" or "group") `name`."""
+        self.lookups += 1
+        key = (kind, name)
+        if key not in self._cache:
+            try:
+                self._cache[key] = self._resolve(kind, name)
+            except (KeyError, OSError):
+                self._cache[key] = None
+        if self._cache[key] is None:
+            raise ValueError(f"unknown {kind} {name!r}")
+        return self._cache[key]
+
+
+NAME_RESOLVER = NameResolver()
+
+
+def _namedb_fingerprint():
+    """Return a `list` that changes whenever the user or group database
+    files change."""
+    fingerprints = []
+    for path in (PASSWD_FILE, GROUP_FILE):
+        try:
+            fingerprints.append(file_fingerprint(path))
+        except OSError:
+            fingerprints.append(None)
+    return fingerprints
+
+
+ParsedConfig = collections.namedtuple(
+    "ParsedConfig", ["entries", "specifiers", "errors", "uses_names"]
+)
+
+
+class PathFilter:
+    """
+    Match paths against `--prefix` and `--exclude-prefix` options.
+
+    A path matches a prefix if it is equal to it or below it.  Prefixes
+    are normalized once, so that matching a path is a single
+    `str.startswith()` call per list, without creating any objects.
+
+    """
+
+    def __init__(self, prefixes=None, exclude_prefixes=None):
+        self.include = self._index(prefixes) if prefixes else None
+        self.exclude = self._index(exclude_prefixes or [])
+
+    @staticmethod
+    def _index(prefixes):
+        """Return `(exact_paths, prefixes_with_trailing_slash)`."""
+        prefixes = {os.path.normpath(p).rstrip("/") for p in prefixes}
+        exact = frozenset(p or "/" for p in prefixes)
+        return exact, tuple(p + "/" for p in sorted(prefixes))
+
+    @staticmethod
+    def _matches(index, path):
+        exact, below = index
+        return path in exact or path.startswith(below)
+
+    def __call__(self, path):
+        if self.include is not None and not self._matches(self.include, path):
+            return False
+        return not self._matches(self.exclude, path)
+
+
+def parse_tmpfiles_config(path, path_filter=None):
+    """
+    Parse the tmpfiles config.  Return a `ParsedConfig`.
+
+    `entries` is a `list` of `(path,action)` tuples, in the order of
+    the lines of the config.  Each action remembers the config file and
+    line number it came from in its `source` attribute.  Lines for
+    paths rejected by `path_filter` are skipped before being parsed.
+
+    `specifiers` is the sorted `list` of specifiers used by the
+    config and `uses_names` tells whether any user or group name was
+    resolved, so that callers can tell whether previously parsed
+    entries are still valid.
+
+    Lines that cannot be parsed (e.g. an unknown user) are reported
+    with their config file and line number, counted in `errors` and
+    skipped.
+
+    """
+    entries = []
+    specifiers = set()
+    errors = 0
+    lookups = NAME_RESOLVER.lookups
+    start = time.perf_counter()
+    with open(path) as f:
+        for lineno, line in enumerate(f, start=1):
+            line = line.strip()
+            if len(line) <= 0 or line.startswith("#"):
+                continue
+            try:
+                fields = line.split(maxsplit=2)
+                if len(fields) > 1:
+                    specifiers.update(re.findall(r"%([a-zA-Z%])", fields[1]))
+                    if path_filter is not None and not path_filter(
+                        resolve_specifiers(fields[1])
+                    ):
+                        continue
+                target, action = parse_action(line)
+            except ValueError as e:
+                LOG.warning(f"{e}, ignoring line", config=path, line=lineno)
+                errors += 1
+                continue
+            action.source = (path, lineno)
+            entries.append((target, action))
+    STATS.add_parse(path, time.perf_counter() - start, len(entries), errors)
+    return ParsedConfig(
+        entries, sorted(specifiers), errors, NAME_RESOLVER.lookups > lookups
+    )
+
+
+def merge_entries(entries):
+    """
+    Merge `(path,action)` entries into a plan.  Return a `list` of
+    `(path,list_of_actions)` tuples, with paths in lexicographic
+    order.  Therefore, prefix/parent paths are always listed before
+    suffix/child paths.  The actions for each path are ordered by
+    their position in `ACTION_MAP`.
+
+    `entries` must be given in config file order.  As described in
+    `tmpfiles.d(5)`, when several lines for the same path conflict
+    (e.g. two lines that both create the path), the first one wins and
+    the others are ignored.  Exact duplicates are ignored silently.
+
+    """
+    by_path = {}
+    for path, action in entries:
+        actions = by_path.setdefault(path, [])
+        if any(action.same_as(other) for other in actions):
+            continue
+        if not action.append_or_force and not all(
+            action.compatible_with(other) for other in actions
+        ):
+            config, lineno = action.source or ("<unknown>", None)
+            LOG.warning(
+                f"duplicate line for path {path!r}, ignoring",
+                config=config,
+                line=lineno,
+                type=action.line_type,
+                path=path,
+            )
+            continue
+        actions.append(action)
+
+    def rank(action):
+        return ACTION_RANK[type(action)]
+
+    return [
+        (path, sorted(by_path[path], key=rank)) for path in sorted(by_path)
+    ]
+
+
+def read_tmpfiles_config(path, prefix):
+    """
+    Read the tmpfiles config.  Return a `list` of groups of
+    `(path,list_of_actions)` tuples, as returned by `merge_entries()`.
+
+    Ignore paths that do not match the given `prefix`.
+
+    """
+    parsed = parse_tmpfiles_config(path, PathFilter([prefix]))
+    return merge_entries(parsed.entries)
+
+
+def read_tmpfiles_configs(
+    config_files, path_filter=None, cache_file=None, boot=True
+):
+    """
+    Read all the tmpfiles configs in one pass and merge them into a
+    single plan (see `merge_entries()`).  If `cache_file` is given,
+    unchanged configs are loaded from it (see `compile_plan()`).
+
+    Ignore paths rejected by `path_filter` (a `PathFilter`), and the
+    `!` lines unless `boot` is true.
+
+    """
+    if cache_file:
+        # the cache holds every line, so filter after loading it
+        entries = (
+            (path, action)
+            for _config_file, entries in compile_plan(config_files, cache_file)
+            for path, action in entries
+            if path_filter is None or path_filter(path)
+        )
+    else:
+        entries = (
+            entry
+            for config_file in config_files
+            for entry in parse_tmpfiles_config(config_file, path_filter).entries
+        )
+    if not boot:
+        entries = ((path, a) for path, a in entries if not a.bootonly)
+    return merge_entries(entries)
+
+
+def file_fingerprint(path):
+    """Return a `list` that changes whenever the file is replaced or
+    modified."""
+    st = os.stat(path)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def _encode_entry(path, action):
+    """Return the `(path, action)` entry as plain JSON values."""
+    return [
+        path,
+        action.line_type,
+        action.bootonly,
+        action.mode,
+        action.user,
+        action.group,
+        action.age,
+        action.arg,
+        action.source[1] if action.source else None,
+    ]
+
+
+def _decode_entry(config_file, record):
+    """
+    Rebuild a `(path, action)` entry from `_encode_entry()` output.
+    The fields were validated when the line was parsed, so they are
+    set as they are, without parsing (or resolving names) again.
+    Raise ValueError if `record` is not such an entry.
+    """
+    try:
+        path, typ, bootonly, mode, user, group, age, arg, lineno = record
+        action_class = ACTION_MAP[typ]
+    except (TypeError, ValueError, KeyError):
+        raise ValueError(f"invalid plan cache entry {record!r}")
+    if not isinstance(path, str):
+        raise ValueError(f"invalid plan cache path {path!r}")
+    action = action_class.__new__(action_class)
+    action.line_type = typ
+    action.bootonly = bool(bootonly)
+    action.mode = None if mode is None else (bool(mode[0]), int(mode[1]))
+    action.user = None if user is None else int(user)
+    action.group = None if group is None else int(group)
+    action.age = None if age is None else Age(*age)
+    action.arg = tuple(arg) if isinstance(arg, list) else arg
+    action.source = (config_file, lineno)
+    return path, action
+
+
+def load_plan_cache(cache_file):
+    """
+    Load the compiled plan cache.  Return a `dict` mapping config file
+    paths to cache entries, or an empty `dict` if the cache is missing,
+    unreadable or was written by a different version of this script.
+
+    The cache is JSON, not `pickle`: it may be stored on a volume that
+    is writable by others, and loading it must not run any code.
+
+    """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if (
+            not isinstance(cache, dict)
+            or cache.get("version") != PLAN_CACHE_VERSION
+            or cache.get("script") != file_fingerprint(__file__)
+        ):
+            return {}
+        configs = {}
+        for config_file, entry in cache["configs"].items():
+            entry["entries"] = [
+                _decode_entry(config_file, record) for record in entry["entries"]
+            ]
+            configs[config_file] = entry
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+        LOG.warning(f"ignoring plan cache {cache_file!r}: {e}")
+        return {}
+    return configs
+
+
+def save_plan_cache(cache_file, configs):
+    """Atomically write the compiled plan cache.  Failures (e.g. a
+    read-only file system) are reported but otherwise ignored."""
+    import tempfile
+
+    cache = {
+        "version": PLAN_CACHE_VERSION,
+        "script": file_fingerprint(__file__),
+        "configs": {
+            config_file: dict(
+                entry,
+                entries=[_encode_entry(path, a) for path, a in entry["entries"]],
+            )
+            for config_file, entry in configs.items()
+        },
+    }
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=".tmpfiles-cache.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, cache_file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError as e:
+        LOG.warning(f"failed to write plan cache {cache_file!r}: {e}")
+
+
+def _cache_entry_valid(entry, fingerprint):
+    if entry is None or entry["fingerprint"] != fingerprint:
+        return False
+    if entry["errors"]:
+        return False  # try again, e.g. an unknown user may exist now
+    if entry["namedb"] is not None and entry["namedb"] != _namedb_fingerprint():
+        return False
+    return all(
+        _specifier_value(spec) == value
+        for spec, value in entry["specifiers"].items()
+    )
+
+
+def compile_plan(config_files, cache_file):
+    """
+    Return a `list` of `(config_file, entries)` tuples, where `entries`
+    is the unfiltered output of `parse_tmpfiles_config()`.
+
+    Entries are taken from `cache_file` when the config file's
+    inode/size/mtime, the values of the specifiers it uses and (if it
+    uses user or group names) the passwd and group files are unchanged
+    and it had no errors.  Other configs are re-parsed and the cache is
+    rewritten.
+
+    """
+    cached = load_plan_cache(cache_file)
+    configs = {}
+    result = []
+    changed = False
+    for config_file in config_files:
+        fingerprint = file_fingerprint(config_file)
+        entry = cached.get(config_file)
+        if not _cache_entry_valid(entry, fingerprint):
+            changed = True
+            parsed = parse_tmpfiles_config(config_file)
+            entry = {
+                "fingerprint": fingerprint,
+                "specifiers": {
+                    s: _specifier_value(s) for s in parsed.specifiers
+                },
+                "namedb": _namedb_fingerprint() if parsed.uses_names else None,
+                "errors": parsed.errors,
+                "entries": parsed.entries,
+            }
+        configs[config_file] = entry
+        result.append((config_file, entry["entries"]))
+    if changed or configs.keys() != cached.keys():
+        save_plan_cache(cache_file, configs)
+    return result
+
+
+def parse_action(line):
+    """
+    Parse a line, returning a `(path,action)` pair or raising
+    ValueError on parse failure.  This function should NOT be
+    applied to empty lines or comments.
+    """
+    fields = line.split(maxsplit=6)
+    fields += [None] * (7 - len(fields))  # extend to required length
+    typ, path, mode, user, group, age, arg = fields
+
+    # apply templating, e.g. %b
+    path = resolve_specifiers(path)
+
+    boot_only = "!" in typ
+    ignore_error = "-" in typ  # TODO implement
+    remove_mismatched = "=" in typ  # TODO implement
+    typ = typ.strip("!-=")
+
+    try:
+        action_class = ACTION_MAP[typ]
+    except KeyError:
+        raise ValueError(f"unknown line type {typ!r}")
+    action = action_class(boot_only, mode, user, group, age, arg)
+    action.line_type = typ
+    return (path, action)
+
+
+# characters that make a path a glob pattern
+GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+def _glob_anchor(path):
+    """Return the longest leading part of `path` without glob magic."""
+    while GLOB_MAGIC.search(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def _is_under(path, root):
+    return path == root or path.startswith(root.rstrip("/") + "/")
+
+
+def _resolver():
+    """
+    Return a function that resolves the symbolic links of a path, like
+    `os.path.realpath()`, where they exist; the rest of the path is
+    kept as is.  Every directory is only looked up once.
+    """
+    resolved = {}
+
+    def resolve(path):
+        real = resolved.get(path)
+        if real is None:
+            parent, name = os.path.split(path)
+            if not name or parent == path:
+                real = path
+            else:
+                real = os.path.join(resolve(parent), name)
+                if os.path.islink(real):
+                    real = os.path.realpath(real)
+            resolved[path] = real
+        return real
+
+    return resolve
+
+
+def split_subtrees(entries):
+    """
+    Split a sequence of `(path,list_of_actions)` entries into groups
+    that do not depend on each other.  Return a `list` of groups,
+    each a `list` of entries in their original order.
+
+    An entry depends on every earlier entry for the same path or for
+    one of its parent paths.  A glob depends on everything below its
+    literal leading directory, since it may match any of it.  Paths are
+    compared once the symbolic links that already exist in them are
+    resolved (e.g. `/var/run` -> `/run`), so that entries that reach
+    the same directory through different paths are in the same group.
+
+    """
+    resolve = _resolver()
+    anchors = [resolve(_glob_anchor(path)) for path, _actions in entries]
+    globs = {i for i, (path, _actions) in enumerate(entries) if GLOB_MAGIC.search(path)}
+    parents = list(range(len(entries)))  # union-find forest
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def union(i, j):
+        parents[find(i)] = find(j)
+
+    owners = {}  # resolved literal path (or glob anchor) -> entry index
+    # parents before children, whatever the links made of the paths
+    for i in sorted(range(len(entries)), key=anchors.__getitem__):
+        anchor = anchors[i]
+        if i in globs:
+            for other, j in owners.items():
+                if _is_under(other, anchor):
+                    union(i, j)
+        p = anchor
+        while True:
+            j = owners.get(p)
+            if j is not None:
+                union(i, j)
+                break
+            parent = os.path.dirname(p)
+            if parent == p:
+                break
+            p = parent
+        owners.setdefault(anchor, i)
+
+    groups = collections.OrderedDict()
+    for i, entry in enumerate(entries):
+        groups.setdefault(find(i), []).append(entry)
+    return list(groups.values())
+
+
+def apply_parallel(entries, apply_entry, jobs):
+    """
+    Apply `(path,list_of_actions)` entries using up to `jobs` threads.
+
+    Independent subtrees (see `split_subtrees()`) are applied
+    concurrently; the entries of a subtree are applied one after the
+    other, in their original order.  Subtrees that create symlinks act
+    as barriers and are applied on their own, because a symlink can
+    make two seemingly unrelated paths refer to the same directory.
+
+    """
+
+    def creates_symlink(group):
+        return any(
+            isinstance(action, SymlinkCreate)
+            for _path, actions in group
+            for action in actions
+        )
+
+    def apply_group(group):
+        for path, actions in group:
+            apply_entry(path, actions)
+
+    def wait(futures):
+        for future in futures:
+            future.result()  # re-raise the first failure, if any
+        futures.clear()
+
+    import concurrent.futures
+
+    futures = []
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for group in split_subtrees(entries):
+            if creates_symlink(group):
+                wait(futures)
+                apply_group(group)
+            else:
+                futures.append(pool.submit(apply_group, group))
+        wait(futures)
+    finally:
+        shutdown_pool(pool)
+
+
+# inotify(7) event bits (see sys/inotify.h)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal inotify(7) binding, through `ctypes`."""
+
+    def __init__(self):
+        import ctypes
+
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        flags = os.O_CLOEXEC | os.O_NONBLOCK
+        self.fd = self._check(self._libc.inotify_init1(flags))
+        # written to by `wake()`, to interrupt `read()`
+        self._wake_read, self._wake_write = os.pipe2(flags)
+
+    def _check(self, result):
+        if result < 0:
+            e = self._ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return result
+
+    def add_watch(self, path, mask):
+        """Watch directory `path`.  Return the watch descriptor."""
+        return self._check(
+            self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        )
+
+    def rm_watch(self, wd):
+        """Stop watching the directory of `wd`."""
+        self._check(self._libc.inotify_rm_watch(self.fd, wd))
+
+    def wake(self):
+        """Make a pending or the next `read()` return at once."""
+        os.write(self._wake_write, b"\0")
+
+    def close(self):
+        for fd in (self.fd, self._wake_read, self._wake_write):
+            os.close(fd)
+
+    def read(self, timeout=None):
+        """
+        Wait up to `timeout` seconds (forever if None) for events.
+        Return a `list` of `(wd, mask, name)` tuples, empty on timeout
+        or after `wake()`.
+        """
+        poll = select.poll()
+        poll.register(self.fd, select.POLLIN)
+        poll.register(self._wake_read, select.POLLIN)
+        ready = dict(poll.poll(None if timeout is None else timeout * 1000))
+        if self._wake_read in ready:
+            os.read(self._wake_read, 4096)
+            return []
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+
+class PlanWatcher:
+    """
+    Keep a plan converged (`--watch`).
+
+    The parent directories of the plan's paths are watched with
+    inotify.  When a path is removed, its entry, and the entries below
+    it, are applied again.  When its attributes change, only the
+    ownership and mode set explicitly by its lines are restored, and
+    only if they differ, so that our own `chmod()`s do not trigger
+    another round.  Events are collected until none arrived for
+    `WATCH_DEBOUNCE` seconds.
+
+    Globs are only watched when their last component is the only one
+    with wildcards, and only for attribute changes.
+
+    If `replan` is given, the config directories (`TMPFILES_DIRS`) are
+    watched as well: when a config is added, changed or removed, the
+    plan returned by `replan()` replaces the current one, and is
+    applied as a whole.
+
+    """
+
+    MASK = (
+        IN_ATTRIB
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+        | IN_ONLYDIR
+    )
+
+    # also notice configs written in place
+    CONFIG_MASK = MASK | IN_CLOSE_WRITE
+
+    def __init__(self, entries, replan=None):
+        self.inotify = Inotify()
+        self.replan = replan
+        self.config_directories = set(TMPFILES_DIRS) if replan else set()
+        self.replan_pending = False
+        self.stopped = False
+        self.watches = {}
+        # (index, path) -> whether the path was removed
+        self.dirty = {}
+        self._index(entries)
+
+    def _index(self, entries):
+        self.entries = entries
+        # (directory, name) -> indexes of literal entries
+        self.literal = collections.defaultdict(list)
+        # directory -> (pattern, index) of glob entries
+        self.globs = collections.defaultdict(list)
+        for index, (path, _actions) in enumerate(entries):
+            directory, name = os.path.split(os.path.normpath(path))
+            if GLOB_MAGIC.search(directory):
+                continue
+            if GLOB_MAGIC.search(name):
+                self.globs[directory].append((name, index))
+            else:
+                self.literal[directory, name].append(index)
+        self.directories = {d for d, _name in self.literal} | set(self.globs)
+
+    def _watch(self, directory, mask):
+        while True:
+            try:
+                wd = self.inotify.add_watch(directory, mask)
+            except (FileNotFoundError, NotADirectoryError):
+                if directory == "/":
+                    return
+                directory = os.path.dirname(directory)
+                continue
+            except OSError as e:
+                report_failure(f"watch {directory}", e)
+                return
+            self.watches[wd] = directory
+            return
+
+    def arm(self):
+        """Watch every directory of the plan (and the config
+        directories), or its nearest existing parent, to notice when
+        the directory is created."""
+        for directory in self.directories:
+            self._watch(directory, self.MASK)
+        # last, as the config mask is a superset of the plan one
+        for directory in self.config_directories:
+            self._watch(directory, self.CONFIG_MASK)
+
+    def _removed(self, path, include_self=True):
+        """Mark the literal entries below (and at) `path` as removed."""
+        for index, (entry_path, _actions) in enumerate(self.entries):
+            if (
+                _is_under(entry_path, path)
+                and (include_self or entry_path != path)
+                and not GLOB_MAGIC.search(entry_path)
+            ):
+                self.dirty[index, entry_path] = True
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            LOG.warning("inotify queue overflow, applying all entries")
+            for index, (path, _actions) in enumerate(self.entries):
+                self.dirty[index, path] = True
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        directory = self.watches.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        if directory in self.config_directories and name.endswith(".conf"):
+            self.replan_pending = True
+        elif (
+            mask & (IN_CREATE | IN_MOVED_TO)
+            and mask & IN_ISDIR
+            and any(_is_under(d, path) for d in self.config_directories)
+        ):
+            self.replan_pending = True
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self._removed(path)
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+            if mask & IN_ISDIR and any(_is_under(d, path) for d in self.directories):
+                # a directory we need appeared: watch it (when
+                # converging), and apply what belongs below it
+                self._removed(path, include_self=False)
+        elif mask & IN_ATTRIB:
+            for index in self.literal.get((directory, name), ()):
+                self.dirty.setdefault((index, path), False)
+            for pattern, index in self.globs.get(directory, ()):
+                if fnmatch.fnmatchcase(name, pattern) and (
+                    pattern.startswith(".") or not name.startswith(".")
+                ):
+                    self.dirty.setdefault((index, path), False)
+
+    def _replan(self):
+        """Replace the plan by a new one from the configs, watch its
+        directories instead, and apply it."""
+        self.replan_pending = False
+        self.dirty = {}
+        LOG.info("configs changed, applying the new plan")
+        self._index(self.replan())
+        for wd in list(self.watches):
+            try:
+                self.inotify.rm_watch(wd)
+            except OSError:
+                pass  # the directory is gone
+        self.watches.clear()
+        # watched first, so that no removal is missed
+        self.arm()
+        GLOB_CACHE.clear()
+        invalidate_dir_fds()
+        apply_plan(self.entries, jobs=RECURSIVE_JOBS)
+
+    def converge(self):
+        """Re-apply the entries marked dirty, in plan order."""
+        if self.replan_pending:
+            self._replan()
+            return
+        dirty, self.dirty = self.dirty, {}
+        GLOB_CACHE.clear()
+        invalidate_dir_fds()
+        for (index, path), removed in sorted(dirty.items()):
+            entry_path, actions = self.entries[index]
+            if removed and not _lexists(path):
+                LOG.info(f"{entry_path} was removed, applying again", path=entry_path)
+                for action in actions:
+                    STATS.run(entry_path, action, action.apply)
+                continue
+            try:
+                st = lstat_at(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for action in actions:
+                if (action.mode, action.user, action.group) == (None, None, None):
+                    continue  # no explicit ownership or mode to restore
+                if action._metadata_changes(st) != (None, None, None):
+                    LOG.info(f"{path} attributes changed, restoring", path=path)
+                    restore = functools.partial(action._chown_and_chmod, st=st)
+                    STATS.run(path, action, restore)
+        self.arm()
+
+    def run(self):
+        """Watch until `stop()` is called."""
+        self.arm()
+        try:
+            while not self.stopped:
+                events = self.inotify.read()
+                while events:
+                    for event in events:
+                        self.handle(*event)
+                    events = self.inotify.read(WATCH_DEBOUNCE)
+                if self.dirty or self.replan_pending:
+                    self.converge()
+                    LOG.flush()
+        finally:
+            self.inotify.close()
+
+    def stop(self):
+        """Make `run()` return (from any thread)."""
+        self.stopped = True
+        self.inotify.wake()
+
+
+def remove_plan(entries, dry_run=False):
+    """Remove the paths of the plan's `D`, `r` and `R` entries
+    (`--remove`)."""
+    for path, actions in entries:
+        for action in actions:
+            remove = functools.partial(action.remove, dry_run=dry_run)
+            STATS.run(path, action, remove)
+
+
+def clean_plan(entries, dry_run=False):
+    """Clean up the directories of the plan's entries that have an age
+    (`--clean`), honouring its `x` and `X` lines."""
+    exclusions = Exclusions(entries)
+    for path, actions in entries:
+        for action in actions:
+            clean = functools.partial(
+                action.clean, exclusions=exclusions, dry_run=dry_run
+            )
+            STATS.run(path, action, clean)
+
+
+def verify_plan(entries):
+    """
+    Check the plan's entries against the file system, without
+    changing anything (`--verify`): log every entry whose path is
+    missing, or has the wrong type, ownership, mode, ACLs or symbolic
+    link target.  Each path is `lstat()`ed once.  Return the number of
+    entries that differ.
+
+    Recursive types only check the path itself, not what is below it.
+    When several lines set the ownership and mode of a path, the last
+    one applied (see `merge_entries()`) is checked.
+
+    """
+    return sum(verify_entry(pattern, actions) for pattern, actions in entries)
+
+
+def verify_entry(pattern, actions, report=True):
+    """Check one `(path,list_of_actions)` entry of the plan (see
+    `verify_plan()`).  Return the number of its lines whose paths
+    differ, logging the differences if `report` is true."""
+
+    def verify(path, action, st, metadata, acl):
+        try:
+            problems = action.verify(path, st, metadata, acl)
+        except OSError as e:
+            if report:
+                report_failure(f"verify {path}", e)
+            return True
+        if report:
+            for problem in problems:
+                LOG.warning(f"{path}: {problem}")
+        return bool(problems)
+
+    if GLOB_MAGIC.search(pattern):
+        paths = GLOB_CACHE.glob(pattern)
+    else:
+        paths = [pattern]
+    adjusting = [action for action in actions if action.adjusts_metadata]
+    last = adjusting[-1] if adjusting else None
+    acl = any(isinstance(action, ACLAction) for action in actions)
+    drifted = 0
+    for path in paths:
+        try:
+            st = lstat_at(path)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        for action in actions:
+            check = functools.partial(
+                verify,
+                action=action,
+                st=st,
+                metadata=action is last,
+                acl=acl,
+            )
+            drifted += STATS.run(path, action, check)
+    return drifted
+
+
+def plan_hash(entries):
+    """Return a hex digest that identifies the plan `entries` (and the
+    version of this script that applies them)."""
+    import hashlib
+
+    digest = hashlib.sha256(repr(file_fingerprint(__file__)).encode())
+    for path, actions in entries:
+        lines = [(action.line_type,) + action._identity()[1:] for action in actions]
+        digest.update(repr((path, lines)).encode())
+    return digest.hexdigest()
+
+
+class Journal:
+    """
+    Append-only record of the plan entries that were applied
+    (`--journal FILE`), so that a run that was interrupted (e.g. the
+    container was killed) resumes instead of starting over: the next
+    run of the same plan only verifies the recorded entries, like
+    `--verify` does, and applies those that differ.
+
+    The first line of the file is the `plan_hash()`, every further line
+    the JSON-encoded path of an entry applied without errors.  Records
+    are written in batches, at most `JOURNAL_WRITE_INTERVAL` seconds
+    apart and right after slow entries; a lost batch only means that
+    its entries are applied again.  The file is removed at the end of
+    the run.
+
+    """
+
+    def __init__(self, path, entries):
+        self.path = path
+        self.plan = plan_hash(entries)
+        self.done = set()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._written = time.monotonic()
+        self._fd = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                if f.readline().rstrip("\n") != self.plan:
+                    return
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            LOG.warning(f"ignoring journal {self.path!r}: {e}")
+            return
+        for line in data.splitlines():
+            try:
+                self.done.add(json.loads(line))
+            except ValueError:
+                continue  # torn by the interruption
+        if data and not data.endswith("\n"):
+            self._pending.append("\n")
+        if self.done:
+            LOG.info(
+                f"resuming from journal {self.path!r}: "
+                f"{len(self.done)} entries to verify",
+                resumed=len(self.done),
+            )
+
+    def record(self, path, seconds):
+        """Record that the entry of `path` was applied, which took
+        `seconds`."""
+        with self._lock:
+            self._pending.append(json.dumps(path) + "\n")
+            now = time.monotonic()
+            if (
+                seconds >= JOURNAL_SLOW_ENTRY
+                or now - self._written >= JOURNAL_WRITE_INTERVAL
+            ):
+                self._write()
+                self._written = now
+
+    def _write(self):
+        if self._fd is None:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC
+            if not self.done:
+                flags |= os.O_TRUNC
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._fd = os.open(self.path, flags, 0o600)
+            except OSError as e:
+                LOG.warning(f"failed to open journal {self.path!r}: {e}")
+                self._fd = -1
+            if not self.done:
+                self._pending.insert(0, self.plan + "\n")
+        data, self._pending = "".join(self._pending), []
+        if self._fd >= 0:
+            os.write(self._fd, data.encode())
+
+    def finish(self):
+        """The plan was applied completely: remove the journal."""
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)
+        self._fd = -1
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def apply_plan(entries, dry_run=False, jobs=1, journal=None):
+    """Create the plan's entries (`--create`), or describe what would
+    change with `dry_run`.  Entries recorded in `journal` (by an
+    interrupted run) are only applied if they differ."""
+
+    def apply_entry(path, actions):
+        if journal is not None:
+            if path in journal.done and not verify_entry(path, actions, False):
+                return
+            errors = LOG.counts["error"]
+            start = time.monotonic()
+        LOG.verbose(f">>> {path}", path=path)
+        for action in actions:
+            if dry_run:
+                changes = STATS.run(path, action, action.describe)
+                if not changes:
+                    LOG.verbose(f"{type(action).__name__}: no changes", path=path)
+                for change in changes or ():
+                    LOG.info(f"{type(action).__name__}: {change}", path=path)
+            else:
+                STATS.run(path, action, action.apply)
+        # with --jobs, errors of other entries may be counted as well;
+        # their entries are then just applied again
+        if journal is not None and LOG.counts["error"] == errors:
+            journal.record(path, time.monotonic() - start)
+
+    if jobs > 1 and not dry_run:
+        apply_parallel(entries, apply_entry, jobs)
+    else:
+        for path, actions in entries:
+            apply_entry(path, actions)
+
+
+def main():
+    global RECURSIVE_JOBS
+
+    parser = argparse.ArgumentParser(description="systemd-tmpfiles clone")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--create", action="store_true")
+    parser.add_argument("--remove", action="store_true")
+    parser.add_argument("--clean", action="store_true")
+    parser.add_argument(
+        "--boot",
+        action="store_true",
+        help="also apply the lines marked with '!', only safe at boot",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="only check the paths against the configs, and exit with "
+        "status 1 if any differs",
+    )
+    parser.add_argument(
+        "--prefix",
+        action="append",
+        help="only apply lines for paths below PREFIX",
+    )
+    parser.add_argument(
+        "--exclude-prefix",
+        action="append",
+        help="ignore lines for paths below EXCLUDE_PREFIX",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help="use (and refresh) a compiled plan cache",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="FILE",
+        help="record the entries applied in FILE, and if a run was "
+        "interrupted, only verify those it applied",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="only compile the configs into the plan cache (default: "
+        f"{PLAN_CACHE_FILE})",
+    )
+    parser.add_argument(
+        "--name-source",
+        choices=["nss", "files"],
+        default="nss",
+        help="resolve user and group names through NSS, or only from "
+        "/etc/passwd and /etc/group",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="apply independent subtrees using N threads",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="after --create, keep watching the paths and re-apply the "
+        "entries of paths that are removed or whose mode or owner changes",
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="only log errors",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="also log every path applied",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=["text", "json"],
+        default="text",
+        help="log plain text lines, or one JSON object per line",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print a JSON summary of timings, system calls and errors",
+    )
+    parser.add_argument(
+        "--trace-json",
+        metavar="FILE",
+        help="write one JSON event per config and applied line to FILE "
+        "('-' for stdout)",
+    )
+    args = parser.parse_args()
+    if args.quiet:
+        LOG.level = Log.QUIET
+    elif args.verbose:
+        LOG.level = Log.VERBOSE
+    LOG.json = args.log_format == "json"
+    atexit.register(LOG.flush)
+    NAME_RESOLVER.source = args.name_source
+    RECURSIVE_JOBS = args.jobs
+    STATS.enabled = args.stats or args.trace_json is not None
+    if args.trace_json == "-":
+        STATS.trace = sys.stdout
+    elif args.trace_json:
+        STATS.trace = open(args.trace_json, "w", buffering=1)
+
+    if args.compile:
+        compile_plan(list_tmpfiles_configs(), args.cache or PLAN_CACHE_FILE)
+        return
+
+    if args.verify and any([args.create, args.remove, args.clean]):
+        sys.exit("--verify cannot be combined with --create, --remove, --clean")
+    if not any([args.create, args.remove, args.clean, args.verify]):
+        sys.exit(
+            "Must specify one or more of --create, --remove, --clean, "
+            "or --verify"
+        )
+    if args.watch and (not args.create or args.dry_run):
+        sys.exit("--watch requires --create and cannot be used with --dry-run")
+
+    start = time.perf_counter()
+    entries = read_tmpfiles_configs(
+        list_tmpfiles_configs(),
+        PathFilter(args.prefix, args.exclude_prefix),
+        args.cache,
+        args.boot,
+    )
+    STATS.add_phase("plan", time.perf_counter() - start)
+
+    if args.verify:
+        start = time.perf_counter()
+        drifted = verify_plan(entries)
+        STATS.add_phase("verify", time.perf_counter() - start)
+        LOG.info(
+            f"{drifted} entries differ, {LOG.counts['error']} errors",
+            drifted=drifted,
+            errors=LOG.counts["error"],
+        )
+        LOG.flush()
+        if args.stats:
+            print(json.dumps(STATS.summary(), indent=2, sort_keys=True))
+        sys.exit(1 if drifted else 0)
+
+    if args.remove:
+        start = time.perf_counter()
+        remove_plan(entries, args.dry_run)
+        STATS.add_phase("remove", time.perf_counter() - start)
+
+    if args.clean:
+        # clean up before creating, so that nothing just created (or
+        # adjusted) is removed
+        start = time.perf_counter()
+        clean_plan(entries, args.dry_run)
+        STATS.add_phase("clean", time.perf_counter() - start)
+
+    if args.create:
+        start = time.perf_counter()
+        journal = None
+        if args.journal and not args.dry_run:
+            journal = Journal(args.journal, entries)
+        apply_plan(entries, args.dry_run, args.jobs, journal)
+        if journal is not None:
+            journal.finish()
+        STATS.add_phase("apply", time.perf_counter() - start)
+
+    summary = {"errors": LOG.counts["error"], "warnings": LOG.counts["warning"]}
+    if args.create and not args.dry_run:
+        summary = dict(changed=CHANGES.changed, unchanged=CHANGES.unchanged, **summary)
+    LOG.info(", ".join(f"{n} {key}" for key, n in summary.items()), **summary)
+    LOG.flush()
+    if args.stats:
+        print(json.dumps(STATS.summary(), indent=2, sort_keys=True))
+    if args.watch:
+        sys.stdout.flush()
+
+        def replan():
+            return read_tmpfiles_configs(
+                list_tmpfiles_configs(),
+                PathFilter(args.prefix, args.exclude_prefix),
+                args.cache,
+                args.boot,
+            )
+
+        try:
+            PlanWatcher(entries, replan).run()
+        except KeyboardInterrupt:
+            pass
+
+
+def _parse_mode(s):
+    if s is None:
+        return None
+
+    mask = False
+    if s.startswith("~"):
+        mask = True
+        s = s[1:]
+
+    return (mask, int(s, base=8))
+
+
+def _parse_user(s):
+    if s is None:
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        return NAME_RESOLVER.lookup("user", s)
+
+
+def _parse_group(s):
+    if s is None:
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        return NAME_RESOLVER.lookup("group", s)
+
+
+def _parse_attrs(s):
+    if not s:  # None or empty string
+        raise ValueError("file attributes cannot be empty")
+    if s[0] not in "+-=":
+        s = "+" + s  # default operation is '+'
+
+    # TODO more complete checks?  For now just take it as-is.
+    return s
+
+
+def _parse_acls(s):
+    if not s:  # None or empty string
+        raise ValueError("file ACLs cannot be empty")
+
+    # TODO more checks?
+    return s
+
+
+def _parse_major_minor(s):
+    if s is None:
+        raise ValueError("major:minor cannot be empty")
+
+    parts = s.split(":")
+    if len(parts) != 2:
+        raise ValueError("major:minor must have 2 parts")
+
+    try:
+        major = int(parts[0])
+        minor = int(parts[1])
+    except ValueError:
+        raise ValueError("major:minor must be integers")
+
+    return (major, minor)
+
+
+# Parsed age field.  `file_stamps` and `dir_stamps` are the stat
+# timestamps ("a", "c", "m") that must all be older than the age for
+# a file or directory to be cleaned up.  With `keep_first_level`
+# ("~" prefix), entries directly inside the directory are kept.
+Age = collections.namedtuple(
+    "Age", ["nanoseconds", "keep_first_level", "file_stamps", "dir_stamps"]
+)
+
+# time span units, as understood by systemd (see systemd.time(7))
+AGE_UNITS = {
+    "": 10**9,
+    "ns": 1,
+    "nsec": 1,
+    "us": 10**3,
+    "usec": 10**3,
+    "μs": 10**3,
+    "ms": 10**6,
+    "msec": 10**6,
+    "s": 10**9,
+    "sec": 10**9,
+    "second": 10**9,
+    "seconds": 10**9,
+    "m": 60 * 10**9,
+    "min": 60 * 10**9,
+    "minute": 60 * 10**9,
+    "minutes": 60 * 10**9,
+    "h": 3600 * 10**9,
+    "hr": 3600 * 10**9,
+    "hour": 3600 * 10**9,
+    "hours": 3600 * 10**9,
+    "d": 86400 * 10**9,
+    "day": 86400 * 10**9,
+    "days": 86400 * 10**9,
+    "w": 7 * 86400 * 10**9,
+    "week": 7 * 86400 * 10**9,
+    "weeks": 7 * 86400 * 10**9,
+    "M": 2629800 * 10**9,
+    "month": 2629800 * 10**9,
+    "months": 2629800 * 10**9,
+    "y": 31557600 * 10**9,
+    "year": 31557600 * 10**9,
+    "years": 31557600 * 10**9,
+}
+AGE_SPAN = re.compile(r"\s*(\d+(?:\.\d*)?)\s*([^\d\s.]*)")
+
+
+def _parse_age(s):
+    """
+    Parse the age field, e.g. "10d", "~1h 30min" or "cM:1w".  The
+    birth time ("b", "B") is not available from `stat()` and is
+    ignored.  Return None for no age (no cleanup).
+    """
+    if s is None:
+        return None
+
+    file_stamps, dir_stamps = "acm", "am"  # systemd's defaults
+    if ":" in s:
+        letters, s = s.split(":", 1)
+        if not letters or set(letters) - set("abcmABCM"):
+            raise ValueError(f"invalid age timestamp selector {letters!r}")
+        file_stamps = "".join(sorted(set(letters) & set("acm"))) or file_stamps
+        dir_stamps = (
+            "".join(sorted(set(letters) & set("ACM"))).lower() or dir_stamps
+        )
+
+    keep_first_level = s.startswith("~")
+    if keep_first_level:
+        s = s[1:]
+
+    nanoseconds = 0
+    pos = 0
+    while pos < len(s.rstrip()):
+        mo = AGE_SPAN.match(s, pos)
+        if mo is None or mo.group(2) not in AGE_UNITS:
+            raise ValueError(f"invalid age {s!r}")
+        nanoseconds += int(float(mo.group(1)) * AGE_UNITS[mo.group(2)])
+        pos = mo.end()
+    if pos == 0:
+        raise ValueError("age cannot be empty")
+
+    return Age(nanoseconds, keep_first_level, file_stamps, dir_stamps)
+
+
+def report_failure(message, cause=None):
+    """Log a "failed to ..." message (and the exception that caused
+    it) and count it as an error of the current action."""
+    LOG.error(f"failed to {message}", cause)
+    STATS.count("errors")
+
+
+def _run_process(desc, args):
+    STATS.count("forks")
+    try:
+        subprocess.check_call(args)
+    except FileNotFoundError:
+        if len(args) < 1:
+            prog = "<undefined>"
+        else:
+            prog = args[0]
+        report_failure(f"{desc}: {prog!r} program not found")
+    except subprocess.CalledProcessError as e:
+        report_failure(desc, e)
+
+
+def _walk_physical(path):
+    """
+    Yield `(path, stat_result)` for `path` and, if it is a directory,
+    everything below it.  Symbolic links (including `path` itself) are
+    reported but never followed.  Entries are streamed, reusing the
+    `os.DirEntry` stat results, without building per-directory lists.
+
+    Entries removed during the walk are skipped.  Directories that
+    cannot be read, and entries that cannot be `lstat()`ed, are
+    reported and skipped, so that the rest of the tree is still walked.
+    """
+    st = lstat_at(path)
+    yield path, st
+    if not stat.S_ISDIR(st.st_mode):
+        return
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        STATS.count("open")
+        try:
+            it = os.scandir(directory)
+        except FileNotFoundError:
+            continue  # removed during the walk
+        except OSError as e:
+            report_failure(f"read {directory!r}", e)
+            continue
+        with it:
+            for entry in it:
+                STATS.count("stat")
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    report_failure(f"stat {entry.path!r}", e)
+                    continue
+                yield entry.path, st
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(entry.path)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def apply_recursive(path, function, jobs=1):
+    """
+    Call `function(node, stat_result)` for `path` and everything below
+    it (see `_walk_physical()`).
+
+    With `jobs` > 1, entries are handed to a pool of `jobs` threads in
+    batches of `WALK_BATCH_SIZE`, while the walk goes on.  At most
+    `2 * jobs` batches are in flight, so memory use stays bounded on
+    very large trees.
+    """
+    nodes = _walk_physical(path)
+    if jobs <= 1:
+        for node, st in nodes:
+            function(node, st)
+        return
+
+    import concurrent.futures
+
+    @STATS.bind
+    def apply_batch(batch):
+        for node, st in batch:
+            function(node, st)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        pending = collections.deque()
+        for batch in _batches(nodes, WALK_BATCH_SIZE):
+            pending.append(pool.submit(apply_batch, batch))
+            if len(pending) >= 2 * jobs:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+    finally:
+        shutdown_pool(pool)
+
+
+# errors meaning that the native backends cannot be used for a path
+NATIVE_UNSUPPORTED = (errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS)
+
+# POSIX ACLs, as stored in the system.posix_acl_* extended attributes
+# (see linux/posix_acl_xattr.h)
+ACL_XATTR_ACCESS = "system.posix_acl_access"
+ACL_XATTR_DEFAULT = "system.posix_acl_default"
+ACL_XATTR_VERSION = 2
+ACL_UNDEFINED_ID = 0xFFFFFFFF
+ACL_USER_OBJ = 0x01
+ACL_USER = 0x02
+ACL_GROUP_OBJ = 0x04
+ACL_GROUP = 0x08
+ACL_MASK = 0x10
+ACL_OTHER = 0x20
+ACL_TAGS = {
+    "u": ACL_USER,
+    "user": ACL_USER,
+    "g": ACL_GROUP,
+    "group": ACL_GROUP,
+    "m": ACL_MASK,
+    "mask": ACL_MASK,
+    "o": ACL_OTHER,
+    "other": ACL_OTHER,
+}
+
+
+def _parse_acl_perms(s):
+    if len(s) == 1 and s in "01234567":
+        return int(s)
+    perms = 0
+    for c in s:
+        if c not in "rwx-":
+            raise ValueError(f"unsupported ACL permissions {s!r}")
+        perms |= {"r": 4, "w": 2, "x": 1, "-": 0}[c]
+    return perms
+
+
+def _parse_acl_spec(spec):
+    """
+    Parse a `setfacl --modify` style ACL specification.  Return a
+    `list` of `(default, tag, id, perms)` tuples.  Raise ValueError
+    for anything the native backend does not support.
+    """
+    entries = []
+    for item in re.split(r"[,\s]+", spec.strip()):
+        if not item:
+            continue
+        parts = item.split(":")
+        default = parts[0] in ("d", "default")
+        if default:
+            parts = parts[1:]
+        if len(parts) == 2 and parts[0] in ("m", "mask", "o", "other"):
+            parts.insert(1, "")
+        if len(parts) != 3 or parts[0] not in ACL_TAGS:
+            raise ValueError(f"unsupported ACL entry {item!r}")
+        tag, qualifier, perms = ACL_TAGS[parts[0]], parts[1], parts[2]
+        if not qualifier:
+            tag = {ACL_USER: ACL_USER_OBJ, ACL_GROUP: ACL_GROUP_OBJ}.get(
+                tag, tag
+            )
+            id_ = ACL_UNDEFINED_ID
+        elif tag == ACL_USER:
+            id_ = _parse_user(qualifier)
+        elif tag == ACL_GROUP:
+            id_ = _parse_group(qualifier)
+        else:
+            raise ValueError(f"unsupported ACL entry {item!r}")
+        entries.append((default, tag, id_, _parse_acl_perms(perms)))
+    return entries
+
+
+def _acl_decode(data):
+    """Decode an ACL xattr into a `dict` of `(tag, id) -> perms`."""
+    (version,) = struct.unpack_from("<I", data)
+    if version != ACL_XATTR_VERSION:
+        raise ValueError(f"unsupported ACL xattr version {version}")
+    return {
+        (tag, id_): perms
+        for tag, perms, id_ in struct.iter_unpack("<HHI", data[4:])
+    }
+
+
+def _acl_encode(acl):
+    data = [struct.pack("<I", ACL_XATTR_VERSION)]
+    for (tag, id_), perms in sorted(acl.items()):
+        data.append(struct.pack("<HHI", tag, perms, id_))
+    return b"".join(data)
+
+
+def _acl_from_mode(mode):
+    return {
+        (ACL_USER_OBJ, ACL_UNDEFINED_ID): (mode >> 6) & 7,
+        (ACL_GROUP_OBJ, ACL_UNDEFINED_ID): (mode >> 3) & 7,
+        (ACL_OTHER, ACL_UNDEFINED_ID): mode & 7,
+    }
+
+
+def _acl_read(path, name, follow_symlinks):
+    try:
+        return _acl_decode(
+            os.getxattr(path, name, follow_symlinks=follow_symlinks)
+        )
+    except OSError as e:
+        if e.errno != errno.ENODATA:
+            raise
+        return None
+
+
+def _acl_base(acl):
+    """Return only the owner/group/other entries of `acl`."""
+    return {
+        k: v
+        for k, v in acl.items()
+        if k[0] in (ACL_USER_OBJ, ACL_GROUP_OBJ, ACL_OTHER)
+    }
+
+
+def _acl_update_mask(acl, explicit_mask):
+    """Recalculate the mask entry like `setfacl` does."""
+    named = [v for (tag, _), v in acl.items() if tag in (ACL_USER, ACL_GROUP)]
+    mask_key = (ACL_MASK, ACL_UNDEFINED_ID)
+    if explicit_mask or not (named or mask_key in acl):
+        return
+    group_obj = acl.get((ACL_GROUP_OBJ, ACL_UNDEFINED_ID), 0)
+    acl[mask_key] = group_obj
+    for perms in named:
+        acl[mask_key] |= perms
+
+
+def _acl_current(path, st, follow_symlinks, with_default=True):
+    """Return the `(access, default)` ACLs of `path`, whose `stat()`
+    result is `st`."""
+    access = _acl_read(path, ACL_XATTR_ACCESS, follow_symlinks)
+    if access is None:
+        access = _acl_from_mode(st.st_mode)
+    default = {}
+    if with_default and stat.S_ISDIR(st.st_mode):
+        default = _acl_read(path, ACL_XATTR_DEFAULT, follow_symlinks) or {}
+    return access, default
+
+
+def _acl_merge(st, access, default, entries, clear):
+    """Return the `(access, default)` ACLs that result from applying
+    the parsed ACL spec `entries` to the `access` and `default` ones,
+    like `setfacl --modify` (after `--remove-all`, if `clear`)."""
+    is_dir = stat.S_ISDIR(st.st_mode)
+    if clear:
+        access, default = _acl_base(access), {}
+    else:
+        access, default = dict(access), dict(default)
+
+    for is_default, tag, id_, perms in entries:
+        if is_default:
+            if not is_dir:
+                continue
+            if not default:
+                default = _acl_base(access)
+            default[(tag, id_)] = perms
+        else:
+            access[(tag, id_)] = perms
+    explicit_access_mask = any(
+        tag == ACL_MASK and not d for d, tag, _, _ in entries
+    )
+    explicit_default_mask = any(
+        tag == ACL_MASK and d for d, tag, _, _ in entries
+    )
+    _acl_update_mask(access, explicit_access_mask)
+    _acl_update_mask(default, explicit_default_mask)
+    return access, default
+
+
+def _native_set_acls_one(path, st, entries, clear, follow_symlinks):
+    access, default = _acl_merge(
+        st,
+        *_acl_current(path, st, follow_symlinks, with_default=not clear),
+        entries,
+        clear,
+    )
+    os.setxattr(
+        path,
+        ACL_XATTR_ACCESS,
+        _acl_encode(access),
+        follow_symlinks=follow_symlinks,
+    )
+    if default:
+        os.setxattr(
+            path,
+            ACL_XATTR_DEFAULT,
+            _acl_encode(default),
+            follow_symlinks=follow_symlinks,
+        )
+    elif stat.S_ISDIR(st.st_mode):
+        try:
+            os.removexattr(
+                path, ACL_XATTR_DEFAULT, follow_symlinks=follow_symlinks
+            )
+        except OSError as e:
+            if e.errno != errno.ENODATA:
+                raise
+
+
+def native_set_acls(path, spec, clear, recursive):
+    """
+    Set POSIX ACLs by writing the `system.posix_acl_*` extended
+    attributes directly, instead of forking `setfacl`.
+
+    If `clear` is true, all extended ACL entries and the default ACL
+    are removed first (`setfacl --remove-all`).  If `recursive` is
+    true, everything below `path` is processed as well, without
+    following symbolic links (`setfacl --recursive --physical`).
+
+    Return False if the native backend cannot handle the ACL spec or
+    the file system, in which case the caller should fall back to
+    `setfacl`.
+    """
+    try:
+        entries = _parse_acl_spec(spec)
+    except (ValueError, KeyError):
+        return False
+    try:
+        if recursive:
+            nodes = _walk_physical(path)
+        else:
+            STATS.count("stat")
+            nodes = [(path, os.stat(path))]
+        for node, st in nodes:
+            if recursive and stat.S_ISLNK(st.st_mode):
+                continue
+            try:
+                _native_set_acls_one(
+                    node, st, entries, clear, follow_symlinks=not recursive
+                )
+            except OSError as e:
+                if e.errno in NATIVE_UNSUPPORTED and node == path:
+                    return False
+                report_failure(f"set ACLs of {node}", e)
+    except OSError as e:
+        report_failure(f"set ACLs of {path}", e)
+    return True
+
+
+def _acl_format(acl):
+    """Format an ACL `dict` in the short text form of `getfacl -c`."""
+    names = {
+        ACL_USER_OBJ: "u",
+        ACL_USER: "u",
+        ACL_GROUP_OBJ: "g",
+        ACL_GROUP: "g",
+        ACL_MASK: "m",
+        ACL_OTHER: "o",
+    }
+    return ",".join(
+        "{}:{}:{}".format(
+            names.get(tag, tag),
+            "" if id_ == ACL_UNDEFINED_ID else id_,
+            "".join(c if perms & bit else "-" for c, bit in zip("rwx", (4, 2, 1))),
+        )
+        for (tag, id_), perms in sorted(acl.items())
+    )
+
+
+def verify_acls(path, st, spec, clear):
+    """
+    Return a `list` of the differences between the POSIX ACLs of
+    `path` (whose `lstat()` result is `st`) and the ACLs that
+    `native_set_acls()` would set.  Symbolic links, and ACL specs or
+    file systems the native backend does not support, are not checked.
+    """
+    if stat.S_ISLNK(st.st_mode):
+        return []
+    try:
+        entries = _parse_acl_spec(spec)
+    except (ValueError, KeyError):
+        return []
+    try:
+        access, default = _acl_current(path, st, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in NATIVE_UNSUPPORTED:
+            return []
+        raise
+    want_access, want_default = _acl_merge(st, access, default, entries, clear)
+    changes = []
+    if want_access != access:
+        changes.append(f"ACL {_acl_format(access)} -> {_acl_format(want_access)}")
+    if want_default != default:
+        changes.append(
+            f"default ACL {_acl_format(default) or 'none'} -> "
+            f"{_acl_format(want_default) or 'none'}"
+        )
+    return changes
+
+
+# inode flags, as set by chattr(1) (see linux/fs.h)
+FS_IOC_GETFLAGS = (2 << 30) | (struct.calcsize("l") << 16) | (ord("f") << 8) | 1
+FS_IOC_SETFLAGS = (1 << 30) | (struct.calcsize("l") << 16) | (ord("f") << 8) | 2
+FS_ATTR_FLAGS = {
+    "a": 0x00000020,  # append only
+    "A": 0x00000080,  # no atime updates
+    "c": 0x00000004,  # compressed
+    "C": 0x00800000,  # no copy on write
+    "d": 0x00000040,  # no dump
+    "D": 0x00010000,  # synchronous directory updates
+    "e": 0x00080000,  # extents
+    "F": 0x40000000,  # casefold
+    "i": 0x00000010,  # immutable
+    "j": 0x00004000,  # data journalling
+    "P": 0x20000000,  # project hierarchy
+    "s": 0x00000001,  # secure deletion
+    "S": 0x00000008,  # synchronous updates
+    "t": 0x00008000,  # no tail-merging
+    "T": 0x00020000,  # top of directory hierarchy
+    "u": 0x00000002,  # undeletable
+    "x": 0x02000000,  # direct access
+}
+
+
+def _parse_attr_flags(s):
+    """Return `(value, mask)` for an attribute spec like `+ai`."""
+    op, letters = s[0], s[1:]
+    value = 0
+    for c in letters:
+        try:
+            value |= FS_ATTR_FLAGS[c]
+        except KeyError:
+            raise ValueError(f"unsupported file attribute {c!r}")
+    if op == "=":
+        mask = 0
+        for flag in FS_ATTR_FLAGS.values():
+            mask |= flag
+    else:
+        mask = value
+    if op == "-":
+        value = 0
+    return value, mask
+
+
+def _native_set_attrs_one(path, value, mask):
+    STATS.count("open")
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOFOLLOW | os.O_CLOEXEC)
+    try:
+        buf = bytearray(struct.calcsize("l"))
+        fcntl.ioctl(fd, FS_IOC_GETFLAGS, buf)
+        (flags,) = struct.unpack_from("i", buf)
+        new_flags = (flags & ~mask) | value
+        if new_flags != flags:
+            struct.pack_into("i", buf, 0, new_flags)
+            fcntl.ioctl(fd, FS_IOC_SETFLAGS, buf)
+    finally:
+        os.close(fd)
+
+
+def native_set_attrs(path, spec, recursive):
+    """
+    Set inode flags with the FS_IOC_SETFLAGS ioctl, instead of forking
+    `chattr`.  Only regular files and directories are changed.
+
+    Return False if the native backend cannot handle the attribute
+    spec or the file system, in which case the caller should fall back
+    to `chattr`.
+    """
+    try:
+        value, mask = _parse_attr_flags(spec)
+    except ValueError:
+        return False
+    try:
+        if recursive:
+            nodes = _walk_physical(path)
+        else:
+            STATS.count("stat")
+            nodes = [(path, os.stat(path))]
+        for node, st in nodes:
+            if not (stat.S_ISREG(st.st_mode) or stat.S_ISDIR(st.st_mode)):
+                continue
+            try:
+                _native_set_attrs_one(node, value, mask)
+            except OSError as e:
+                if e.errno in NATIVE_UNSUPPORTED and node == path:
+                    return False
+                report_failure(f"change attributes of {node}", e)
+    except OSError as e:
+        report_failure(f"change attributes of {path}", e)
+    return True
+
+
+class DirFdCache:
+    """
+    LRU cache of open directory file descriptors, keyed by path.
+
+    A directory is opened relative to its (cached) parent, so that
+    operations on entries of deep trees only make the kernel resolve
+    the last path component.
+
+    """
+
+    def __init__(self, size=DIR_FD_CACHE_SIZE):
+        self.size = size
+        self.generation = _dir_fds_generation
+        self._fds = collections.OrderedDict()
+
+    def get(self, path):
+        """Return an open file descriptor for directory `path`."""
+        fd = self._fds.get(path)
+        if fd is not None:
+            self._fds.move_to_end(path)
+            return fd
+        flags = os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC
+        parent, name = os.path.split(path)
+        STATS.count("open")
+        if name and parent:
+            fd = os.open(name, flags, dir_fd=self.get(parent))
+        else:
+            fd = os.open(path, flags)
+        self._fds[path] = fd
+        if len(self._fds) > self.size:
+            _path, old_fd = self._fds.popitem(last=False)
+            os.close(old_fd)
+        return fd
+
+    def clear(self):
+        while self._fds:
+            _path, fd = self._fds.popitem()
+            os.close(fd)
+
+
+# Directory fds are cached per thread.  Whenever a directory may have
+# been removed or replaced, the generation is bumped and all caches
+# are dropped, so that no fd refers to a stale directory.  The caches
+# of the workers of a thread pool are closed when it is shut down (see
+# `shutdown_pool()`), as thread-local data outlives the thread.
+_dir_fds_local = threading.local()
+_dir_fds_generation = 0
+_dir_fds_threads = {}
+_dir_fds_lock = threading.Lock()
+
+
+def invalidate_dir_fds():
+    """Drop all cached directory fds (in every thread)."""
+    global _dir_fds_generation
+    _dir_fds_generation += 1
+
+
+def _dir_fds():
+    cache = getattr(_dir_fds_local, "cache", None)
+    if cache is None:
+        cache = _dir_fds_local.cache = DirFdCache()
+        with _dir_fds_lock:
+            _dir_fds_threads[threading.current_thread()] = cache
+    elif cache.generation != _dir_fds_generation:
+        cache.clear()
+        cache.generation = _dir_fds_generation
+    return cache
+
+
+def shutdown_pool(pool):
+    """Shut down the thread pool `pool`, waiting for its workers, and
+    close the directory fds they cached."""
+    pool.shutdown()
+    with _dir_fds_lock:
+        exited = [t for t in _dir_fds_threads if not t.is_alive()]
+        caches = [_dir_fds_threads.pop(t) for t in exited]
+    for cache in caches:
+        cache.clear()
+
+
+def _at(path):
+    """
+    Split `path` into a `(dir_fd, name)` pair for the `*at()` family
+    of system calls.  `dir_fd` is None for paths that have no parent.
+    """
+    path = path.rstrip("/") or "/"
+    parent, name = os.path.split(path)
+    if not name or not os.path.isabs(path):
+        return None, path
+    return _dir_fds().get(parent), name
+
+
+def lstat_at(path):
+    """`os.lstat()` through the cached file descriptor of the parent
+    directory of `path` (see `_at()`)."""
+    STATS.count("stat")
+    dir_fd, name = _at(path)
+    return os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+
+
+def _stat(path):
+    STATS.count("stat")
+    dir_fd, name = _at(path)
+    return os.stat(name, dir_fd=dir_fd)
+
+
+def _lexists(path):
+    try:
+        lstat_at(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    return True
+
+
+def _open(path, flags, mode=0o644):
+    """Open `path` relative to its parent directory.  Return a file
+    object."""
+    STATS.count("open")
+    dir_fd, name = _at(path)
+    fd = os.open(name, flags | os.O_CLOEXEC, mode, dir_fd=dir_fd)
+    if flags & os.O_CREAT:
+        GLOB_CACHE.invalidate(os.path.dirname(path))
+    return os.fdopen(fd, "r+" if flags & os.O_RDWR else "w")
+
+
+def _mkdir(path, mode=0o755):
+    """Create directory `path` (and missing parents).  Tolerate it
+    already existing (e.g. created concurrently)."""
+    STATS.count("mkdir")
+    try:
+        dir_fd, name = _at(path)
+        os.mkdir(name, mode, dir_fd=dir_fd)
+        GLOB_CACHE.invalidate(os.path.dirname(path))
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        os.makedirs(path, mode, exist_ok=True)
+        GLOB_CACHE.clear()
+
+
+def _chown_at(path, uid, gid):
+    STATS.count("chown")
+    dir_fd, name = _at(path)
+    os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+
+
+def _chmod_at(path, mode):
+    STATS.count("chmod")
+    dir_fd, name = _at(path)
+    try:
+        os.chmod(name, mode, dir_fd=dir_fd, follow_symlinks=False)
+    except (NotImplementedError, ValueError):
+        # fchmodat(AT_SYMLINK_NOFOLLOW) is not supported by every libc;
+        # callers never chmod symbolic links, so following is safe
+        os.chmod(name, mode, dir_fd=dir_fd)
+
+
+# share the extents of a file (reflink), see ioctl_ficlone(2)
+FICLONE = (1 << 30) | (struct.calcsize("i") << 16) | (0x94 << 8) | 9
+COPY_CHUNK_SIZE = 1 << 20
+
+# errors meaning that a data copy method cannot be used between two
+# file systems, and the next one should be tried
+COPY_UNSUPPORTED = (
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.ENOSYS,
+)
+
+# (method, source_dev, destination_dev) combinations known not to work
+_copy_unsupported = set()
 
 
-def read_tmpfiles_config(path, prefix):
+def _copy_data(src_fd, dst_fd, devices):
     """
-    Read the tmpfiles config.  Return a `list` of groups of
-    `(path,list_of_actions)` tuples, with paths in lexicographic
-    order.  Therefore, prefix/parent paths are always listed before
-    suffix/child paths.
+    Copy the contents of `src_fd` to `dst_fd`: share the extents
+    (FICLONE) if the file system supports it, else copy in the kernel
+    (`copy_file_range()`, `sendfile()`), else through a buffer.
+    Return the method used.
+    """
+    if ("clone", devices) not in _copy_unsupported:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return "clone"
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED:
+                raise
+            _copy_unsupported.add(("clone", devices))
+
+    for method, copy_chunk in (
+        ("copy_file_range", os.copy_file_range),
+        ("sendfile", lambda src, dst, n: os.sendfile(dst, src, None, n)),
+    ):
+        if (method, devices) in _copy_unsupported:
+            continue
+        copied = 0
+        try:
+            while True:
+                n = copy_chunk(src_fd, dst_fd, COPY_CHUNK_SIZE)
+                if n == 0:
+                    return method
+                copied += n
+        except OSError as e:
+            # only fall back if nothing has been copied yet
+            if e.errno not in COPY_UNSUPPORTED or copied:
+                raise
+            _copy_unsupported.add((method, devices))
+
+    while True:
+        data = os.read(src_fd, COPY_CHUNK_SIZE)
+        if not data:
+            return "read"
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view) :]
+
+
+# errors of setxattr() for attributes that are skipped when copying
+XATTR_IGNORED_ERRORS = (
+    errno.EPERM,
+    errno.EACCES,
+    errno.EINVAL,
+    errno.ENODATA,
+) + NATIVE_UNSUPPORTED
+
+
+def _copy_xattrs(src_fd, dst_fd):
+    """Copy the extended attributes of `src_fd`, ignoring those that
+    cannot be set (like `shutil.copystat()`)."""
+    try:
+        names = os.listxattr(src_fd)
+    except OSError as e:
+        if e.errno in NATIVE_UNSUPPORTED:
+            return
+        raise
+    for name in names:
+        try:
+            os.setxattr(dst_fd, name, os.getxattr(src_fd, name))
+        except OSError as e:
+            # e.g. security.selinux labels that the policy does not
+            # allow (EACCES) or does not know (EINVAL)
+            if e.errno not in XATTR_IGNORED_ERRORS:
+                raise
 
-    Ignore paths that do not match the given `prefix`.
 
+def _copy_owner(dst, st, fd=None):
+    """Give `dst` (or `fd`, if given) the owner described by `st`."""
+    try:
+        if fd is None:
+            _chown_at(dst, st.st_uid, st.st_gid)
+        else:
+            STATS.count("chown")
+            os.fchown(fd, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass  # not running as root, keep our own ownership
+
+
+def _copy_metadata(dst, st, fd=None, owner=True):
+    """Give `dst` (or `fd`, if given) the owner (unless `owner` is
+    false), mode and timestamps described by `st`."""
+    times = (st.st_atime_ns, st.st_mtime_ns)
+    if owner:
+        _copy_owner(dst, st, fd)
+    if fd is not None:
+        STATS.count("chmod")
+        os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        os.utime(fd, ns=times)
+        return
+    if not stat.S_ISLNK(st.st_mode):
+        _chmod_at(dst, stat.S_IMODE(st.st_mode))
+    dir_fd, name = _at(dst)
+    os.utime(name, ns=times, dir_fd=dir_fd, follow_symlinks=False)
+
+
+def copy_node(src, dst, st):
     """
-    with open(path) as f:
-        lines = f.readlines()
-    actions = (
-        parse_action(line.strip())
-        for line in lines
-        if len(line.strip()) > 0 and not line.startswith("#")
-    )
+    Copy the file `src`, whose `lstat()` result is `st`, to the new
+    path `dst`.  Directories are created empty.  Ownership, mode,
+    timestamps (except for directories, whose contents may still
+    change) and, for regular files, extended attributes are preserved.
+    """
+    dir_fd, name = _at(dst)
+    if stat.S_ISREG(st.st_mode):
+        STATS.count("open")
+        src_fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        try:
+            STATS.count("open")
+            dst_fd = os.open(
+                name,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC,
+                0o600,
+                dir_fd=dir_fd,
+            )
+            try:
+                _copy_data(src_fd, dst_fd, (st.st_dev, os.fstat(dst_fd).st_dev))
+                # the owner first, as changing it drops file
+                # capabilities; the mode even if an attribute fails,
+                # so that the copy is not left at 0600
+                _copy_owner(dst, st, fd=dst_fd)
+                try:
+                    _copy_xattrs(src_fd, dst_fd)
+                finally:
+                    _copy_metadata(dst, st, fd=dst_fd, owner=False)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        return
+    if stat.S_ISDIR(st.st_mode):
+        STATS.count("mkdir")
+        os.mkdir(name, 0o700, dir_fd=dir_fd)
+        return
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), name, dir_fd=dir_fd)
+    elif stat.S_IFMT(st.st_mode) in (stat.S_IFIFO, stat.S_IFCHR, stat.S_IFBLK):
+        os.mknod(name, st.st_mode, st.st_rdev, dir_fd=dir_fd)
+    else:
+        return  # sockets cannot be copied
+    _copy_metadata(dst, st)
+
+
+def copy_tree(src, dst, jobs=1):
+    """
+    Copy `src` to `dst` in a single `os.scandir()` walk (see
+    `_walk_physical()`), without following symbolic links.  If `dst`
+    is an existing empty directory, the contents of `src` are copied
+    into it.
+
+    Directories are created by the walk, so they exist before anything
+    is copied into them.  With `jobs` > 1, regular files are copied by
+    a pool of `jobs` threads, with at most `4 * jobs` copies in flight.
+    The metadata of directories is set last, deepest first.
 
-    # filter out paths that do not match prefix
-    prefix_Path = pathlib.Path(prefix)
+    Failures are reported per entry and do not stop the copy.
+    """
+    directories = []
+    GLOB_CACHE.invalidate(os.path.dirname(dst))
+    GLOB_CACHE.invalidate(dst)
 
-    def matches_prefix(s):
-        s_Path = pathlib.Path(s)
-        return prefix_Path in [s_Path, *s_Path.parents]
+    def copy_one(node, st):
+        try:
+            copy_node(node, dst + node[len(src) :], st)
+        except FileExistsError:
+            if node != src or not stat.S_ISDIR(st.st_mode):
+                raise
+        if stat.S_ISDIR(st.st_mode):
+            directories.append((dst + node[len(src) :], st))
+
+    def copy_checked(node, st):
+        try:
+            copy_one(node, st)
+        except OSError as e:
+            report_failure(f"copy {node!r}", e)
 
-    actions = (
-        (path, action) for path, action in actions if matches_prefix(path)
-    )
+    pool = None
+    if jobs > 1:
+        import concurrent.futures
 
-    # putting things in order.
-    #
-    # pass 1: sort all actions by path.
-    #         output is iterable of (path, action)
-    #
-    actions = sorted(actions, key=operator.itemgetter(0))
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        copy_file = STATS.bind(copy_checked)
+    pending = collections.deque()
+    try:
+        for node, st in _walk_physical(src):
+            if pool is None or not stat.S_ISREG(st.st_mode):
+                copy_checked(node, st)
+                continue
+            if len(pending) >= 4 * jobs:
+                pending.popleft().result()
+            pending.append(pool.submit(copy_file, node, st))
+        while pending:
+            pending.popleft().result()
+    finally:
+        if pool is not None:
+            shutdown_pool(pool)
+    for directory, st in reversed(directories):
+        try:
+            _copy_metadata(directory, st)
+        except OSError as e:
+            report_failure(f"copy metadata to {directory!r}", e)
 
-    # pass 2: group actions by path.
-    #         output is iterable of (path, [(path, action)])
-    actions = itertools.groupby(actions, key=operator.itemgetter(0))
 
-    # pass 2.1: discard redundant path, dissolve nested tuple.
-    #           output is iterable of (path, [action])
-    actions = ((k, map(operator.itemgetter(1), v)) for k, v in actions)
+class Exclusions:
+    """
+    The `x` (path and everything below it) and `X` (path only) lines
+    of a plan, for `--clean`.  Patterns are matched component by
+    component, like globs, and only against paths with as many
+    components.
 
-    # pass 3: sort actions for each path
-    ACTION_ORDER = list(ACTION_MAP.values())
+    """
 
-    def f(action):
-        return ACTION_ORDER.index(type(action))
+    def __init__(self, entries):
+        self._patterns = collections.defaultdict(list)
+        for path, actions in entries:
+            for action in actions:
+                if isinstance(action, (IgnoreRecursive, Ignore)):
+                    parts = os.path.normpath(path).split("/")
+                    self._patterns[len(parts)].append(
+                        (parts, isinstance(action, IgnoreRecursive))
+                    )
+
+    def match(self, path):
+        """Return "x" if `path` and its contents are excluded, "X" if
+        only `path` is, else None."""
+        candidates = self._patterns.get(path.count("/") + 1)
+        if not candidates:
+            return None
+        parts = path.split("/")
+        result = None
+        for pattern, recursive in candidates:
+            if all(
+                p == n or fnmatch.fnmatchcase(n, p) for p, n in zip(pattern, parts)
+            ):
+                if recursive:
+                    return "x"
+                result = "X"
+        return result
+
+    def covers(self, path):
+        """Whether `path` or one of its parents is excluded with `x`."""
+        parts = os.path.normpath(path).split("/")
+        return any(
+            self.match("/".join(parts[:n])) == "x" for n in range(2, len(parts) + 1)
+        )
 
-    actions = ((path, sorted(l, key=f)) for path, l in actions)
 
-    # finally, return a list (makes debugging easier)
-    return list(actions)
+# paths of bound AF_UNIX sockets, read once from /proc/net/unix
+_unix_sockets = None
 
 
-def parse_action(line):
+def _bound_unix_sockets():
+    global _unix_sockets
+    if _unix_sockets is None:
+        sockets = set()
+        try:
+            with open("/proc/net/unix") as f:
+                next(f, None)  # header
+                for line in f:
+                    fields = line.split(None, 7)
+                    if len(fields) == 8 and fields[7].startswith("/"):
+                        sockets.add(fields[7].rstrip("\n"))
+        except OSError:
+            pass
+        _unix_sockets = sockets
+    return _unix_sockets
+
+
+def _aged_out(st, stamps, cutoff):
+    """Whether all the timestamps `stamps` of `st` are older than
+    `cutoff` (in nanoseconds)."""
+    return all(getattr(st, f"st_{stamp}time_ns") < cutoff for stamp in stamps)
+
+
+def _unlink_batch(dir_fd, prefix, names):
+    """Unlink `names` relative to `dir_fd` (the directory `prefix`).
+    Return the number of entries removed."""
+    removed = 0
+    for name in names:
+        try:
+            os.unlink(name, dir_fd=dir_fd)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            report_failure(f"remove {prefix}{name}", e)
+    return removed
+
+
+class _OpenDir:
+    """A directory being walked by `clean_directory()` or
+    `remove_tree()`."""
+
+    def __init__(self, fd, path, name, st, depth, keep):
+        self.fd = fd
+        self.st = st
+        self.path = path
+        self.prefix = path.rstrip("/") + "/"
+        self.name = name
+        self.depth = depth
+        self.keep = keep  # do not remove the directory itself
+        self.entries = os.scandir(fd)
+        self.doomed = []
+        self.futures = []
+        self.files = 0
+
+
+def clean_directory(root, age, exclusions, dry_run=False, jobs=1):
     """
-    Parse a line, returning a `(path,action)` pair or raising
-    ValueError on parse failure.  This function should NOT be
-    applied to empty lines or comments.
+    Remove the entries below directory `root` whose timestamps are all
+    older than `age` (an `Age`), except those excluded by `exclusions`
+    (an `Exclusions`).  Return the numbers of files and directories
+    removed (or, with `dry_run`, that would be removed).
+
+    The tree is walked once, depth first, with `os.scandir()` relative
+    to directory fds, and every entry is `lstat()`ed once.  Like
+    systemd-tmpfiles, this does not cross mount points, skips
+    directories that are locked (`flock()`), files with the sticky bit
+    and bound AF_UNIX sockets, and only removes directories that are
+    old and empty once their contents have been cleaned.  The
+    timestamps of a directory are taken before it is cleaned, and
+    restored afterwards.
+
+    Files are unlinked in batches of `WALK_BATCH_SIZE` per directory;
+    with `jobs` > 1, by a pool of `jobs` threads.
     """
-    fields = line.split(maxsplit=6)
-    fields += [None] * (7 - len(fields))  # extend to required length
-    typ, path, mode, user, group, age, arg = fields
+    cutoff = time.time_ns() - age.nanoseconds
+    flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+    STATS.count("open")
+    # like systemd-tmpfiles, follow a symbolic link to the root itself
+    root_fd = os.open(root, flags & ~os.O_NOFOLLOW)
+    root_st = os.fstat(root_fd)
+    directories = 0
+
+    pool = None
+    if jobs > 1 and not dry_run:
+        import concurrent.futures
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        unlink_batch = STATS.bind(_unlink_batch)
+
+    def flush(frame):
+        names, frame.doomed = frame.doomed, []
+        if dry_run:
+            for name in names:
+                LOG.info(f"would remove {frame.prefix}{name}")
+            frame.files += len(names)
+        elif pool is not None:
+            frame.futures.append(
+                pool.submit(unlink_batch, frame.fd, frame.prefix, names)
+            )
+        else:
+            frame.files += _unlink_batch(frame.fd, frame.prefix, names)
 
-    # apply templating, e.g. %b
-    path = resolve_specifiers(path)
+    stack = [_OpenDir(root_fd, root, None, root_st, 0, keep=True)]
+    files = 0
+    try:
+        while stack:
+            frame = stack[-1]
+            entry = next(frame.entries, None)
+            if entry is None:
+                flush(frame)
+                files += frame.files + sum(f.result() for f in frame.futures)
+                frame.entries.close()
+                # reading (and cleaning) the directory changed its
+                # timestamps; restore them, like systemd-tmpfiles
+                times = (frame.st.st_atime_ns, frame.st.st_mtime_ns)
+                try:
+                    os.utime(frame.fd, ns=times)
+                except OSError:
+                    pass
+                os.close(frame.fd)
+                stack.pop()
+                if frame.keep:
+                    continue
+                if dry_run:
+                    LOG.info(f"would remove {frame.prefix} (if empty)")
+                    directories += 1
+                    continue
+                try:
+                    os.rmdir(frame.name, dir_fd=stack[-1].fd)
+                    directories += 1
+                except OSError as e:
+                    if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                        report_failure(f"remove {frame.path}", e)
+                continue
 
-    boot_only = "!" in typ
-    ignore_error = "-" in typ  # TODO implement
-    remove_mismatched = "=" in typ  # TODO implement
-    typ = typ.strip("!-=")
+            path = frame.prefix + entry.name
+            first_level = frame.depth == 0 and age.keep_first_level
+            STATS.count("stat")
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            excluded = exclusions.match(path)
+            if excluded == "x":
+                continue
 
-    action = ACTION_MAP[typ](boot_only, mode, user, group, age, arg)
-    return (path, action)
+            if stat.S_ISDIR(st.st_mode):
+                if st.st_dev != root_st.st_dev:
+                    continue  # mount point
+                STATS.count("open")
+                try:
+                    fd = os.open(entry.name, flags, dir_fd=frame.fd)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    report_failure(f"open {path}", e)
+                    continue
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    os.close(fd)
+                    continue  # locked by its user
+                keep = bool(excluded) or first_level
+                keep = keep or not _aged_out(st, age.dir_stamps, cutoff)
+                stack.append(
+                    _OpenDir(fd, path, entry.name, st, frame.depth + 1, keep)
+                )
+                continue
 
+            if (
+                excluded
+                or first_level
+                or st.st_mode & stat.S_ISVTX
+                or not _aged_out(st, age.file_stamps, cutoff)
+                or (stat.S_ISSOCK(st.st_mode) and path in _bound_unix_sockets())
+            ):
+                continue
+            frame.doomed.append(entry.name)
+            if len(frame.doomed) >= WALK_BATCH_SIZE:
+                flush(frame)
+    finally:
+        for frame in stack:
+            frame.entries.close()
+            os.close(frame.fd)
+        if pool is not None:
+            shutdown_pool(pool)
+        if files or directories:
+            GLOB_CACHE.clear()
+            invalidate_dir_fds()
+    return files, directories
+
+
+def clean_path(path, age, exclusions, dry_run=False):
+    """Clean up directory `path` (see `clean_directory()`), unless it
+    has no age or is excluded.  Report what was removed."""
+    if age is None or exclusions.covers(path):
+        return
+    start = time.perf_counter()
+    try:
+        files, directories = clean_directory(
+            path, age, exclusions, dry_run, RECURSIVE_JOBS
+        )
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    except OSError as e:
+        report_failure(f"clean {path}", e)
+        return
+    if files or directories:
+        LOG.info(
+            f"cleaned {path}: {files} files and {directories} directories "
+            f"{'would be ' if dry_run else ''}removed "
+            f"in {time.perf_counter() - start:.3f}s"
+        )
 
-def main():
-    parser = argparse.ArgumentParser(description="systemd-tmpfiles clone")
-    parser.add_argument("--dry-run", action="store_true")
-    parser.add_argument("--create", action="store_true")
-    parser.add_argument("--remove", action="store_true")
-    parser.add_argument("--clean", action="store_true")
-    parser.add_argument("--prefix", default="/")
-    args = parser.parse_args()
 
-    if not any([args.create, args.remove, args.clean]):
-        sys.exit("Must specify one or more of --create, --remove, --clean")
-    if args.remove:
-        sys.exit("--remove is not implemented")
-    if args.clean:
-        sys.exit("--clean is not implemented")
+def remove_tree(path, contents_only=False, jobs=1):
+    """
+    Remove `path` and, if it is a directory, everything below it (or,
+    with `contents_only`, only what is below it).  Return the numbers
+    of files and directories removed.
+
+    The tree is walked once, depth first, with `os.scandir()` relative
+    to directory fds, and entries are removed with `unlinkat()`.
+    Files are unlinked in batches of `WALK_BATCH_SIZE` per directory;
+    with `jobs` > 1, by a pool of `jobs` threads, which pays off for
+    wide directories.  Mount points below `path` are not crossed.
+    """
+    flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+    st = lstat_at(path)
+    if not stat.S_ISDIR(st.st_mode):
+        if contents_only:
+            return 0, 0
+        dir_fd, name = _at(path)
+        os.unlink(name, dir_fd=dir_fd)
+        GLOB_CACHE.invalidate(os.path.dirname(path))
+        return 1, 0
+
+    pool = None
+    if jobs > 1:
+        import concurrent.futures
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        unlink_batch = STATS.bind(_unlink_batch)
+
+    def flush(frame):
+        names, frame.doomed = frame.doomed, []
+        if pool is not None:
+            frame.futures.append(
+                pool.submit(unlink_batch, frame.fd, frame.prefix, names)
+            )
+        else:
+            frame.files += _unlink_batch(frame.fd, frame.prefix, names)
 
-    config_files = list_tmpfiles_configs()
-    for config_file in config_files:
-        for path, actions in read_tmpfiles_config(config_file, args.prefix):
-            print(f">>> {path}")
-            for action in actions:
-                if args.dry_run:
-                    print(action)
-                else:
-                    if args.create:
-                        action.apply(path)
+    dir_fd, name = _at(path)
+    STATS.count("open")
+    root_fd = os.open(name, flags, dir_fd=dir_fd)
+    stack = [_OpenDir(root_fd, path, None, st, 0, keep=True)]
+    files = directories = 0
+    try:
+        while stack:
+            frame = stack[-1]
+            entry = next(frame.entries, None)
+            if entry is None:
+                flush(frame)
+                files += frame.files + sum(f.result() for f in frame.futures)
+                frame.entries.close()
+                os.close(frame.fd)
+                stack.pop()
+                if frame.keep:
+                    continue
+                try:
+                    os.rmdir(frame.name, dir_fd=stack[-1].fd)
+                    directories += 1
+                except OSError as e:
+                    # not empty if it had a mount point below it
+                    if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                        report_failure(f"remove {frame.path}", e)
+                continue
 
+            # is_dir() usually does not need a stat() (d_type)
+            if not entry.is_dir(follow_symlinks=False):
+                frame.doomed.append(entry.name)
+                if len(frame.doomed) >= WALK_BATCH_SIZE:
+                    flush(frame)
+                continue
+            child = frame.prefix + entry.name
+            STATS.count("stat")
+            STATS.count("open")
+            try:
+                if entry.stat(follow_symlinks=False).st_dev != st.st_dev:
+                    continue  # mount point
+                fd = os.open(entry.name, flags, dir_fd=frame.fd)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                report_failure(f"remove {child}", e)
+                continue
+            stack.append(_OpenDir(fd, child, entry.name, None, 0, keep=False))
+    finally:
+        for frame in stack:
+            frame.entries.close()
+            os.close(frame.fd)
+        if pool is not None:
+            shutdown_pool(pool)
+        GLOB_CACHE.clear()
+        invalidate_dir_fds()
+
+    if not contents_only:
+        os.rmdir(name, dir_fd=_at(path)[0])
+        directories += 1
+    return files, directories
+
+
+def remove_path(path, contents_only=False, dry_run=False):
+    """Remove `path` (see `remove_tree()`), reporting what was
+    removed."""
+    if dry_run:
+        what = "the contents of " if contents_only else ""
+        if _lexists(path):
+            LOG.info(f"would remove {what}{path}")
+        return
+    start = time.perf_counter()
+    try:
+        files, directories = remove_tree(path, contents_only, RECURSIVE_JOBS)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    except OSError as e:
+        report_failure(f"remove {path}", e)
+        return
+    if files or directories:
+        LOG.info(
+            f"removed {path}: {files} files and {directories} directories "
+            f"in {time.perf_counter() - start:.3f}s"
+        )
 
-def _parse_mode(s):
-    if s is None:
-        return None
 
-    mask = False
-    if s.startswith("~"):
-        mask = True
-        s = s[1:]
+class GlobCache:
+    """
+    Expand glob patterns like `glob.glob()`, but list every directory
+    only once and match all the patterns below it against that listing.
 
-    return (mask, int(s, base=8))
+    A listing is kept until `invalidate()` is called for its directory,
+    which callers do whenever they create or remove entries in it.
+    The cache is shared by the threads of `apply_parallel()`: a listing
+    made while its directory was invalidated is not kept, since it may
+    predate the change.
 
+    """
 
-def _parse_user(s):
-    if s is None:
-        return None
-    try:
-        return int(s)
-    except ValueError:
-        return pwd.getpwnam(s)[2]
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._patterns = {}
+        self._generation = 0  # bumped by every invalidation
+
+    def _listdir(self, directory):
+        with self._lock:
+            names = self._listings.get(directory)
+            generation = self._generation
+        if names is None:
+            STATS.count("open")
+            try:
+                with os.scandir(directory or os.curdir) as it:
+                    names = tuple(entry.name for entry in it)
+            except OSError:
+                # not cached, the directory may still be created
+                return ()
+            with self._lock:
+                if generation == self._generation:
+                    self._listings[directory] = names
+        return names
+
+    def _match(self, pattern):
+        match = self._patterns.get(pattern)
+        if match is None:
+            match = self._patterns[pattern] = re.compile(
+                fnmatch.translate(pattern)
+            ).match
+        return match
+
+    def glob(self, pattern):
+        """Return the list of paths matching `pattern`."""
+        if not GLOB_MAGIC.search(pattern):
+            return [pattern] if _lexists(pattern) else []
+        directory, base = os.path.split(pattern)
+        if not base:
+            # trailing slash, only matches directories
+            return glob.glob(pattern)
+        if GLOB_MAGIC.search(directory):
+            directories = [d for d in self.glob(directory) if os.path.isdir(d)]
+        else:
+            directories = [directory]
+        if not GLOB_MAGIC.search(base):
+            return [
+                path
+                for path in (os.path.join(d, base) for d in directories)
+                if _lexists(path)
+            ]
+        match = self._match(base)
+        # like glob.glob(), "*" and "?" do not match leading dots
+        hidden = base.startswith(".")
+        return [
+            os.path.join(d, name)
+            for d in directories
+            for name in self._listdir(d)
+            if match(name) and (hidden or not name.startswith("."))
+        ]
+
+    def invalidate(self, directory):
+        """Forget the listing of `directory`, whose entries changed."""
+        with self._lock:
+            self._generation += 1
+            self._listings.pop(directory, None)
+
+    def clear(self):
+        """Forget all listings (e.g. after removing a tree)."""
+        with self._lock:
+            self._generation += 1
+            self._listings.clear()
+
+
+GLOB_CACHE = GlobCache()
+
+
+class ChangeCounter:
+    """Thread-safe count of entries whose metadata was changed or was
+    already as desired."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.changed = 0
+        self.unchanged = 0
+
+    def record(self, changed):
+        with self._lock:
+            if changed:
+                self.changed += 1
+            else:
+                self.unchanged += 1
 
 
-def _parse_group(s):
-    if s is None:
-        return None
-    try:
-        return int(s)
-    except ValueError:
-        return grp.getgrnam(s)[2]
+CHANGES = ChangeCounter()
 
 
-def _parse_attrs(s):
-    if not s:  # None or empty string
-        raise ValueError("file attributes cannot be empty")
-    if s[0] not in "+-=":
-        s = "+" + s  # default operation is '+'
+class RunStats:
+    """
+    Timing, system call, fork and error counts of a run, per config
+    file and per line type (`--stats`), optionally streamed as JSON
+    Lines events (`--trace-json`).
 
-    # TODO more complete checks?  For now just take it as-is.
-    return s
+    Counts are collected per action in a thread-local `Counter`, so
+    that the file system helpers do not take a lock.  Nothing is
+    collected unless `enabled` is set.
 
+    """
 
-def _parse_acls(s):
-    if not s:  # None or empty string
-        raise ValueError("file ACLs cannot be empty")
+    SYSCALLS = ("stat", "chown", "chmod", "mkdir", "open")
+
+    def __init__(self):
+        self.enabled = False
+        self.trace = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._seq = 0
+        self.phases = {}
+        self.configs = collections.defaultdict(self._bucket)
+        self.types = collections.defaultdict(self._bucket)
+        self.total = self._bucket()
+        self.slowest = []
+
+    @staticmethod
+    def _bucket():
+        bucket = {"lines": 0, "seconds": 0.0, "parse_seconds": 0.0}
+        bucket.update((name, 0) for name in RunStats.SYSCALLS)
+        bucket.update(forks=0, errors=0)
+        return bucket
+
+    def count(self, name):
+        """Count a system call, fork or error of the current action."""
+        counts = getattr(self._local, "counts", None)
+        if counts is not None:
+            counts[name] += 1
+
+    def current(self):
+        """Return the `(path, action)` being run in this thread, or
+        `(None, None)`."""
+        return getattr(self._local, "current", (None, None))
+
+    def bind(self, function):
+        """
+        Wrap `function`, to be run in another thread, so that what it
+        does is counted for (and its errors are reported against) the
+        action that is current in this thread.
+        """
+        parent = getattr(self._local, "counts", None)
+        current = self.current()
+        if parent is None and current == (None, None):
+            return function
+
+        def wrapper(*args):
+            self._local.current = current
+            self._local.counts = counts = (
+                None if parent is None else collections.Counter()
+            )
+            try:
+                return function(*args)
+            finally:
+                self._local.current = (None, None)
+                self._local.counts = None
+                if counts:
+                    with self._lock:
+                        parent.update(counts)
+
+        return wrapper
+
+    def run(self, path, action, function):
+        """Return `function(path)`, measuring it as one run of
+        `action`."""
+        outer = self.current()
+        self._local.current = (path, action)
+        try:
+            if not self.enabled:
+                return function(path)
+            self._local.counts = counts = collections.Counter()
+            start = time.perf_counter()
+            try:
+                return function(path)
+            except Exception:
+                counts["errors"] += 1
+                raise
+            finally:
+                self._local.counts = None
+                self._add_action(path, action, time.perf_counter() - start, counts)
+        finally:
+            self._local.current = outer
+
+    def _add_action(self, path, action, seconds, counts):
+        config, lineno = action.source or (None, None)
+        line_type = action.line_type or type(action).__name__
+        with self._lock:
+            for bucket in (self.configs[config], self.types[line_type], self.total):
+                bucket["lines"] += 1
+                bucket["seconds"] += seconds
+                for name, n in counts.items():
+                    bucket[name] += n
+            self._seq += 1
+            item = (seconds, self._seq, config, lineno, line_type, path)
+            if len(self.slowest) < STATS_SLOWEST_LINES:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+            self._emit(
+                event="action",
+                config=config,
+                line=lineno,
+                type=line_type,
+                path=path,
+                seconds=seconds,
+                **counts,
+            )
 
-    # TODO more checks?
-    return s
+    def add_parse(self, config, seconds, lines, errors):
+        """Record the parsing of a config file."""
+        if not self.enabled:
+            return
+        with self._lock:
+            for bucket in (self.configs[config], self.total):
+                bucket["parse_seconds"] += seconds
+                bucket["errors"] += errors
+            self._emit(
+                event="parse",
+                config=config,
+                seconds=seconds,
+                lines=lines,
+                errors=errors,
+            )
 
+    def add_phase(self, name, seconds):
+        """Record the wall time of a phase of the run (e.g. "plan")."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+            self._emit(event="phase", phase=name, seconds=seconds)
+
+    def _emit(self, **event):
+        if self.trace is not None:
+            self.trace.write(json.dumps(event) + "\n")
+
+    def summary(self):
+        """Return the statistics as a JSON-serializable `dict`."""
+        with self._lock:
+            return {
+                "phases": dict(self.phases),
+                "total": dict(self.total),
+                "configs": {k: dict(v) for k, v in self.configs.items()},
+                "types": {k: dict(v) for k, v in self.types.items()},
+                "slowest": [
+                    {
+                        "config": config,
+                        "line": lineno,
+                        "type": line_type,
+                        "path": path,
+                        "seconds": seconds,
+                    }
+                    for seconds, _seq, config, lineno, line_type, path in sorted(
+                        self.slowest, reverse=True
+                    )
+                ],
+            }
+
+
+STATS = RunStats()
+
+
+class Log:
+    """
+    The messages of a run, at one of three levels: `QUIET` (errors
+    only), `NORMAL` (also warnings, what was removed or cleaned, and a
+    summary) and `VERBOSE` (also every path applied), written as text
+    or as JSON Lines (`--log-format=json`).
 
-def _parse_major_minor(s):
-    if s is None:
-        raise ValueError("major:minor cannot be empty")
+    Messages are buffered and written at once by `flush()`, at the end
+    of the run (and after each convergence with `--watch`), or when
+    `LOG_BUFFER_LINES` are pending.  Errors and warnings carry the
+    config file, line number and type of the action being run, and
+    errors the errno of their cause.
 
-    parts = s.split(":")
-    if len(parts) != 2:
-        raise ValueError("major:minor must have 2 parts")
+    """
 
-    try:
-        major = int(parts[0])
-        minor = int(parts[1])
-    except ValueError:
-        raise ValueError("major:minor must be integers")
+    QUIET, NORMAL, VERBOSE = range(3)
+
+    def __init__(self):
+        self.level = Log.NORMAL
+        self.json = False
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._buffer = []
+
+    def error(self, message, cause=None, **fields):
+        """Log an error; `cause` is the exception, if any."""
+        if cause is not None:
+            message = f"{message}: {cause}"
+            code = getattr(cause, "errno", None)
+            if code is not None:
+                fields.update(errno=code, error=errno.errorcode.get(code))
+        self._log(Log.QUIET, "error", message, True, fields)
+
+    def warning(self, message, **fields):
+        self._log(Log.NORMAL, "warning", message, True, fields)
+
+    def info(self, message, **fields):
+        self._log(Log.NORMAL, "info", message, False, fields)
+
+    def verbose(self, message, **fields):
+        self._log(Log.VERBOSE, "verbose", message, False, fields)
+
+    def _log(self, level, severity, message, with_source, fields):
+        with self._lock:
+            self.counts[severity] += 1
+        if level > self.level:
+            return
+        if with_source and "config" not in fields:
+            path, action = STATS.current()
+            if action is not None:
+                fields.setdefault("path", path)
+                fields["type"] = action.line_type
+                if action.source is not None:
+                    fields["config"], fields["line"] = action.source
+        if self.json:
+            record = {"level": severity, "message": message}
+            record.update((k, v) for k, v in fields.items() if v is not None)
+            text = json.dumps(record)
+        elif with_source and fields.get("config") is not None:
+            text = f"{fields['config']}:{fields['line']}: {message}"
+        else:
+            text = message
+        with self._lock:
+            self._buffer.append(text + "\n")
+            if len(self._buffer) >= LOG_BUFFER_LINES:
+                self._flush()
 
-    return (major, minor)
+    def flush(self):
+        """Write the pending messages to stdout."""
+        with self._lock:
+            self._flush()
 
+    def _flush(self):
+        if self._buffer:
+            data, self._buffer = "".join(self._buffer), []
+            sys.stdout.write(data)
+        sys.stdout.flush()
 
-def _run_process(desc, args):
-    try:
-        subprocess.check_call(args)
-    except FileNotFoundError:
-        if len(args) < 1:
-            prog = "<undefined>"
-        else:
-            prog = args[0]
-        print(f"failed to {desc}: {prog!r} program not found")
-    except subprocess.CalledProcessError as e:
-        print(f"failed to {desc}: {e}")
+
+LOG = Log()
 
 
 class Action:
@@ -327,12 +3357,32 @@ class Action:
     # If should raise ValueError for invalid input.
     arg_function = staticmethod(lambda x: x)
 
+    # whether the action creates (or removes) the path, in which case
+    # it conflicts with other such lines for the same path
+    takes_ownership = False
+
+    # whether the type has a '+' modifier, which bypasses conflict
+    # checks
+    append_or_force = False
+
+    # (config_file, line_number) the action was parsed from
+    source = None
+
+    # line type (e.g. "d", "L+") the action was parsed from
+    line_type = None
+
+    # file type (`stat.S_IF*`) the action creates, if any
+    file_type = None
+
+    # whether the action sets the ownership and mode of the path
+    adjusts_metadata = True
+
     def __init__(self, bootonly, mode, user, group, age, arg):
         self.bootonly = bootonly
         self._set("mode", mode, function=_parse_mode)
         self._set("user", user, function=_parse_user)
         self._set("group", group, function=_parse_group)
-        self._set("age", age, function=lambda TODO: TODO)
+        self._set("age", age, function=_parse_age)
         self._set("arg", arg, function=self.arg_function)
 
     def _set(self, k, v, function=lambda x: x):
@@ -340,14 +3390,74 @@ class Action:
             v = None
         setattr(self, k, function(v))
 
+    def _identity(self):
+        return (
+            type(self),
+            self.mode,
+            self.user,
+            self.group,
+            self.age,
+            self.arg,
+        )
+
+    def same_as(self, other):
+        """Whether `other` is an exact duplicate of this action."""
+        return self._identity() == other._identity()
+
+    def compatible_with(self, other):
+        """
+        Whether this action may be applied to the same path as
+        `other` (see `item_compatible()` in systemd-tmpfiles).
+        """
+        if self.takes_ownership and other.takes_ownership:
+            return self._identity()[1:] == other._identity()[1:]
+        return True
+
     def describe(self, path):
-        """Describe the action."""
-        raise NotImplementedError
+        """
+        Describe what applying the action to `path` would change,
+        without changing anything.  Return a `list` of strings.
+        """
+        try:
+            st = lstat_at(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return [f"{path}: missing"]
+        return [f"{path}: {change}" for change in self._describe_metadata(st)]
+
+    def verify(self, path, st, metadata=True, acl=False):
+        """
+        Return a `list` of the ways in which `path`, whose `lstat()`
+        result is `st` (None if it does not exist), differs from what
+        applying the action would make of it (`--verify`).  The
+        ownership and mode are only checked if `metadata` is true, and
+        the group permission bits not if `acl` (an ACL line for the
+        path, whose mask they then are).
+        """
+        if st is None:
+            return ["missing"] if self.file_type is not None else []
+        kind = stat.S_IFMT(st.st_mode)
+        if self.file_type is not None and kind != self.file_type:
+            return [
+                f"is a {FILE_KINDS.get(kind, 'file')}, "
+                f"expected a {FILE_KINDS[self.file_type]}"
+            ]
+        return self._describe_metadata(st, acl) if metadata else []
 
     def apply(self, path):
         """Apply the action."""
         self.apply_one(path)
 
+    def remove(self, path, dry_run=False):
+        """Remove the path, or its contents (`--remove`)."""
+        self.remove_one(path, dry_run)
+
+    def remove_one(self, path, dry_run=False):
+        """Remove a single path.  Most types do not remove anything."""
+
+    def clean(self, path, exclusions, dry_run=False):
+        """Remove old entries below `path`, according to the age
+        field (`--clean`).  Most types do not clean up."""
+
     def apply_one(self, path):
         """
         Apply the action on a single path.
@@ -358,25 +3468,48 @@ class Action:
         """
         raise NotImplementedError
 
-    def _chown_and_chmod(self, path):
-        # the order matters, because chown(2) resets SUID and SGID bits
-        self._chown(path)
-        self._chmod(path)
+    def _chown_and_chmod(self, path, st=None):
+        """
+        Set the file ownership and mode.  Caller must ensure file
+        exists.  `st` is the `lstat()` result of `path`, if already
+        known.  Only the system calls that change something are made.
+        """
+        if st is None:
+            st = lstat_at(path)
+        uid, gid, mode = self._metadata_changes(st)
+        if uid is not None or gid is not None:
+            try:
+                _chown_at(
+                    path, -1 if uid is None else uid, -1 if gid is None else gid
+                )
+            except OSError as e:
+                report_failure(f"chown {path!r}", e)
+            # chown(2) resets SUID and SGID bits, so set the mode again
+            mode = self._desired_mode(st)
+        if mode is not None:
+            try:
+                _chmod_at(path, mode)
+            except OSError as e:
+                report_failure(f"chmod {path!r}", e)
+        CHANGES.record(uid is not None or gid is not None or mode is not None)
+
+    def _desired_mode(self, st):
+        """Return the mode the file described by `st` should have, or
+        None for symbolic links (whose mode cannot be changed)."""
+        r = st.st_mode
+        if stat.S_ISLNK(r):
+            return None
 
-    def _chmod(self, path):
-        """Set the file mode.  Caller must ensure file exists."""
         if self.mode is None:
             mask = False
-            if os.path.islink(path) or not os.path.isdir(path):
-                mode = 0o644  # is a file or symbolic link
+            if not stat.S_ISDIR(r):
+                mode = 0o644  # is a file
             else:
                 mode = 0o755  # is a dir
         else:
             mask, mode = self.mode
 
         if mask:
-            r = os.lstat(path).st_mode  # stat file
-
             # existing mode masks new mode
             mode &= stat.S_IMODE(r)
 
@@ -384,49 +3517,94 @@ class Action:
             if not stat.S_ISDIR(r):
                 mode &= ~(stat.S_ISUID | stat.S_ISGID | stat.S_ISVTX)
 
-        try:
-            os.chmod(path, mode, follow_symlinks=False)
-        except:
-            print(f"failed to chmod {path!r}")
+        return mode
 
-    def _chown(self, path):
-        """Set the file ownership.  Caller must ensure file exists."""
-        user = self.user
-        if user is None:
-            user = -1
-        group = self.group
-        if group is None:
-            group = -1
-        if user >= 0 or group >= 0:
-            try:
-                os.chown(path, user, group, follow_symlinks=False)
-            except:
-                print(f"failed to chmod {path!r}")
+    def _metadata_changes(self, st):
+        """
+        Compare the `lstat()` result `st` with the desired ownership
+        and mode.  Return a `(uid, gid, mode)` tuple where each item is
+        None if it already matches.
+        """
+        uid = self.user if self.user not in (None, st.st_uid) else None
+        gid = self.group if self.group not in (None, st.st_gid) else None
+        mode = self._desired_mode(st)
+        if mode == stat.S_IMODE(st.st_mode):
+            mode = None
+        return uid, gid, mode
+
+    def _describe_metadata(self, st, acl=False):
+        uid, gid, mode = self._metadata_changes(st)
+        if acl and mode is not None and not (mode ^ st.st_mode) & ~0o070 & 0o7777:
+            mode = None  # only the group bits differ, i.e. the ACL mask
+        changes = []
+        if uid is not None:
+            changes.append(f"owner {st.st_uid} -> {uid}")
+        if gid is not None:
+            changes.append(f"group {st.st_gid} -> {gid}")
+        if mode is not None:
+            changes.append(f"mode {stat.S_IMODE(st.st_mode):04o} -> {mode:04o}")
+        return changes
 
 
 class GlobAction(Action):
     """Action that takes a glob rather than a path."""
 
     def apply(self, pattern):
-        for path in glob.glob(pattern):
+        for path in GLOB_CACHE.glob(pattern):
             self.apply_one(path)
 
+    def remove(self, pattern, dry_run=False):
+        for path in GLOB_CACHE.glob(pattern):
+            self.remove_one(path, dry_run)
+
+    def describe(self, pattern):
+        return [
+            change
+            for path in GLOB_CACHE.glob(pattern)
+            for change in Action.describe(self, path)
+        ]
+
+    def verify(self, path, st, metadata=True, acl=False):
+        if st is None:
+            return []  # matches nothing, which is fine
+        return super().verify(path, st, metadata, acl)
+
+
+class NoVerify:
+    """Mixin for types whose result `--verify` does not check."""
+
+    adjusts_metadata = False
+
+    def verify(self, path, st, metadata=True, acl=False):
+        return []
+
 
 class FileCreate(Action):
     """f - create file with optional content"""
 
+    takes_ownership = True
+    file_type = stat.S_IFREG
+
     def apply_one(self, path):
-        if not os.path.lexists(path):
-            with open(path, "w") as f:
+        try:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+            with _open(path, flags) as f:
                 f.write(self.arg if self.arg is not None else "")
+        except FileExistsError:
+            pass
         self._chown_and_chmod(path)
 
 
 class FileCreateOrTruncate(Action):
     """f+ - create or truncate file, with optional content"""
 
+    takes_ownership = True
+    file_type = stat.S_IFREG
+    append_or_force = True
+
     def apply_one(self, path):
-        with open(path, "w") as f:
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+        with _open(path, flags) as f:
             f.write(self.arg if self.arg is not None else "")
         self._chown_and_chmod(path)
 
@@ -434,10 +3612,13 @@ class FileCreateOrTruncate(Action):
 class FileWrite(GlobAction):
     """w - write to file"""
 
+    takes_ownership = True
+    file_type = stat.S_IFREG
+
     # TODO interpret C-style blackslashes in argument.  Also for
     # other actions (f, f+, w+, ...)
     def apply_one(self, path):
-        with open(path, "w") as f:
+        with _open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC) as f:
             f.write(self.arg if self.arg is not None else "")
         self._chown_and_chmod(path)
 
@@ -445,8 +3626,12 @@ class FileWrite(GlobAction):
 class FileAppend(GlobAction):
     """w+ - append to file"""
 
+    takes_ownership = True
+    file_type = stat.S_IFREG
+    append_or_force = True
+
     def apply_one(self, path):
-        with open(path, "a") as f:
+        with _open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND) as f:
             f.write(self.arg if self.arg is not None else "")
         self._chown_and_chmod(path)
 
@@ -454,25 +3639,46 @@ class FileAppend(GlobAction):
 class DirCreateAndCleanup(Action):
     """d - create and cleanup directory"""
 
+    takes_ownership = True
+    file_type = stat.S_IFDIR
+
     def apply_one(self, path):
-        if not os.path.lexists(path):
-            os.makedirs(path)
+        _mkdir(path)
         self._chown_and_chmod(path)
 
+    def clean(self, path, exclusions, dry_run=False):
+        clean_path(path, self.age, exclusions, dry_run)
+
 
 class DirCreateAndRemove(DirCreateAndCleanup):
     """D - create and remove directory"""
 
-    # No additional behaviour, until --remove gets implemented
+    def remove_one(self, path, dry_run=False):
+        remove_path(path, contents_only=True, dry_run=dry_run)
 
 
 class DirCleanup(GlobAction):
     """e - create and remove directory"""
 
+    takes_ownership = True
+
+    def clean(self, pattern, exclusions, dry_run=False):
+        for path in GLOB_CACHE.glob(pattern):
+            clean_path(path, self.age, exclusions, dry_run)
+
     def apply_one(self, path):
-        if os.path.isdir(path):
+        try:
+            is_dir = stat.S_ISDIR(_stat(path).st_mode)
+        except (FileNotFoundError, NotADirectoryError):
+            is_dir = False
+        if is_dir:
             self._chown_and_chmod(path)
 
+    def verify(self, path, st, metadata=True, acl=False):
+        if st is None or not stat.S_ISDIR(st.st_mode):
+            return []  # only existing directories are adjusted
+        return super().verify(path, st, metadata, acl)
+
 
 class SubvolumeCreate_v(DirCreateAndCleanup):
     """v - create subvolume or directory"""
@@ -498,39 +3704,65 @@ class SubvolumeCreate_Q(DirCreateAndCleanup):
 class SymlinkCreate(Action):
     """L - create symlink"""
 
+    takes_ownership = True
+    file_type = stat.S_IFLNK
+    adjusts_metadata = False
+
+    def verify(self, path, st, metadata=True, acl=False):
+        if st is None or not stat.S_ISLNK(st.st_mode):
+            return super().verify(path, st, metadata, acl)
+        target = os.readlink(path)
+        if self.arg is not None and target != self.arg:
+            return [f"target {target!r} -> {self.arg!r}"]
+        return []
+
     def apply_one(self, path):
-        if not os.path.exists(path):
+        if not _lexists(path):
             if self.arg is None:
                 # TODO link to /usr/share/factory/FILE
                 # (see tmpfiles.d(5) for details)
                 raise RuntimeError("symlink target not specified")
-            os.symlink(self.arg, path)
+            dir_fd, name = _at(path)
+            os.symlink(self.arg, name, dir_fd=dir_fd)
+            GLOB_CACHE.invalidate(os.path.dirname(path))
 
 
 class SymlinkRecreate(SymlinkCreate):
     """L+ - [re]create symlink"""
 
+    append_or_force = True
+
     def apply_one(self, path):
-        if os.path.exists(path):
-            if not os.path.islink(path) and os.path.isdir(path):
-                shutil.rmtree(path)
-            else:
-                os.unlink(path)
-        super().apply(path)
+        if _lexists(path):
+            remove_tree(path, jobs=RECURSIVE_JOBS)
+        super().apply_one(path)
 
 
 class CreateCharDev(Action):
     """c - create character device node"""
 
+    takes_ownership = True
+    file_type = stat.S_IFCHR
+
     arg_function = staticmethod(_parse_major_minor)
 
     def apply_one(self, path):
-        major, minor = self.args
-        if not os.path.lexists():
-            _run_process(
-                f"create character device at {path}",
-                ["mknod", path, c, major, minor],
-            )
+        major, minor = self.arg
+        if not _lexists(path):
+            mode = 0o644 if self.mode is None else self.mode[1]
+            dir_fd, name = _at(path)
+            try:
+                os.mknod(
+                    name,
+                    stat.S_IFCHR | mode,
+                    os.makedev(major, minor),
+                    dir_fd=dir_fd,
+                )
+            except OSError as e:
+                report_failure(f"create character device at {path}", e)
+                return
+            GLOB_CACHE.invalidate(os.path.dirname(path))
+        self._chown_and_chmod(path)
 
 
 # TODO c+ b b+ (char and block devices)
@@ -539,6 +3771,17 @@ class CreateCharDev(Action):
 class Copy(Action):
     """C - copy file"""
 
+    takes_ownership = True
+    adjusts_metadata = False
+
+    def verify(self, path, st, metadata=True, acl=False):
+        # the copy may be of a file or of a directory, whose ownership
+        # and mode are those of the source
+        return ["missing"] if st is None else []
+
+    def clean(self, path, exclusions, dry_run=False):
+        clean_path(path, self.age, exclusions, dry_run)
+
     def apply_one(self, path):
         src = self.arg
         if src is None:
@@ -551,54 +3794,99 @@ class Copy(Action):
         # ensure intermediate directories exist
         if not os.path.isdir(os.path.dirname(path)):
             os.makedirs(os.path.dirname(path))
+            GLOB_CACHE.clear()
 
-        if os.path.islink(src) or not os.path.isdir(src):
-            if not os.path.exists(path):
-                shutil.copy(src, path, follow_symlinks=False)
-        else:  # src is a directory
-            if (
-                os.path.isdir(path)
-                and not os.path.islink(path)
-                and len(os.listdir(path)) <= 0
-            ):
-                # dst is a empty dir.  remove it (it will be recreated)
-                os.rmdir(path)
-            if not os.path.exists(path):
-                shutil.copytree(src, path, symlinks=True)
-
-
-class IgnoreRecursive(GlobAction):
+        try:
+            src_st = lstat_at(src)
+        except (FileNotFoundError, NotADirectoryError) as e:
+            report_failure(f"copy {src!r}", e)
+            return
+        try:
+            st = lstat_at(path)
+        except FileNotFoundError:
+            # copy to a temporary name first, so that a copy that was
+            # interrupted is not mistaken for a complete one
+            tmp = os.path.join(
+                os.path.dirname(path), f".#{os.path.basename(path)}.copy"
+            )
+            if _lexists(tmp):
+                remove_tree(tmp, jobs=RECURSIVE_JOBS)
+            copy_tree(src, tmp, RECURSIVE_JOBS)
+            os.rename(tmp, path)
+            invalidate_dir_fds()
+            GLOB_CACHE.invalidate(os.path.dirname(path))
+            return
+        if stat.S_ISDIR(src_st.st_mode) and stat.S_ISDIR(st.st_mode):
+            with os.scandir(path) as it:
+                empty = next(it, None) is None
+            if empty:
+                # dst is an empty dir, copy the contents of src into it
+                copy_tree(src, path, RECURSIVE_JOBS)
+
+
+class IgnoreRecursive(NoVerify, GlobAction):
     """x - ignore path or glob recursively"""
 
+    takes_ownership = True
+
     def apply_one(_self, _path):
         pass  # nothing to due; only applies to cleanup
 
 
-class Ignore(GlobAction):
+class Ignore(NoVerify, GlobAction):
     """X - ignore path or glob"""
 
+    takes_ownership = True
+
     def apply_one(_self, _path):
         pass  # nothing to due; only applies to cleanup
 
 
-class Remove(GlobAction):
-    """r - remove empty dir"""
+class Remove(NoVerify, GlobAction):
+    """r - remove file or empty dir (with --remove)"""
+
+    takes_ownership = True
+
+    def describe(self, pattern):
+        return []  # only acts with --remove
 
     def apply_one(self, path):
-        if os.path.islink(path) or not os.path.isdir(path):
-            os.unlink(path)
-        elif len(os.listdir(path)) <= 0:
-            os.rmdir(path)
+        pass  # only acts with --remove
+
+    def remove_one(self, path, dry_run=False):
+        if dry_run:
+            LOG.info(f"would remove {path}")
+            return
+        dir_fd, name = _at(path)
+        try:
+            if stat.S_ISDIR(lstat_at(path).st_mode):
+                os.rmdir(name, dir_fd=dir_fd)
+                invalidate_dir_fds()
+                GLOB_CACHE.invalidate(path)
+            else:
+                os.unlink(name, dir_fd=dir_fd)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                report_failure(f"remove {path}", e)
+            return
+        GLOB_CACHE.invalidate(os.path.dirname(path))
+
 
+class RemoveRecursive(NoVerify, GlobAction):
+    """R - recursive delete (with --remove)"""
 
-class RemoveRecursive(GlobAction):
-    """R - recursive delete"""
+    takes_ownership = True
+
+    def describe(self, pattern):
+        return []  # only acts with --remove
 
     def apply_one(self, path):
-        if os.path.islink(path) or not os.path.isdir(path):
-            os.unlink(path)
-        else:
-            shutil.rmtree(path, ignore_errors=True)
+        pass  # only acts with --remove
+
+    def remove_one(self, path, dry_run=False):
+        remove_path(path, dry_run=dry_run)
 
 
 # TODO t T
@@ -608,7 +3896,7 @@ class ModeAdjust(GlobAction):
     """z - adjust mode/user/group"""
 
     def apply_one(self, path):
-        if os.path.lexists(path):
+        if _lexists(path):
             self._chown_and_chmod(path)
             # TODO restore SELinux context
 
@@ -617,25 +3905,20 @@ class ModeAdjustRecursive(GlobAction):
     """Z - adjust mode/user/group recursively"""
 
     def apply_one(self, path):
-        if os.path.islink(path) or not os.path.isdir(path):
-            # link or file
-            self._chown_and_chmod(path)
-            # TODO restore SELinux context
-        else:  # directory
-            for dirname, dirs, files in os.walk(path):
-                for filename in dirs + files:
-                    node = os.path.join(dirname, filename)
-                    self._chown_and_chmod(path)
-                    # TODO restore SELinux context
+        # TODO restore SELinux context
+        apply_recursive(path, self._chown_and_chmod, RECURSIVE_JOBS)
 
 
-class AttrsSet(GlobAction):
+class AttrsSet(NoVerify, GlobAction):
     """h - set file attributes"""
 
     arg_function = staticmethod(_parse_attrs)
     chattr_args = []
+    recursive = False
 
     def apply_one(self, path):
+        if native_set_attrs(path, self.arg, self.recursive):
+            return
         _run_process(
             f"change attributes of {path}",
             ["chattr"] + self.chattr_args + [self.arg, path],
@@ -646,14 +3929,33 @@ class AttrsSetRecursive(AttrsSet):
     """H - set file attributes recursively"""
 
     chattr_args = ["-R"]
+    recursive = True
 
 
-class ACLsSet(GlobAction):
-    """a - set POSIX ACLs"""
+class ACLAction(GlobAction):
+    """Base of the POSIX ACL types."""
 
     arg_function = staticmethod(_parse_acls)
 
+    adjusts_metadata = False
+
+    # whether existing extended ACL entries are removed first
+    clear_acls = False
+
+    def verify(self, path, st, metadata=True, acl=False):
+        if st is None:
+            return []
+        return verify_acls(path, st, self.arg, self.clear_acls)
+
+
+class ACLsSet(ACLAction):
+    """a - set POSIX ACLs"""
+
+    clear_acls = True
+
     def apply_one(self, path):
+        if native_set_acls(path, self.arg, clear=True, recursive=False):
+            return
         _run_process(
             f"clear ACLs of {path}",
             ["setfacl", "--remove-all", "--", path],
@@ -664,24 +3966,28 @@ class ACLsSet(GlobAction):
         )
 
 
-class ACLsAppend(GlobAction):
+class ACLsAppend(ACLAction):
     """a+ - append POSIX ACLs"""
 
-    arg_function = staticmethod(_parse_acls)
+    append_or_force = True
 
     def apply_one(self, path):
+        if native_set_acls(path, self.arg, clear=False, recursive=False):
+            return
         _run_process(
             f"set ACLs of {path}",
             ["setfacl", "--modify", self.arg, "--", path],
         )
 
 
-class ACLsSetRecursive(GlobAction):
+class ACLsSetRecursive(ACLAction):
     """A - set POSIX ACLs recursively"""
 
-    arg_function = staticmethod(_parse_acls)
+    clear_acls = True
 
     def apply_one(self, path):
+        if native_set_acls(path, self.arg, clear=True, recursive=True):
+            return
         _run_process(
             f"clear ACLs (recursively) of {path}",
             ["setfacl", "--recursive", "--remove-all", "--", path],
@@ -700,12 +4006,14 @@ class ACLsSetRecursive(GlobAction):
         )
 
 
-class ACLsAppendRecursive(GlobAction):
+class ACLsAppendRecursive(ACLAction):
     """A+ - append POSIX ACLs recursively"""
 
-    arg_function = staticmethod(_parse_acls)
+    append_or_force = True
 
     def apply_one(self, path):
+        if native_set_acls(path, self.arg, clear=False, recursive=True):
+            return
         _run_process(
             f"set ACLs (recursively) of {path}",
             [
@@ -732,8 +4040,6 @@ The order is the order in which they appear in tmpfiles.d(5).  The
 order seems reasonable, although I'm not sure whether it is the
 order that systemd-tmpfiles actually uses.
 
-TODO: % specifiers (at least %b and %m are required)
-
 """
 ACTION_MAP = collections.OrderedDict(
     [
@@ -768,6 +4074,12 @@ ACTION_MAP = collections.OrderedDict(
     ]
 )
 
+# Position of each action class in ACTION_MAP (the first one, for
+# classes with deprecated aliases), used to order actions on a path.
+ACTION_RANK = {}
+for _rank, _cls in enumerate(ACTION_MAP.values()):
+    ACTION_RANK.setdefault(_cls, _rank)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,268 @@
+#!/bin/python3
+
+"""
+
+Script that turns off the sandboxing options of systemd units that the
+container cannot set up (`PrivateTmp`, `PrivateDevices`,
+`ProtectSystem`) with drop-ins, instead of editing the unit files in
+place, so that the root file system can be read-only.
+
+Every listed unit file is read once, with its drop-ins in
+`/etc/systemd/system`, `/run/systemd/system` and next to it, and a
+drop-in `/run/systemd/system/<unit>.d/zz-ipa-container.conf` is only
+written for the units that actually turn on one of the options
+requested for them.  Units that do not are left alone.  The drop-in's
+name sorts after the usual ones, so that systemd applies it last.
+
+The drop-ins only depend on the image and on the drop-ins the admin
+added, so with `--cache FILE` they are stored in FILE together with
+the image's build-id, the options requested and the names and mtimes
+of the other drop-ins, and later starts write them from FILE without
+reading any unit while none of these change.
+
+"""
+
+import argparse
+import atexit
+import json
+import os
+import sys
+
+from tmpfiles import LOG, Log, file_fingerprint
+
+OUTPUT_DIR = "/run/systemd/system"
+# directories whose drop-ins apply to every unit file, by precedence;
+# the output directory comes right after them (see systemd.unit(5))
+UNIT_DROPIN_DIRS = ("/etc/systemd/system",)
+DROPIN_NAME = "zz-ipa-container.conf"
+BUILD_ID_FILE = "/data-template/build-id"
+CACHE_VERSION = 2
+
+# option: (command line flag, value that turns it off)
+OPTIONS = {
+    "PrivateTmp": ("--private-tmp-off", "off"),
+    "PrivateDevices": ("--private-devices-off", "off"),
+    "ProtectSystem": ("--protect-system-off", "no"),
+}
+FALSE_VALUES = ("", "0", "no", "false", "off")
+
+
+def unit_files(path, output=OUTPUT_DIR):
+    """Return the unit file `path` followed by its drop-ins (except
+    those written by this script in `output`), in the order systemd
+    applies them."""
+    name = os.path.basename(path)
+    directories = [os.path.join(d, f"{name}.d") for d in UNIT_DROPIN_DIRS]
+    directories += [os.path.join(output, f"{name}.d"), f"{path}.d"]
+    dropins = {}
+    for directory in directories:
+        try:
+            entries = os.listdir(directory)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for entry in entries:
+            if entry.endswith(".conf") and entry != DROPIN_NAME:
+                # the first directory listed wins, as in systemd
+                dropins.setdefault(entry, os.path.join(directory, entry))
+    return [path] + [dropins[entry] for entry in sorted(dropins)]
+
+
+def dropins_fingerprint(paths, output=OUTPUT_DIR):
+    """Return a `list` that changes whenever a drop-in of the unit
+    files `paths` is added, removed, replaced or modified."""
+    return [
+        [dropin] + file_fingerprint(dropin)
+        for path in sorted(paths)
+        for dropin in unit_files(path, output)[1:]
+    ]
+
+
+def read_service_settings(paths, names):
+    """
+    Return the values of the settings `names` of the `[Service]`
+    section of the unit files `paths`; the last assignment wins, and
+    an empty one resets the setting.  Missing files are skipped.
+    """
+    values = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            continue
+        section = None
+        pending = ""
+        for line in lines:
+            line = pending + line.strip()
+            if line.endswith("\\"):
+                pending = line[:-1] + " "
+                continue
+            pending = ""
+            if not line or line[0] in "#;":
+                continue
+            if line.startswith("["):
+                section = line.strip("[]")
+                continue
+            key, sep, value = line.partition("=")
+            if section == "Service" and sep and key.strip() in names:
+                values[key.strip()] = value.strip()
+    return values
+
+
+def generate_dropins(requests, output=OUTPUT_DIR):
+    """
+    `requests` maps unit file paths to the options to turn off.  Return
+    a `dict` mapping the name of every unit that turns any of them on
+    to the contents of its drop-in.
+    """
+    dropins = {}
+    for path, options in sorted(requests.items()):
+        if not os.path.exists(path):
+            LOG.warning(f"unit {path!r} not found")
+            continue
+        values = read_service_settings(unit_files(path, output), options)
+        enabled = [
+            option
+            for option in options
+            if values.get(option, "").lower() not in FALSE_VALUES
+        ]
+        if not enabled:
+            LOG.verbose(f"{path}: nothing to turn off")
+            continue
+        lines = ["# Generated by unit_dropins.py at container start", "[Service]"]
+        lines += [f"{option}={OPTIONS[option][1]}" for option in enabled]
+        dropins[os.path.basename(path)] = "\n".join(lines) + "\n"
+    return dropins
+
+
+def write_dropins(output, names, dropins):
+    """Write `dropins` to `output`, and remove the drop-ins of the units
+    `names` that no longer need one."""
+    for name in sorted(names):
+        path = os.path.join(output, f"{name}.d", DROPIN_NAME)
+        content = dropins.get(name)
+        if content is None:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                if f.read() == content:
+                    continue
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+        LOG.verbose(f"wrote {path}")
+
+
+def _read_build_id(path):
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_cache(path, key):
+    """Return the drop-ins stored in `path` for `key`, or None."""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        LOG.warning(f"ignoring cache {path!r}: {e}")
+        return None
+    if data.get("version") != CACHE_VERSION or data.get("key") != key:
+        return None
+    return data.get("dropins")
+
+
+def save_cache(path, key, dropins):
+    tmp = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump({"version": CACHE_VERSION, "key": key, "dropins": dropins}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        LOG.warning(f"failed to save cache {path!r}: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="systemd sandboxing drop-ins")
+    for option, (flag, _value) in OPTIONS.items():
+        parser.add_argument(
+            flag,
+            dest=option,
+            nargs="+",
+            default=[],
+            action="extend",
+            metavar="UNIT",
+            help=f"turn {option} off for the unit files UNIT",
+        )
+    parser.add_argument("--output", default=OUTPUT_DIR, metavar="DIR")
+    parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help="reuse the drop-ins stored in FILE for the same image build",
+    )
+    parser.add_argument("--build-id", default=BUILD_ID_FILE, metavar="FILE")
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="only log errors",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="also log every unit and drop-in",
+    )
+    args = parser.parse_args()
+    if args.quiet:
+        LOG.level = Log.QUIET
+    elif args.verbose:
+        LOG.level = Log.VERBOSE
+    atexit.register(LOG.flush)
+
+    requests = {}
+    for option in OPTIONS:
+        for path in getattr(args, option):
+            options = requests.setdefault(path, [])
+            if option not in options:
+                options.append(option)
+    names = {os.path.basename(path) for path in requests}
+
+    build_id = _read_build_id(args.build_id)
+    dropins = None
+    if args.cache and build_id is not None:
+        key = [
+            build_id,
+            sorted([path, sorted(o)] for path, o in requests.items()),
+            dropins_fingerprint(requests, args.output),
+        ]
+        dropins = load_cache(args.cache, key)
+    cached = dropins is not None
+    if not cached:
+        dropins = generate_dropins(requests, args.output)
+    try:
+        write_dropins(args.output, names, dropins)
+    except OSError as e:
+        LOG.flush()
+        sys.exit(f"failed to write the drop-ins: {e}")
+    if args.cache and build_id is not None and not cached:
+        save_cache(args.cache, key, dropins)
+    LOG.info(
+        f"{len(dropins)} drop-ins for {len(names)} units"
+        + (" (cached)" if cached else "")
+    )
+
+
+if __name__ == "__main__":
+    main()
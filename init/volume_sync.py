@@ -0,0 +1,669 @@
+#!/bin/python3
+
+"""
+
+Script that keeps a data volume in line with the image's template.
+
+After an image upgrade (`--update`) it replaces the `sha256sum`,
+`tar`, `chown --reference` and `chmod --reference` loops that
+`container_step_volume_update` used to run.
+
+Files listed in `/etc/volume-data-autoupdate` (in `sha256sum` format)
+whose copy in the volume still has one of the listed hashes, i.e. was
+not modified by the admin, are replaced by the template's version, or
+removed if the template has none.  Then the paths listed in
+`/etc/volume-data-list` get the ownership and mode of their template
+counterpart.
+
+The template side of both lists is described by a manifest (type,
+size, mtime, hash, owner and mode of every path), written when the
+image is built (`--write-manifest`) and loaded once; it is only
+rebuilt, in memory, if it does not match the template's build-id.
+The volume side is hashed through a cache keyed on size and mtime
+(`--cache FILE`), so files that did not change since the last update
+are never read again.
+
+Files are copied with the copy engine of `tmpfiles.py` (reflink or
+in-kernel copy, preserving ownership, mode and timestamps), to a
+temporary name that is then renamed into place, by `--jobs N` threads.
+Files whose content, owner and mode already match the template are
+left alone, and ownership and mode are only changed where they differ.
+
+`--populate DIR` creates the entries of `DIR-template` that are
+missing from `DIR` (`/data` on first boot, `/tmp` on every start), in
+place of `populate-volume-from-template`: the template is walked once,
+missing entries and subtrees are copied concurrently with their
+ownership, mode and timestamps, and existing directories get the
+ownership and mode of the template.
+
+Failures are reported per path and do not stop the update or the
+population, as with the shell scripts.
+
+"""
+
+import argparse
+import atexit
+import collections
+import json
+import os
+import re
+import stat
+import sys
+import threading
+import time
+
+from tmpfiles import (
+    LOG,
+    Log,
+    copy_node,
+    copy_tree,
+    invalidate_dir_fds,
+    lstat_at,
+    remove_tree,
+    report_failure,
+    shutdown_pool,
+)
+
+# concurrent.futures and hashlib are imported where they are used, as
+# in tmpfiles.py
+
+DATA_DIR = "/data"
+TEMPLATE_DIR = "/data-template"
+AUTOUPDATE_FILE = "/etc/volume-data-autoupdate"
+DATA_LIST_FILE = "/etc/volume-data-list"
+MANIFEST_FILE = "/etc/volume-data.manifest"
+MANIFEST_VERSION = 1
+# relative to the data volume
+HASH_CACHE_FILE = "var/cache/ipa-container/volume-sync.cache"
+HASH_CACHE_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20
+# files modified less than this many seconds before the run started
+# are not cached: they could change again without changing their mtime
+HASH_CACHE_RACY = 2
+DEFAULT_JOBS = min(8, os.cpu_count() or 1)
+
+SHA256SUM_LINE = re.compile(r"([0-9a-fA-F]{64}) [ *](.+)")
+FILE_TYPES = {
+    stat.S_IFREG: "f",
+    stat.S_IFDIR: "d",
+    stat.S_IFLNK: "l",
+}
+
+
+def _normalize(path):
+    """Return `path`, as listed in the lists, as an absolute path with
+    no trailing slash (`$DATA$i` in the shell loops)."""
+    return "/" + os.path.normpath(path.strip()).lstrip("/")
+
+
+def read_autoupdate_list(path):
+    """
+    Read a `sha256sum` file.  Return a `dict` mapping every path to
+    the set of its hashes (a path may be listed once for each version
+    of the file that may be replaced).
+    """
+    hashes = {}
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            m = SHA256SUM_LINE.fullmatch(line)
+            if m is None:
+                LOG.warning(f"{path}:{lineno}: not a sha256sum line, ignored")
+                continue
+            hashes.setdefault(_normalize(m.group(2)), set()).add(m.group(1).lower())
+    return hashes
+
+
+def read_data_list(path):
+    """Read the list of the volume's paths.  Return them in order."""
+    with open(path) as f:
+        return [_normalize(line) for line in f if line.strip()]
+
+
+def _read_build_id(template):
+    try:
+        with open(os.path.join(template, "build-id")) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def hash_file(path):
+    """Return the sha256 hex digest of the contents of `path`."""
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(HASH_CHUNK_SIZE)
+            if not data:
+                return digest.hexdigest()
+            digest.update(data)
+
+
+class Manifest:
+    """
+    The template's paths that the volume update reads: `entries` maps
+    each of them to a `dict` with its `type` (`f`, `d`, `l` or `o`),
+    `size`, `mtime` (in ns), `uid`, `gid`, `mode`, and `hash` (regular
+    files) or `target` (symbolic links), as of `lstat()`.  Paths missing
+    from the template are not in `entries`.
+    """
+
+    def __init__(self, build_id, entries):
+        self.build_id = build_id
+        self.entries = entries
+
+    @classmethod
+    def scan(cls, template, paths):
+        """Describe `paths` of `template`, hashing its files."""
+        entries = {}
+        for path in sorted(set(paths)):
+            node = template + path
+            try:
+                st = os.lstat(node)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            entry = {
+                "type": FILE_TYPES.get(stat.S_IFMT(st.st_mode), "o"),
+                "size": st.st_size,
+                "mtime": st.st_mtime_ns,
+                "uid": st.st_uid,
+                "gid": st.st_gid,
+                "mode": stat.S_IMODE(st.st_mode),
+            }
+            if stat.S_ISREG(st.st_mode):
+                entry["hash"] = hash_file(node)
+            elif stat.S_ISLNK(st.st_mode):
+                entry["target"] = os.readlink(node)
+            entries[path] = entry
+        return cls(_read_build_id(template), entries)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"unsupported version {data.get('version')!r}")
+        return cls(data["build-id"], data["entries"])
+
+    def save(self, path):
+        data = {
+            "version": MANIFEST_VERSION,
+            "build-id": self.build_id,
+            "entries": self.entries,
+        }
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.write("\n")
+        os.replace(tmp, path)
+
+
+def load_manifest(path, template, paths):
+    """
+    Return the manifest stored in `path`, or, if it is missing or was
+    written for another build of the template, a manifest of `paths`
+    scanned from `template`.
+    """
+    build_id = _read_build_id(template)
+    try:
+        manifest = Manifest.load(path)
+    except FileNotFoundError:
+        LOG.warning(f"no manifest {path!r}, scanning {template!r}")
+    except (OSError, ValueError, KeyError) as e:
+        LOG.warning(f"ignoring manifest {path!r}: {e}")
+    else:
+        if manifest.build_id == build_id:
+            return manifest
+        LOG.warning(f"manifest {path!r} is not of this build, scanning {template!r}")
+    return Manifest.scan(template, paths)
+
+
+class HashCache:
+    """
+    sha256 digests of the volume's files, stored in a JSON file and
+    reused as long as the size and mtime of a file are unchanged.
+    Files modified right before the run are not cached (see
+    `HASH_CACHE_RACY`).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+        self._lock = threading.Lock()
+        self._racy = time.time_ns() - HASH_CACHE_RACY * 10**9
+        if path is None:
+            return
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("version") == HASH_CACHE_VERSION:
+                self.entries = data["entries"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            LOG.warning(f"ignoring hash cache {path!r}: {e}")
+
+    def digest(self, path, st):
+        """Return the sha256 digest of `path`, whose `stat()` result
+        is `st`."""
+        cached = self.entries.get(path)
+        if cached is not None and cached[:2] == [st.st_size, st.st_mtime_ns]:
+            return cached[2]
+        digest = hash_file(path)
+        self.store(path, st, digest)
+        return digest
+
+    def store(self, path, st, digest):
+        """Record that `path`, whose `stat()` result is `st`, has
+        `digest`."""
+        with self._lock:
+            if st.st_mtime_ns >= self._racy:
+                self.entries.pop(path, None)
+            else:
+                self.entries[path] = [st.st_size, st.st_mtime_ns, digest]
+            self.changed = True
+
+    def forget(self, path):
+        with self._lock:
+            self.changed |= self.entries.pop(path, None) is not None
+
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        tmp = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({"version": HASH_CACHE_VERSION, "entries": self.entries}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            LOG.warning(f"failed to save hash cache {self.path!r}: {e}")
+
+
+def copy_entry(src, dst, src_st, suffix):
+    """
+    Copy `src`, whose `lstat()` result is `src_st` (and everything
+    below it, for a directory), to `dst`.  The copy is made to a
+    temporary name, `.#<name>.<suffix>`, then renamed, so that an
+    interrupted copy never leaves a partial file or tree at `dst`.
+    """
+    tmp = os.path.join(os.path.dirname(dst), f".#{os.path.basename(dst)}.{suffix}")
+    if os.path.lexists(tmp):
+        remove_tree(tmp)
+    if stat.S_ISDIR(src_st.st_mode):
+        copy_tree(src, tmp)
+    else:
+        copy_node(src, tmp, src_st)
+    os.rename(tmp, dst)
+    if stat.S_ISDIR(src_st.st_mode):
+        invalidate_dir_fds()
+
+
+def set_owner_and_mode(node, st, uid, gid, mode, dry_run=False):
+    """Give `node`, whose `stat()` result is `st`, the owner `uid`:`gid`
+    and `mode`, where they differ.  Return True if anything differs."""
+    chown = (st.st_uid, st.st_gid) != (uid, gid)
+    # chown() clears the set-user-ID and set-group-ID bits
+    chmod = chown or stat.S_IMODE(st.st_mode) != mode
+    if not chown and not chmod:
+        return False
+    LOG.verbose(f"{node}: owner {uid}:{gid}, mode {mode:04o}")
+    if dry_run:
+        return True
+    if chown:
+        try:
+            os.chown(node, uid, gid)
+        except OSError as e:
+            report_failure(f"chown {node!r}", e)
+    try:
+        os.chmod(node, mode)
+    except OSError as e:
+        report_failure(f"chmod {node!r}", e)
+    return True
+
+
+class VolumeChange:
+    """Base of the changes made to a volume: `counts` holds the number
+    of paths changed, by kind."""
+
+    kinds = ()
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.counts = dict.fromkeys(self.kinds, 0)
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+
+class VolumeUpdate(VolumeChange):
+    """
+    Update the volume `data` from `template`, described by `manifest`
+    (see the module docstring).  `counts` holds the number of files
+    updated and removed, and of paths whose metadata was adjusted.
+    """
+
+    kinds = ("updated", "removed", "adjusted")
+
+    def __init__(self, data, template, manifest, cache, dry_run=False):
+        super().__init__(dry_run)
+        self.data = data
+        self.template = template
+        self.manifest = manifest
+        self.cache = cache
+
+    def update_files(self, hashes, jobs=1):
+        """Replace the files of `hashes` (see `read_autoupdate_list()`)
+        that still have one of their listed hashes."""
+        items = sorted(hashes.items())
+        if jobs <= 1:
+            for path, expected in items:
+                self.update_file(path, expected)
+            return
+
+        import concurrent.futures
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        try:
+            for future in [pool.submit(self.update_file, *item) for item in items]:
+                future.result()
+        finally:
+            shutdown_pool(pool)
+
+    def update_file(self, path, expected):
+        dst = self.data + path
+        try:
+            lst = os.lstat(dst)
+            st = os.stat(dst) if stat.S_ISLNK(lst.st_mode) else lst
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        except OSError as e:
+            report_failure(f"stat {dst!r}", e)
+            return
+        if not stat.S_ISREG(st.st_mode):
+            return
+        try:
+            digest = self.cache.digest(dst, st)
+        except OSError as e:
+            report_failure(f"hash {dst!r}", e)
+            return
+        if digest not in expected:
+            return  # modified in the volume, keep it
+
+        entry = self.manifest.entries.get(path)
+        if entry is None:
+            self.remove_file(dst)
+        elif (
+            stat.S_ISREG(lst.st_mode)
+            and entry.get("hash") == digest
+            and [entry["uid"], entry["gid"], entry["mode"]]
+            == [st.st_uid, st.st_gid, stat.S_IMODE(st.st_mode)]
+        ):
+            LOG.verbose(f"{dst}: up to date")
+        else:
+            self.copy_file(path, entry)
+
+    def remove_file(self, dst):
+        LOG.info(f"removing {dst}")
+        self._count("removed")
+        if self.dry_run:
+            return
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            report_failure(f"remove {dst!r}", e)
+        self.cache.forget(dst)
+
+    def copy_file(self, path, entry):
+        src, dst = self.template + path, self.data + path
+        LOG.info(f"updating {dst}")
+        self._count("updated")
+        if self.dry_run:
+            return
+        try:
+            src_st = lstat_at(src)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            copy_entry(src, dst, src_st, "update")
+        except OSError as e:
+            report_failure(f"update {dst!r}", e)
+            self.cache.forget(dst)
+            return
+        if entry.get("hash") is not None and stat.S_ISREG(src_st.st_mode):
+            self.cache.store(dst, os.stat(dst), entry["hash"])
+        else:
+            self.cache.forget(dst)
+
+    def adjust_metadata(self, paths):
+        """Give each of `paths` of the volume the ownership and mode of
+        its template counterpart, if both exist and they differ."""
+        for path in paths:
+            entry = self.manifest.entries.get(path)
+            if entry is None:
+                continue
+            node = self.data + path
+            try:
+                if entry["type"] == "l":
+                    # like `chown --reference`, use what the link points to
+                    ref = os.stat(self.template + path)
+                    uid, gid, mode = ref.st_uid, ref.st_gid, stat.S_IMODE(ref.st_mode)
+                else:
+                    uid, gid, mode = entry["uid"], entry["gid"], entry["mode"]
+                st = os.stat(node)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            except OSError as e:
+                report_failure(f"stat {node!r}", e)
+                continue
+            if set_owner_and_mode(node, st, uid, gid, mode, self.dry_run):
+                self._count("adjusted")
+
+
+class VolumePopulate(VolumeChange):
+    """
+    Create the entries of `template` that are missing from `volume`,
+    in place of `populate-volume-from-template`.  `template` is walked
+    once, with `os.scandir()`, and only below directories that exist
+    in `volume` too.  A missing entry is copied (with everything below
+    it, for a directory) with its ownership, mode and timestamps; with
+    `jobs` > 1, missing entries are copied concurrently while the walk
+    goes on.  Directories that exist get the ownership and mode of the
+    template; other existing entries are left alone.
+    """
+
+    kinds = ("created", "adjusted")
+
+    def __init__(self, template, volume, dry_run=False):
+        super().__init__(dry_run)
+        self.template = template
+        self.volume = volume
+
+    def run(self, jobs=1):
+        if not os.path.isdir(self.volume) and not self.dry_run:
+            os.makedirs(self.volume)
+        pool = None
+        if jobs > 1:
+            import concurrent.futures
+
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        pending = collections.deque()
+        try:
+            for src, dst, st in self._missing():
+                if pool is None:
+                    self.create(src, dst, st)
+                    continue
+                if len(pending) >= 4 * jobs:
+                    pending.popleft().result()
+                pending.append(pool.submit(self.create, src, dst, st))
+            while pending:
+                pending.popleft().result()
+        finally:
+            if pool is not None:
+                shutdown_pool(pool)
+
+    def _missing(self):
+        """Yield `(src, dst, lstat_result)` for the entries of the
+        template that are missing from the volume, adjusting the
+        directories that exist on the way."""
+        stack = [""]
+        while stack:
+            relative = stack.pop()
+            try:
+                it = os.scandir(self.template + relative)
+            except OSError as e:
+                report_failure(f"read {self.template + relative!r}", e)
+                continue
+            with it:
+                for entry in it:
+                    src = entry.path
+                    dst = self.volume + relative + "/" + entry.name
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        report_failure(f"stat {src!r}", e)
+                        continue
+                    try:
+                        dst_st = os.lstat(dst)
+                    except (FileNotFoundError, NotADirectoryError):
+                        yield src, dst, st
+                        continue
+                    except OSError as e:
+                        report_failure(f"stat {dst!r}", e)
+                        continue
+                    if not stat.S_ISDIR(st.st_mode) or not stat.S_ISDIR(
+                        dst_st.st_mode
+                    ):
+                        continue
+                    if set_owner_and_mode(
+                        dst,
+                        dst_st,
+                        st.st_uid,
+                        st.st_gid,
+                        stat.S_IMODE(st.st_mode),
+                        self.dry_run,
+                    ):
+                        self._count("adjusted")
+                    stack.append(relative + "/" + entry.name)
+
+    def create(self, src, dst, st):
+        LOG.verbose(f"creating {dst}")
+        self._count("created")
+        if self.dry_run:
+            return
+        try:
+            copy_entry(src, dst, st, "populate")
+        except OSError as e:
+            report_failure(f"create {dst!r}", e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="data volume update")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument(
+        "--update",
+        action="store_true",
+        help="update the data volume from the template",
+    )
+    mode.add_argument(
+        "--write-manifest",
+        action="store_true",
+        help="describe the template's listed paths in the manifest",
+    )
+    mode.add_argument(
+        "--populate",
+        metavar="DIR",
+        help="create the entries of the template (default: DIR-template) "
+        "that are missing from DIR",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--data", default=DATA_DIR, metavar="DIR")
+    parser.add_argument(
+        "--template",
+        metavar="DIR",
+        help=f"the template (default: {TEMPLATE_DIR})",
+    )
+    parser.add_argument("--autoupdate-list", default=AUTOUPDATE_FILE, metavar="FILE")
+    parser.add_argument("--data-list", default=DATA_LIST_FILE, metavar="FILE")
+    parser.add_argument("--manifest", default=MANIFEST_FILE, metavar="FILE")
+    parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help="cache the hashes of the volume's files in FILE (default: "
+        f"{HASH_CACHE_FILE} in the volume, '-' for none)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        metavar="N",
+        help="hash and copy files using N threads",
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="only log errors",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="also log the paths that are left alone",
+    )
+    args = parser.parse_args()
+    if args.quiet:
+        LOG.level = Log.QUIET
+    elif args.verbose:
+        LOG.level = Log.VERBOSE
+    atexit.register(LOG.flush)
+
+    if args.populate:
+        volume = args.populate.rstrip("/")
+        populate = VolumePopulate(
+            (args.template or f"{volume}-template").rstrip("/"), volume, args.dry_run
+        )
+        populate.run(args.jobs)
+        summary = dict(populate.counts, errors=LOG.counts["error"])
+        LOG.info(", ".join(f"{n} {key}" for key, n in summary.items()))
+        return
+
+    template = (args.template or TEMPLATE_DIR).rstrip("/")
+    try:
+        hashes = read_autoupdate_list(args.autoupdate_list)
+        paths = read_data_list(args.data_list)
+    except OSError as e:
+        sys.exit(f"failed to read the volume lists: {e}")
+
+    if args.write_manifest:
+        manifest = Manifest.scan(template, list(hashes) + paths)
+        if not args.dry_run:
+            manifest.save(args.manifest)
+        LOG.info(f"{len(manifest.entries)} paths in {args.manifest}")
+        return
+
+    data = args.data.rstrip("/")
+    manifest = load_manifest(args.manifest, template, list(hashes) + paths)
+    if args.cache == "-":
+        cache = HashCache(None)
+    else:
+        cache = HashCache(args.cache or os.path.join(data, HASH_CACHE_FILE))
+    update = VolumeUpdate(data, template, manifest, cache, args.dry_run)
+    update.update_files(hashes, args.jobs)
+    update.adjust_metadata(paths)
+    if not args.dry_run:
+        cache.save()
+
+    summary = dict(update.counts, errors=LOG.counts["error"])
+    LOG.info(", ".join(f"{n} {key}" for key, n in summary.items()))
+
+
+if __name__ == "__main__":
+    main()
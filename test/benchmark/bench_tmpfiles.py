@@ -0,0 +1,307 @@
+#!/bin/python3
+
+"""
+
+Benchmark for `init/tmpfiles.py`.
+
+Generates a synthetic `tmpfiles.d` directory (thousands of lines, every
+line type of `ACTION_MAP`, conflicting lines across config files) and
+seed trees (a deep and a wide one, used by `C`, `Z`, `A` and `H` lines)
+in a temporary directory, then times the parse, plan (merge, or load
+from the cache), remove and apply phases of these scenarios:
+
+  create        `--create` on an empty root
+  create-again  `--create` on an up to date root (the usual restart)
+  cache-hit     `--create --cache` on an up to date root, with the
+                plan cache up to date
+  dry-run       `--create --dry-run` on an up to date root
+  prefix        `--create --prefix` of a single config's subtree
+  remove        `--remove --create` on an up to date root, with the
+                paths of the `r` and `R` lines present
+
+Every sample runs the script's `main()` with `--stats` in a fresh copy
+of the script, so that no cache (names, directory fds, globs) is
+shared between samples.  The median of `--repeat` samples is
+reported.
+
+`--save-baseline FILE` stores the results; `--baseline FILE` compares
+against them and exits with status 1 if a phase got slower than
+`--threshold` percent (and by more than `MIN_REGRESSION` seconds).
+
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+
+SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "init", "tmpfiles.py"
+)
+SCENARIOS = ("create", "create-again", "cache-hit", "dry-run", "prefix", "remove")
+PHASES = ("parse", "plan", "remove", "apply")
+
+# differences below this many seconds are noise, not regressions
+MIN_REGRESSION = 0.005
+
+# (type, weight, line template); {c} is the config's subtree, {i} the
+# line number, {d} one of the config's directories, {s} the seed trees
+LINE_TEMPLATES = (
+    ("d", 20, "d {c}/d{i} 0755 root root -"),
+    ("D", 2, "D {c}/D{i} 0750 - - -"),
+    ("f", 15, "f {d}/f{i} 0644 root root - content {i}"),
+    ("f+", 3, "f+ {d}/t{i} 0600 - - - truncated {i}"),
+    ("F", 1, "F {d}/T{i} 0600 - - - truncated {i}"),
+    ("w", 3, "w {d}/f* - - - - written {i}"),
+    ("w+", 2, "w+ {d}/t* - - - - appended {i}"),
+    ("e", 2, "e {d} 0755 - - -"),
+    ("v", 1, "v {c}/v{i} 0755 - - -"),
+    ("q", 1, "q {c}/q{i} 0755 - - -"),
+    ("Q", 1, "Q {c}/Q{i} 0755 - - -"),
+    ("L", 8, "L {c}/l{i} - - - - {d}"),
+    ("L+", 2, "L+ {c}/L{i} - - - - {d}"),
+    ("c", 1, "c {c}/null{i} 0666 - - - 1:3"),
+    ("C", 1, "C {c}/copy{i} - - - - {s}/wide"),
+    ("x", 1, "x {d}/ignored*"),
+    ("X", 1, "X {d}/ignored"),
+    ("r", 2, "r {c}/gone{i}"),
+    ("R", 1, "R {c}/gone-tree{i}"),
+    ("z", 8, "z {d} 0750 - - -"),
+    ("m", 1, "m {d} 0750 - - -"),
+    ("Z", 1, "Z {s}/deep 0755 - - -"),
+    ("h", 2, "h {d} - - - - +d"),
+    ("H", 1, "H {s}/deep - - - - +d"),
+    ("a", 2, "a {d} - - - - u:0:rwx"),
+    ("a+", 2, "a+ {d} - - - - g:0:rx"),
+    ("A", 1, "A {s}/deep - - - - u:0:rx"),
+    ("A+", 1, "A+ {s}/deep - - - - g:0:rx"),
+)
+
+
+def load_tmpfiles():
+    """Load a fresh instance of the tmpfiles script as a module."""
+    spec = importlib.util.spec_from_file_location("tmpfiles", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_configs(confdir, root, seeds, lines, configs):
+    """
+    Write `configs` config files with `lines` lines in total.  Every
+    config file manages its own subtree of `root`, and also has a few
+    lines for paths shared with the other configs, which conflict.
+    """
+    types = [t for t, weight, _template in LINE_TEMPLATES for _ in range(weight)]
+    templates = {t: template for t, _weight, template in LINE_TEMPLATES}
+    per_config = max(1, lines // configs)
+    for k in range(configs):
+        subtree = os.path.join(root, f"c{k}")
+        directories = [f"{subtree}/d{i}" for i in range(0, per_config, len(types))]
+        out = [f"# synthetic config {k}", f"d {subtree} 0755 - - -"]
+        out += [f"d {d} 0755 - - -" for d in directories]
+        for i in range(per_config):
+            typ = types[(i + k) % len(types)]
+            out.append(
+                templates[typ].format(
+                    c=subtree, i=i, d=directories[i % len(directories)], s=seeds
+                )
+            )
+        for i in range(10):
+            out.append(f"d {root}/shared/d{i} 07{k % 8}5 - - -")
+        path = os.path.join(confdir, f"{k:03d}-bench.conf")
+        with open(path, "w") as f:
+            f.write("\n".join(out) + "\n")
+
+
+def generate_seeds(seeds, depth, width):
+    """Create a `depth` levels deep tree and a directory with `width`
+    files under `seeds`."""
+    path = os.path.join(seeds, "deep")
+    for level in range(depth):
+        path = os.path.join(path, f"l{level}")
+        os.makedirs(path)
+        for i in range(4):
+            with open(os.path.join(path, f"f{i}"), "w") as f:
+                f.write(f"{level} {i}\n")
+    wide = os.path.join(seeds, "wide")
+    os.makedirs(wide)
+    for i in range(width):
+        with open(os.path.join(wide, f"f{i}"), "w") as f:
+            f.write(f"{i}\n" * 16)
+
+
+def run_sample(confdir, args):
+    """Run the script's `main()` once with the command line `args`.
+    Return a `dict` of phase timings in seconds, from `--stats`."""
+    tmpfiles = load_tmpfiles()
+    tmpfiles.TMPFILES_DIRS = (confdir,)
+    argv = sys.argv
+    sys.argv = ["tmpfiles", *args, "--quiet", "--stats"]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            tmpfiles.main()
+    finally:
+        sys.argv = argv
+    summary = tmpfiles.STATS.summary()
+    # the plan phase includes parsing the configs (if not cached)
+    parse = summary["total"]["parse_seconds"]
+    timings = {phase: summary["phases"].get(phase, 0.0) for phase in PHASES}
+    timings["parse"] = parse
+    timings["plan"] -= parse
+    return timings
+
+
+def create_removed_paths(confdir):
+    """Create the paths of the `r` and `R` lines of the configs in
+    `confdir`, for `--remove` to remove."""
+    for config in sorted(os.listdir(confdir)):
+        with open(os.path.join(confdir, config)) as f:
+            lines = [line.split() for line in f]
+        for fields in lines:
+            if not fields:
+                continue
+            if fields[0] == "r":
+                open(fields[1], "w").close()
+            elif fields[0] == "R":
+                os.makedirs(os.path.join(fields[1], "sub"), exist_ok=True)
+                for i in range(4):
+                    open(os.path.join(fields[1], "sub", f"f{i}"), "w").close()
+
+
+def run_scenario(scenario, workdir, repeat):
+    """Return the median phase timings of `scenario`."""
+    confdir = os.path.join(workdir, "tmpfiles.d")
+    root = os.path.join(workdir, "root")
+    cache = os.path.join(workdir, "tmpfiles.cache")
+    args = {
+        "create": ["--create"],
+        "create-again": ["--create"],
+        "cache-hit": ["--create", "--cache", cache],
+        "dry-run": ["--create", "--dry-run"],
+        "prefix": ["--create", "--prefix", os.path.join(root, "c0")],
+        "remove": ["--remove", "--create"],
+    }[scenario]
+    samples = []
+    for _ in range(repeat):
+        if scenario in ("create", "prefix"):
+            shutil.rmtree(root, ignore_errors=True)
+            os.makedirs(root)
+        else:
+            # bring the root (and the cache) up to date first
+            if scenario == "cache-hit":
+                run_sample(confdir, args)
+            else:
+                run_sample(confdir, ["--create"])
+            if scenario == "remove":
+                create_removed_paths(confdir)
+        samples.append(run_sample(confdir, args))
+    result = {
+        phase: statistics.median(sample[phase] for sample in samples)
+        for phase in PHASES
+    }
+    result["total"] = statistics.median(sum(s.values()) for s in samples)
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Print `results` next to `baseline`.  Return True if any phase
+    is more than `threshold` percent slower."""
+    regressed = False
+    print(f"{'scenario':<14}{'phase':<8}{'seconds':>10}{'baseline':>10}{'change':>9}")
+    for scenario, phases in results.items():
+        for phase, seconds in phases.items():
+            line = f"{scenario:<14}{phase:<8}{seconds:>10.4f}"
+            old = (baseline or {}).get(scenario, {}).get(phase)
+            if old:
+                change = (seconds - old) / old * 100
+                line += f"{old:>10.4f}{change:>+8.1f}%"
+                if change > threshold and seconds - old > MIN_REGRESSION:
+                    line += "  SLOWER"
+                    regressed = True
+            print(line)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tmpfiles.py benchmark")
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--configs", type=int, default=25)
+    parser.add_argument("--depth", type=int, default=64, help="deep seed tree")
+    parser.add_argument("--width", type=int, default=200, help="wide seed tree")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="only run SCENARIO (default: all)",
+    )
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--baseline", metavar="FILE")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="percentage above the baseline reported as a regression",
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the work dir")
+    args = parser.parse_args()
+
+    params = {
+        "lines": args.lines,
+        "configs": args.configs,
+        "depth": args.depth,
+        "width": args.width,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved["params"] != params:
+            print(f"warning: baseline was made with {saved['params']}")
+        baseline = saved["results"]
+
+    workdir = tempfile.mkdtemp(prefix="bench-tmpfiles.")
+    try:
+        confdir = os.path.join(workdir, "tmpfiles.d")
+        seeds = os.path.join(workdir, "seeds")
+        os.makedirs(confdir)
+        generate_seeds(seeds, args.depth, args.width)
+        generate_configs(
+            confdir, os.path.join(workdir, "root"), seeds, args.lines, args.configs
+        )
+        results = {
+            scenario: run_scenario(scenario, workdir, args.repeat)
+            for scenario in args.scenario or SCENARIOS
+        }
+    finally:
+        if args.keep:
+            print(f"work dir: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    regressed = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(
+                {
+                    "params": params,
+                    "python": platform.python_version(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
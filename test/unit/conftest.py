@@ -0,0 +1,80 @@
+"""
+
+Fixtures for the tests of the Python scripts of `init/`.
+
+`tmpfiles.py` is loaded afresh for every run, as every run is a new
+process in the container, with its configs read from a temporary
+`tmpfiles.d` directory.  The other scripts are run as processes.
+
+"""
+
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+INIT_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "init")
+)
+
+
+def load_script(name):
+    """Load a fresh instance of the script `init/<name>.py` as a module."""
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(INIT_DIR, f"{name}.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_script(name, *args):
+    """Run `init/<name>.py` with `args`.  Return the completed process."""
+    return subprocess.run(
+        [sys.executable, os.path.join(INIT_DIR, f"{name}.py"), *map(str, args)],
+        capture_output=True,
+        text=True,
+    )
+
+
+class Tmpfiles:
+    """Runs of `tmpfiles.py` against the configs written by `config()`;
+    `{root}` in a config is replaced by the `root` directory."""
+
+    def __init__(self, tmp_path, capsys, monkeypatch):
+        self.root = tmp_path / "root"
+        self.root.mkdir()
+        self.confdir = tmp_path / "tmpfiles.d"
+        self.confdir.mkdir()
+        self.module = None
+        self._capsys = capsys
+        self._monkeypatch = monkeypatch
+
+    def config(self, text, name="test.conf"):
+        (self.confdir / name).write_text(text.replace("{root}", str(self.root)))
+
+    def load(self):
+        """Load a fresh instance of the script, as `run()` does."""
+        self.module = load_script("tmpfiles")
+        self.module.TMPFILES_DIRS = (str(self.confdir),)
+        return self.module
+
+    def run(self, *args, module=None):
+        """Run `main()` with `args`, in `module` if given (as returned
+        by `load()`).  Return `(status, output)`."""
+        module = module or self.load()
+        self._monkeypatch.setattr(sys, "argv", ["tmpfiles", *map(str, args)])
+        try:
+            module.main()
+            status = 0
+        except SystemExit as e:
+            status = e.code or 0
+        module.LOG.flush()
+        return status, self._capsys.readouterr().out
+
+
+@pytest.fixture
+def tmpfiles(tmp_path, capsys, monkeypatch):
+    return Tmpfiles(tmp_path, capsys, monkeypatch)
@@ -108,6 +108,17 @@ load '../libs/bats-mock/load'
 }
 
 
+@test "container_helper_invoke_populate_volume_from_template - no directory" {
+    source './init/utils.inc.sh'
+    source './init/tasks.inc.sh'
+    source './init/container.inc.sh'
+
+    run container_helper_invoke_populate_volume_from_template ""
+    assert_failure
+    assert_output ""
+}
+
+
 @test "container_step_workaround_1372562" {
     source './init/utils.inc.sh'
     source './init/tasks.inc.sh'
@@ -9,7 +9,7 @@ load '../libs/bats-mock/load'
 
 function setup
 {
-    mock stub tasks_helper_update_step tasks_helper_add_after
+    mock stub tasks_helper_update_step tasks_helper_add_after tasks_helper_add_prerequisites
     mock_tasks_helper_update_step 0 "container_step_enable_traces" \
                                     "ocp4_step_enable_traces"
     mock_tasks_helper_update_step 0 "container_step_process_hostname" \
@@ -19,16 +19,21 @@ function setup
         "ocp4_step_process_first_boot"
 
     mock_tasks_helper_add_after 0 "container_step_volume_update" \
-                                  "ocp4_step_systemd_units_set_private_tmp_off" \
-                                  "ocp4_step_systemd_units_set_private_system_off" \
-                                  "ocp4_step_systemd_units_set_private_devices_off" \
+                                  "ocp4_step_systemd_units_write_dropins" \
                                   "ocp4_step_systemd_tmpfiles_create"
+
+    mock_tasks_helper_add_prerequisites 0 \
+        "ocp4_step_systemd_units_write_dropins" \
+        "container_step_volume_update"
+    mock_tasks_helper_add_prerequisites 0 \
+        "ocp4_step_systemd_tmpfiles_create" \
+        "container_step_volume_update"
 }
 
 
 function teardown
 {
-    mock unstub tasks_helper_update_step tasks_helper_add_after
+    mock unstub tasks_helper_update_step tasks_helper_add_after tasks_helper_add_prerequisites
 }
 
 
@@ -226,122 +231,12 @@ function teardown
 }
 
 
-@test "ocp4_step_systemd_units_set_private_devices_off" {
-    source './init/ocp4.inc.sh'
-
-    mock stub ocp4_helper_switch_starting_by_substr
-    mock_ocp4_helper_switch_starting_by_substr 0 "PrivateDevices=true" "PrivateDevices=off" "/usr/lib/systemd/system/dbus-broker.service"
-    run ocp4_step_systemd_units_set_private_devices_off
-
-    assert_mock ocp4_helper_switch_starting_by_substr
-    assert_success
-}
-
-
-@test "ocp4_step_systemd_units_set_private_system_off" {
-    source './init/ocp4.inc.sh'
-
-    mock stub ocp4_helper_switch_starting_by_substr
-    mock_ocp4_helper_switch_starting_by_substr 0 "ProtectSystem=full" "# ProtectSystem=full" "/usr/lib/systemd/system/dbus-broker.service"
-    run ocp4_step_systemd_units_set_private_system_off
-
-    assert_mock ocp4_helper_switch_starting_by_substr
-    assert_success
-    mock unstub ocp4_helper_switch_starting_by_substr
-}
-
-
-@test "ocp4_helper_turn_private_tmp_off_for_one_file" {
-    source './init/ocp4.inc.sh'
-
-    local _filename="/tmp/systemd.unit"
-    mock stub ocp4_helper_switch_starting_by_substr
-    mock_ocp4_helper_switch_starting_by_substr 0 "PrivateTmp=on" "PrivateTmp=off" "${_filename}"
-    mock_ocp4_helper_switch_starting_by_substr 0 "PrivateTmp=yes" "PrivateTmp=off" "${_filename}"
-    mock_ocp4_helper_switch_starting_by_substr 0 "PrivateTmp=true" "PrivateTmp=off" "${_filename}"
-
-    run ocp4_helper_turn_private_tmp_off_for_one_file "${_filename}"
-    assert_success
-    assert_output ""
-    assert_mock ocp4_helper_switch_starting_by_substr
-    mock unstub ocp4_helper_switch_starting_by_substr
-}
-
-
-@test "ocp4_helper_turn_private_tmp_off - no files" {
-    source './init/ocp4.inc.sh'
-
-    local _filename=()
-    mock stub utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-
-
-    run ocp4_helper_turn_private_tmp_off "${_filename[@]}"
-    assert_success
-    assert_output ""
-    assert_mock utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-    mock unstub utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-}
-
-
-@test "ocp4_helper_turn_private_tmp_off - a file that does not exist" {
-    source './init/ocp4.inc.sh'
-
-    local _filename=("/tmp/does_not_exist")
-    mock stub utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-    mock_utils_path_exists 1 "${_filename[0]}"
-    local _msg="File '${_filename[0]}' not found at 'ocp4_helper_turn_private_tmp_off'"
-    mock_tasks_helper_msg_warning 0 "${_msg}"
-    mock_tasks_helper_msg_warning output <<EOF
-WARNING:${_msg}
-EOF
-
-    run ocp4_helper_turn_private_tmp_off "${_filename[@]}"
-    assert_success
-    assert_output "WARNING:${_msg}"
-    assert_mock utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-    mock unstub utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-}
-
-
-@test "ocp4_helper_turn_private_tmp_off - a file that exist" {
-    source './init/ocp4.inc.sh'
-
-    local _filename=("/tmp/does_exist_1")
-    mock stub utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-    mock_utils_path_exists 0 "${_filename[0]}"
-    mock_ocp4_helper_turn_private_tmp_off_for_one_file 0 "${_filename[0]}"
-
-    run ocp4_helper_turn_private_tmp_off "${_filename[@]}"
-    assert_success
-    assert_output ""
-    assert_mock utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-    mock unstub utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-}
-
-
-@test "ocp4_helper_turn_private_tmp_off - several files that exist" {
+@test "ocp4_step_systemd_units_write_dropins" {
     source './init/ocp4.inc.sh'
 
-    local _filename=("/tmp/does_exist_1" "/tmp/does_exist_2")
-    mock stub utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-    mock_utils_path_exists 0 "${_filename[0]}"
-    mock_utils_path_exists 0 "${_filename[1]}"
-    mock_ocp4_helper_turn_private_tmp_off_for_one_file 0 "${_filename[0]}"
-    mock_ocp4_helper_turn_private_tmp_off_for_one_file 0 "${_filename[1]}"
-
-    run ocp4_helper_turn_private_tmp_off "${_filename[@]}"
-    assert_success
-    assert_output ""
-    assert_mock utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-    mock unstub utils_path_exists tasks_helper_msg_warning ocp4_helper_turn_private_tmp_off_for_one_file
-}
-
-
-@test "ocp4_step_systemd_units_set_private_tmp_off" {
-    source './init/ocp4.inc.sh'
-
-    mock stub ocp4_helper_turn_private_tmp_off
-    mock_ocp4_helper_turn_private_tmp_off 0 \
+    mock stub ocp4_helper_generate_unit_dropins
+    mock_ocp4_helper_generate_unit_dropins 0 \
+        --private-tmp-off \
         /lib/systemd/system/dirsrv@.service \
         /lib/systemd/system/ipa-custodia.service \
         /usr/lib/systemd/system/dbus-broker.service \
@@ -364,15 +259,33 @@ EOF
         /lib/systemd/system/systemd-timedated.service \
         /lib/systemd/system/logrotate.service \
         /lib/systemd/system/named.service \
-        /lib/systemd/system/httpd@.service
+        /lib/systemd/system/httpd@.service \
+        --private-devices-off /usr/lib/systemd/system/dbus-broker.service \
+        --protect-system-off /usr/lib/systemd/system/dbus-broker.service
 
-    run ocp4_step_systemd_units_set_private_tmp_off
+    run ocp4_step_systemd_units_write_dropins
     assert_success
-    assert_mock ocp4_helper_turn_private_tmp_off \
+    assert_mock ocp4_helper_generate_unit_dropins \
                 tasks_helper_update_step \
                 tasks_helper_add_after
 
-    mock unstub ocp4_helper_turn_private_tmp_off
+    mock unstub ocp4_helper_generate_unit_dropins
+}
+
+
+@test "ocp4_step_systemd_tmpfiles_create" {
+    source './init/ocp4.inc.sh'
+    TMPFILES_CACHE_FILE="/data/var/cache/ipa-container/tmpfiles.cache"
+    TMPFILES_JOURNAL_FILE="/data/var/cache/ipa-container/tmpfiles.journal"
+
+    mock stub ocp4_helper_run_tmpfiles
+    mock_ocp4_helper_run_tmpfiles 0 --create --remove --boot \
+        --cache "/data/var/cache/ipa-container/tmpfiles.cache" \
+        --journal "/data/var/cache/ipa-container/tmpfiles.journal"
+    run ocp4_step_systemd_tmpfiles_create
+    assert_success
+    assert_mock ocp4_helper_run_tmpfiles
+    mock unstub ocp4_helper_run_tmpfiles
 }
 
 
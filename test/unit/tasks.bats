@@ -788,3 +788,307 @@ module_step_anything_3
 EOF
 }
 
+
+@test "tasks_helper_format_seconds" {
+    source './init/tasks.inc.sh'
+
+    function format_and_print
+    {
+        local value
+        tasks_helper_format_seconds value "$1"
+        echo "${value}"
+    }
+    export -f format_and_print
+
+    run format_and_print 0
+    assert_output "0.00"
+
+    run format_and_print 5
+    assert_output "0.05"
+
+    run format_and_print 12345
+    assert_output "123.45"
+}
+
+@test "tasks_helper_execute - timeline" {
+    source './init/tasks.inc.sh'
+
+    TASKS_TIMELINE_FILE="${BATS_TMPDIR}/init-timeline.json"
+    rm -f "${TASKS_TIMELINE_FILE}"
+
+    function module_step_anything_1 {
+        :
+    }
+    export -f module_step_anything_1
+
+    function module_step_anything_2 {
+        return 3
+    }
+    export -f module_step_anything_2
+
+    tasks_helper_add_tasks "module_step_anything_1"
+    run tasks_helper_execute
+    assert_success
+    run grep -c '"step": ' "${TASKS_TIMELINE_FILE}"
+    assert_output "1"
+    run grep -q '"step": "module_step_anything_1", .*"status": 0,' "${TASKS_TIMELINE_FILE}"
+    assert_success
+
+    tasks_helper_add_tasks "module_step_anything_2" "module_step_anything_1"
+    run tasks_helper_execute
+    assert_failure
+    assert_output << EOF
+INFO:Running step: 'module_step_anything_1'
+INFO:Running step: 'module_step_anything_2'
+ERROR:Executing step at: 'module_step_anything_2'
+EOF
+    # the timeline stops at the failed step
+    run grep -c '"step": ' "${TASKS_TIMELINE_FILE}"
+    assert_output "2"
+    run grep -q '"step": "module_step_anything_2", .*"status": 3,' "${TASKS_TIMELINE_FILE}"
+    assert_success
+
+    rm -f "${TASKS_TIMELINE_FILE}"
+}
+
+@test "tasks_helper_execute - no timeline directory" {
+    source './init/tasks.inc.sh'
+
+    TASKS_TIMELINE_FILE="${BATS_TMPDIR}/does-not-exist/init-timeline.json"
+
+    function module_step_anything_1 {
+        :
+    }
+    export -f module_step_anything_1
+
+    tasks_helper_add_tasks "module_step_anything_1"
+    run tasks_helper_execute
+    assert_success
+    assert_output "INFO:Running step: 'module_step_anything_1'"
+    [ ! -e "${TASKS_TIMELINE_FILE}" ]
+}
+
+@test "tasks_helper_timeline_summary" {
+    source './init/tasks.inc.sh'
+
+    TASKS_TIMELINE_FILE="${BATS_TMPDIR}/init-timeline.json"
+
+    run tasks_helper_timeline_summary
+    assert_success
+    assert_output ""
+
+    function module_step_anything_1 {
+        :
+    }
+    export -f module_step_anything_1
+
+    function module_step_anything_2 {
+        sleep 0.1
+    }
+    export -f module_step_anything_2
+
+    function execute_and_summarize
+    {
+        tasks_helper_execute 2>/dev/null \
+        && tasks_helper_timeline_summary
+    }
+    export -f execute_and_summarize
+
+    tasks_helper_add_tasks "module_step_anything_1" "module_step_anything_2"
+    run execute_and_summarize
+    assert_success
+    assert_output --regexp "^INFO:Startup timeline: 2 steps in [0-9]+\.[0-9]{2}s, [0-9]+ forks; slowest: 'module_step_anything_2' \([0-9]+\.[0-9]{2}s\); see '${TASKS_TIMELINE_FILE}'$"
+
+    rm -f "${TASKS_TIMELINE_FILE}"
+}
+
+@test "tasks_helper_add_prerequisites" {
+    source './init/tasks.inc.sh'
+
+    function module_nostep_anything {
+        :
+    }
+    export -f module_nostep_anything
+
+    function module_step_anything_1 {
+        :
+    }
+    export -f module_step_anything_1
+
+    function module_step_anything_2 {
+        :
+    }
+    export -f module_step_anything_2
+
+    run tasks_helper_add_prerequisites "module_nostep_anything"
+    assert_failure
+
+    run tasks_helper_add_prerequisites "module_step_anything_2" "module_nostep_anything"
+    assert_failure
+
+    run tasks_helper_has_prerequisites "module_step_anything_2"
+    assert_failure
+
+    tasks_helper_add_prerequisites "module_step_anything_1"
+    run tasks_helper_has_prerequisites "module_step_anything_1"
+    assert_success
+
+    tasks_helper_add_prerequisites "module_step_anything_2" "module_step_anything_1"
+    run tasks_helper_has_prerequisites "module_step_anything_2"
+    assert_success
+    [ "${TASKS_PREREQUISITES[module_step_anything_2]}" == "module_step_anything_1" ]
+}
+
+@test "tasks_helper_update_step - prerequisites" {
+    source './init/tasks.inc.sh'
+
+    function module_step_anything_1 {
+        :
+    }
+    export -f module_step_anything_1
+
+    function module_step_anything_2 {
+        :
+    }
+    export -f module_step_anything_2
+
+    function module_step_anything_3 {
+        :
+    }
+    export -f module_step_anything_3
+
+    tasks_helper_add_tasks "module_step_anything_1" "module_step_anything_2"
+    tasks_helper_add_prerequisites "module_step_anything_1"
+    tasks_helper_add_prerequisites "module_step_anything_2" "module_step_anything_1"
+    tasks_helper_update_step "module_step_anything_1" "module_step_anything_3"
+
+    run tasks_helper_list
+    assert_output "module_step_anything_3, module_step_anything_2"
+    run tasks_helper_has_prerequisites "module_step_anything_3"
+    assert_success
+    [ "${TASKS_PREREQUISITES[module_step_anything_2]}" == "module_step_anything_3" ]
+}
+
+@test "tasks_helper_execute - TASKS_MAX_JOBS" {
+    source './init/tasks.inc.sh'
+
+    TASKS_TIMELINE_FILE="${BATS_TMPDIR}/does-not-exist/init-timeline.json"
+
+    function module_step_anything_1 {
+        echo "${FUNCNAME[0]}"
+    }
+    export -f module_step_anything_1
+
+    function module_step_anything_2 {
+        sleep 0.2
+        echo "${FUNCNAME[0]}"
+    }
+    export -f module_step_anything_2
+
+    function module_step_anything_3 {
+        echo "${FUNCNAME[0]}"
+    }
+    export -f module_step_anything_3
+
+    function module_step_anything_4 {
+        echo "${FUNCNAME[0]}"
+    }
+    export -f module_step_anything_4
+
+    tasks_helper_add_tasks "module_step_anything_1" "module_step_anything_2" "module_step_anything_3" "module_step_anything_4"
+    tasks_helper_add_prerequisites "module_step_anything_2"
+    tasks_helper_add_prerequisites "module_step_anything_3"
+
+    # One job: the steps run in order, as without prerequisites
+    TASKS_MAX_JOBS=1
+    run tasks_helper_execute
+    assert_success
+    assert_output << EOF
+INFO:Running step: 'module_step_anything_1'
+module_step_anything_1
+INFO:Running step: 'module_step_anything_2'
+module_step_anything_2
+INFO:Running step: 'module_step_anything_3'
+module_step_anything_3
+INFO:Running step: 'module_step_anything_4'
+module_step_anything_4
+EOF
+
+    # Two jobs: step 3 does not wait for step 2, but step 4 (which has
+    # no prerequisites declared) waits for both
+    TASKS_MAX_JOBS=2
+    run tasks_helper_execute
+    assert_success
+    assert_output << EOF
+INFO:Running step: 'module_step_anything_1'
+module_step_anything_1
+INFO:Running step: 'module_step_anything_2'
+INFO:Running step: 'module_step_anything_3'
+module_step_anything_3
+module_step_anything_2
+INFO:Running step: 'module_step_anything_4'
+module_step_anything_4
+EOF
+
+    # Step 3 now waits for step 2
+    tasks_helper_add_prerequisites "module_step_anything_3" "module_step_anything_2"
+    run tasks_helper_execute
+    assert_success
+    assert_output << EOF
+INFO:Running step: 'module_step_anything_1'
+module_step_anything_1
+INFO:Running step: 'module_step_anything_2'
+module_step_anything_2
+INFO:Running step: 'module_step_anything_3'
+module_step_anything_3
+INFO:Running step: 'module_step_anything_4'
+module_step_anything_4
+EOF
+
+    TASKS_MAX_JOBS=0
+    run tasks_helper_execute
+    assert_failure
+}
+
+@test "tasks_helper_execute - TASKS_MAX_JOBS and failures" {
+    source './init/tasks.inc.sh'
+
+    TASKS_TIMELINE_FILE="${BATS_TMPDIR}/does-not-exist/init-timeline.json"
+    TASKS_MAX_JOBS=2
+
+    function module_step_anything_1 {
+        sleep 2
+        echo "${FUNCNAME[0]}"
+    }
+    export -f module_step_anything_1
+
+    function module_step_anything_2 {
+        return 1
+    }
+    export -f module_step_anything_2
+
+    function module_step_anything_3 {
+        echo "${FUNCNAME[0]}"
+    }
+    export -f module_step_anything_3
+
+    # The failure is reported right away, and the other steps are stopped
+    tasks_helper_add_tasks "module_step_anything_1" "module_step_anything_2" "module_step_anything_3"
+    tasks_helper_add_prerequisites "module_step_anything_1"
+    tasks_helper_add_prerequisites "module_step_anything_2"
+    run tasks_helper_execute
+    assert_failure
+    assert_output << EOF
+INFO:Running step: 'module_step_anything_1'
+INFO:Running step: 'module_step_anything_2'
+ERROR:Executing step at: 'module_step_anything_2'
+EOF
+
+    # A prerequisite has to be listed before the step
+    tasks_helper_clean
+    tasks_helper_add_tasks "module_step_anything_3" "module_step_anything_1"
+    tasks_helper_add_prerequisites "module_step_anything_3" "module_step_anything_1"
+    run tasks_helper_execute
+    assert_failure
+    assert_output --partial "'module_step_anything_1' must be listed before 'module_step_anything_3'"
+}
@@ -0,0 +1,666 @@
+import errno
+import json
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+
+def test_plan_cache_is_json(tmpfiles, tmp_path):
+    cache = tmp_path / "tmpfiles.cache"
+    tmpfiles.config(
+        "d {root}/dir 0750 - - 10d\n"
+        "f {root}/dir/file 0600 - - - content\n"
+        "c {root}/null 0666 - - - 1:3\n"
+    )
+    assert tmpfiles.run("--create", "--cache", cache)[0] == 0
+    data = json.loads(cache.read_text())
+    [config] = data["configs"].values()
+    assert [entry[:2] for entry in config["entries"]] == [
+        [f"{tmpfiles.root}/dir", "d"],
+        [f"{tmpfiles.root}/dir/file", "f"],
+        [f"{tmpfiles.root}/null", "c"],
+    ]
+
+    # the entries are reused as they were parsed, and the cache is kept
+    module = tmpfiles.load()
+    mtime = cache.stat().st_mtime_ns
+
+    def parse(config_file):
+        raise AssertionError(f"{config_file} parsed again")
+
+    module.parse_tmpfiles_config = parse
+    [(_config, entries)] = module.compile_plan(
+        [str(tmpfiles.confdir / "test.conf")], str(cache)
+    )
+    assert cache.stat().st_mtime_ns == mtime
+    assert [path for path, _action in entries] == [
+        f"{tmpfiles.root}/dir",
+        f"{tmpfiles.root}/dir/file",
+        f"{tmpfiles.root}/null",
+    ]
+    directory, file, null = (action for _path, action in entries)
+    assert type(directory) is module.ACTION_MAP["d"]
+    assert directory.mode == (False, 0o750)
+    assert directory.age.nanoseconds == 10 * 86400 * 10**9
+    assert directory.source == (str(tmpfiles.confdir / "test.conf"), 1)
+    assert file.arg == "content"
+    assert null.arg == (1, 3)
+
+    (tmpfiles.root / "dir" / "file").unlink()
+    assert tmpfiles.run("--create", "--cache", cache)[0] == 0
+    assert (tmpfiles.root / "dir" / "file").read_text() == "content"
+
+
+def test_plan_cache_not_json(tmpfiles, tmp_path):
+    cache = tmp_path / "tmpfiles.cache"
+    # e.g. a pickle written by an older version, or by someone else
+    cache.write_bytes(b"\x80\x04\x95cos\nsystem\n")
+    tmpfiles.config("d {root}/dir - - - -\n")
+    status, output = tmpfiles.run("--create", "--cache", cache)
+    assert status == 0
+    assert "ignoring plan cache" in output
+    assert (tmpfiles.root / "dir").is_dir()
+    assert json.loads(cache.read_text())["version"]
+
+
+def _open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_parallel_workers_close_dir_fds(tmpfiles, tmp_path):
+    src = tmp_path / "src"
+    for i in range(8):
+        directory = src / f"dir{i}" / "sub"
+        directory.mkdir(parents=True)
+        for j in range(8):
+            (directory / f"file{j}").write_text(f"{i}.{j}")
+    module = tmpfiles.load()
+    module._dir_fds().clear()
+    before = _open_fds()
+
+    for n in range(3):
+        module.copy_tree(str(src), str(tmp_path / f"copy{n}"), jobs=4)
+        module.apply_recursive(
+            str(tmp_path / f"copy{n}"), lambda node, st: module.lstat_at(node), jobs=4
+        )
+        module._dir_fds().clear()
+        assert _open_fds() == before
+
+    assert (tmp_path / "copy2" / "dir7" / "sub" / "file7").read_text() == "7.7"
+
+
+def _setxattr_failing(error):
+    def setxattr(*args, **kwargs):
+        raise OSError(error, os.strerror(error))
+
+    return setxattr
+
+
+@pytest.mark.parametrize("error", [errno.EACCES, errno.EINVAL, errno.EPERM])
+def test_copy_node_skips_xattrs_that_cannot_be_set(
+    tmpfiles, tmp_path, monkeypatch, error
+):
+    src = tmp_path / "src"
+    src.write_text("data")
+    src.chmod(0o751)
+    try:
+        os.setxattr(src, "user.test", b"value")
+    except OSError:
+        pytest.skip("no user extended attributes on this file system")
+    module = tmpfiles.load()
+    monkeypatch.setattr(os, "setxattr", _setxattr_failing(error))
+    module.copy_node(str(src), str(tmp_path / "dst"), os.lstat(src))
+    assert (tmp_path / "dst").read_text() == "data"
+    assert stat.S_IMODE(os.lstat(tmp_path / "dst").st_mode) == 0o751
+
+
+def test_copy_node_sets_mode_when_xattrs_fail(tmpfiles, tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.write_text("data")
+    src.chmod(0o755)
+    try:
+        os.setxattr(src, "user.test", b"value")
+    except OSError:
+        pytest.skip("no user extended attributes on this file system")
+    module = tmpfiles.load()
+    monkeypatch.setattr(os, "setxattr", _setxattr_failing(errno.EIO))
+    with pytest.raises(OSError):
+        module.copy_node(str(src), str(tmp_path / "dst"), os.lstat(src))
+    assert stat.S_IMODE(os.lstat(tmp_path / "dst").st_mode) == 0o755
+
+
+def test_copy_source_below_a_file(tmpfiles, tmp_path):
+    (tmp_path / "file").write_text("")
+    tmpfiles.config(f"C {{root}}/copy - - - - {tmp_path}/file/src\n")
+    output = tmpfiles.run("--create")[1]
+    assert f"failed to copy '{tmp_path}/file/src'" in output
+    assert "Not a directory" in output
+    assert "1 errors" in output
+    assert not (tmpfiles.root / "copy").exists()
+
+
+def test_boot_only_lines(tmpfiles):
+    tmpfiles.config("d {root}/always - - - -\nd! {root}/boot - - - -\n")
+    tmpfiles.run("--create")
+    assert (tmpfiles.root / "always").is_dir()
+    assert not (tmpfiles.root / "boot").exists()
+    tmpfiles.run("--create", "--boot")
+    assert (tmpfiles.root / "boot").is_dir()
+
+
+def test_remove(tmpfiles):
+    root = tmpfiles.root
+    for directory in ("D", "R/sub", "r-dir", "r-full"):
+        (root / directory).mkdir(parents=True)
+    for file in ("D/file", "R/sub/file", "r-file", "r-full/file"):
+        (root / file).write_text("")
+    tmpfiles.config(
+        "D {root}/D - - - -\n"
+        "R {root}/R - - - -\n"
+        "r {root}/r-file - - - -\n"
+        "r {root}/r-dir - - - -\n"
+        "r {root}/r-full - - - -\n"
+        "r {root}/r-missing - - - -\n"
+    )
+
+    # r and R only act with --remove, and D does not empty the directory
+    tmpfiles.run("--create")
+    assert sorted(p.name for p in root.iterdir()) == [
+        "D", "R", "r-dir", "r-file", "r-full"
+    ]
+    assert (root / "D" / "file").exists()
+
+    output = tmpfiles.run("--create", "--remove")[1]
+    # D directories are emptied, then created again
+    assert list((root / "D").iterdir()) == []
+    # r does not remove directories that are not empty
+    assert sorted(p.name for p in root.iterdir()) == ["D", "r-full"]
+    assert (root / "r-full" / "file").exists()
+    assert "0 errors" in output
+
+
+def test_duplicate_lines(tmpfiles):
+    tmpfiles.config("d {root}/dir 0700 - - -\nd {root}/dir 0700 - - -\n", "10-a.conf")
+    tmpfiles.config("d {root}/dir 0755 - - -\nz {root}/dir 0750 - - -\n", "20-b.conf")
+    tmpfiles.config("f {root}/dir/file 0640 - - - a\n", "30-c.conf")
+    tmpfiles.config(
+        "f {root}/dir/file 0600 - - - c\nw+ {root}/dir/file - - - - b\n", "40-d.conf"
+    )
+    output = tmpfiles.run("--create")[1]
+
+    # the line of the config that sorts first wins; exact duplicates
+    # and lines that do not conflict are not reported
+    root = tmpfiles.root
+    assert output.count("duplicate line") == 2
+    assert f"20-b.conf:1: duplicate line for path '{root}/dir'" in output
+    assert f"40-d.conf:1: duplicate line for path '{root}/dir/file'" in output
+    # z adjusts the mode after d created the directory
+    assert stat.S_IMODE(os.lstat(root / "dir").st_mode) == 0o750
+    # w+ appends to what f wrote
+    assert (root / "dir" / "file").read_text() == "ab"
+
+
+def test_config_directories_precedence(tmpfiles, tmp_path):
+    etc = tmp_path / "etc"
+    etc.mkdir()
+    (etc / "test.conf").write_text(f"d {tmpfiles.root}/etc - - - -\n")
+    tmpfiles.config("d {root}/usr - - - -\n")
+    tmpfiles.config("d {root}/other - - - -\n", "other.conf")
+    module = tmpfiles.load()
+    module.TMPFILES_DIRS = (str(etc), str(tmpfiles.confdir))
+    # a config in an earlier directory masks those of the same name
+    assert module.list_tmpfiles_configs() == [
+        str(tmpfiles.confdir / "other.conf"),
+        str(etc / "test.conf"),
+    ]
+
+
+def _age(path, seconds):
+    """Set the access and modification times of `path` to `seconds`
+    ago.  The configs only select the modification times (`mM:`), as
+    walking the trees in the tests updates the access times."""
+    past = time.time() - seconds
+    os.utime(path, (past, past), follow_symlinks=False)
+
+
+def _clean_tree(root):
+    tmp = root / "tmp"
+    for directory in ("old-dir", "new-dir", "keep-dir"):
+        (tmp / directory).mkdir(parents=True)
+    for file in ("old", "new", "sticky", "keep-me", "old-dir/old", "new-dir/old"):
+        (tmp / file).write_text("")
+    (tmp / "sticky").chmod(0o1644)
+    for path in ("old", "sticky", "keep-me", "old-dir/old", "new-dir/old"):
+        _age(tmp / path, 7200)
+    for directory in ("old-dir", "keep-dir", "."):
+        _age(tmp / directory, 7200)
+    return tmp
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_clean(tmpfiles, jobs):
+    tmp = _clean_tree(tmpfiles.root)
+    tmpfiles.config("d {root}/tmp - - - mM:1h\nx {root}/tmp/keep*\n")
+    status, output = tmpfiles.run("--clean", "--jobs", jobs)
+    assert status == 0
+    assert f"cleaned {tmp}: 3 files and 1 directories removed" in output
+    # old entries are removed, directories once they are empty
+    assert sorted(p.name for p in tmp.iterdir()) == [
+        "keep-dir", "keep-me", "new", "new-dir", "sticky"
+    ]
+    assert list((tmp / "new-dir").iterdir()) == []
+    # the timestamps of the cleaned directory are restored
+    assert os.stat(tmp).st_mtime < time.time() - 3600
+
+
+def test_clean_keep_first_level(tmpfiles):
+    tmp = _clean_tree(tmpfiles.root)
+    tmpfiles.config("d {root}/tmp - - - mM:~1h\n")
+    tmpfiles.run("--clean")
+    assert sorted(p.name for p in tmp.iterdir()) == [
+        "keep-dir", "keep-me", "new", "new-dir", "old", "old-dir", "sticky"
+    ]
+    assert list((tmp / "old-dir").iterdir()) == []
+
+
+def test_clean_dry_run(tmpfiles):
+    tmp = _clean_tree(tmpfiles.root)
+    before = sorted(tmp.rglob("*"))
+    tmpfiles.config("d {root}/tmp - - - mM:1h\n")
+    output = tmpfiles.run("--clean", "--dry-run")[1]
+    assert sorted(tmp.rglob("*")) == before
+    assert f"would remove {tmp}/old\n" in output
+    assert f"would remove {tmp}/old-dir/old\n" in output
+    assert "4 files and 2 directories would be removed" in output
+
+
+def _tree_state(root):
+    """Return what --verify must not change in the tree `root`."""
+    return sorted(
+        (str(p), st.st_ino, st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns)
+        for p in root.rglob("*")
+        for st in [p.lstat()]
+    )
+
+
+def test_verify(tmpfiles):
+    root = tmpfiles.root
+    tmpfiles.config(
+        "d {root}/dir 0750 - - -\n"
+        "f {root}/dir/file 0640 - - -\n"
+        "L {root}/link - - - - {root}/dir\n"
+    )
+    status, output = tmpfiles.run("--verify")
+    assert status == 1
+    assert "3 entries differ" in output
+
+    tmpfiles.run("--create")
+    status, output = tmpfiles.run("--verify")
+    assert status == 0
+    assert "0 entries differ, 0 errors" in output
+
+    (root / "dir" / "file").chmod(0o644)
+    (root / "link").unlink()
+    (root / "link").symlink_to(root)
+    before = _tree_state(root)
+    status, output = tmpfiles.run("--verify")
+    assert status == 1
+    assert f"{root}/dir/file: " in output
+    assert f"{root}/link: " in output
+    assert f"{root}/dir: " not in output
+    assert "2 entries differ" in output
+    # nothing is changed
+    assert _tree_state(root) == before
+
+
+def test_verify_cannot_be_combined(tmpfiles):
+    tmpfiles.config("d {root}/dir - - - -\n")
+    status, _output = tmpfiles.run("--verify", "--create")
+    assert "cannot be combined" in status
+    assert not (tmpfiles.root / "dir").exists()
+
+
+def test_journal_resume(tmpfiles, tmp_path):
+    journal = tmp_path / "tmpfiles.journal"
+    root = tmpfiles.root
+    tmpfiles.config(
+        "".join(f"w {{root}}/f{i} - - - - new\n" for i in range(6))
+        + "d {root}/dir 0755 - - -\n"
+    )
+    for i in range(6):
+        (root / f"f{i}").write_text("old")
+
+    # the run is killed while applying f3
+    module = tmpfiles.load()
+    module.JOURNAL_WRITE_INTERVAL = 0
+    apply_one = module.FileWrite.apply_one
+
+    def interrupted(self, path):
+        if path.endswith("/f3"):
+            raise KeyboardInterrupt
+        apply_one(self, path)
+
+    module.FileWrite.apply_one = interrupted
+    with pytest.raises(KeyboardInterrupt):
+        tmpfiles.run("--create", "--journal", journal, module=module)
+    contents = [(root / f"f{i}").read_text() for i in range(6)]
+    assert contents == ["new", "new", "new", "old", "old", "old"]
+    assert (root / "dir").is_dir()
+    # the plan hash, then dir, f0, f1 and f2
+    assert len(journal.read_text().splitlines()) == 1 + 4
+
+    # the next run only verifies the entries recorded: what changed
+    # since in f0 is kept, dir is created again, and the rest is applied
+    (root / "f0").write_text("changed")
+    (root / "dir").rmdir()
+    output = tmpfiles.run("--create", "--journal", journal)[1]
+    assert f"resuming from journal '{journal}': 4 entries to verify" in output
+    contents = [(root / f"f{i}").read_text() for i in range(6)]
+    assert contents == ["changed", "new", "new", "new", "new", "new"]
+    assert (root / "dir").is_dir()
+    assert not journal.exists()
+
+
+def test_journal_of_another_plan(tmpfiles, tmp_path):
+    journal = tmp_path / "tmpfiles.journal"
+    journal.write_text('0123456789abcdef\n"/f0"\n"/f1')
+    tmpfiles.config("w {root}/f0 - - - - new\n")
+    (tmpfiles.root / "f0").write_text("old")
+    output = tmpfiles.run("--create", "--journal", journal)[1]
+    assert "resuming" not in output
+    assert (tmpfiles.root / "f0").read_text() == "new"
+    assert not journal.exists()
+
+
+def test_recursive_walk_skips_unreadable_and_removed_directories(
+    tmpfiles, monkeypatch
+):
+    root = tmpfiles.root
+    for directory in ("tree/locked", "tree/gone", "tree/ok"):
+        (root / directory).mkdir(parents=True)
+        (root / directory / "file").write_text("")
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if path.endswith("/locked"):
+            raise PermissionError(errno.EACCES, "Permission denied", path)
+        if path.endswith("/gone"):
+            # removed by someone else while the tree is walked
+            (root / "tree" / "gone" / "file").unlink()
+            (root / "tree" / "gone").rmdir()
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", failing_scandir)
+    tmpfiles.config("Z {root}/tree 0700 - - -\nd {root}/zz - - - -\n")
+    output = tmpfiles.run("--create")[1]
+    assert f"failed to read '{root}/tree/locked'" in output
+    assert "gone" not in output
+    assert "1 errors" in output
+    # the rest of the tree, and the later entries, are applied
+    assert stat.S_IMODE(os.lstat(root / "tree" / "ok" / "file").st_mode) == 0o700
+    assert stat.S_IMODE(os.lstat(root / "tree" / "locked").st_mode) == 0o700
+    assert (root / "zz").is_dir()
+
+
+def _split(module, root, paths):
+    entries = [(os.path.join(root, path), ()) for path in paths]
+    return [
+        [os.path.relpath(path, root) for path, _actions in group]
+        for group in module.split_subtrees(entries)
+    ]
+
+
+def test_split_subtrees(tmpfiles):
+    module = tmpfiles.load()
+    root = str(tmpfiles.root)
+    assert _split(module, root, ["a", "a/b", "a/b/c", "b", "b-c/d", "c/d"]) == [
+        ["a", "a/b", "a/b/c"],
+        ["b"],
+        ["b-c/d"],
+        ["c/d"],
+    ]
+    # a glob goes with everything below its literal leading directory
+    assert _split(module, root, ["a/*/c", "a/b", "a/x/y", "ab"]) == [
+        ["a/*/c", "a/b", "a/x/y"],
+        ["ab"],
+    ]
+
+
+def test_split_subtrees_through_symlinks(tmpfiles):
+    root = tmpfiles.root
+    (root / "real").mkdir()
+    (root / "link").symlink_to("real")
+    (root / "var").mkdir()
+    (root / "var" / "run").symlink_to("../run")
+    module = tmpfiles.load()
+    # `run` does not exist yet, it is still reached through `var/run`
+    assert _split(
+        module, str(root), ["link/a", "other", "real", "run", "var/run/y"]
+    ) == [["link/a", "real"], ["other"], ["run", "var/run/y"]]
+
+
+def test_parse_acl_spec(tmpfiles):
+    module = tmpfiles.load()
+    undefined = module.ACL_UNDEFINED_ID
+    assert module._parse_acl_spec("u::rwx,u:1234:r-x g::6,mask:r,o::-") == [
+        (False, module.ACL_USER_OBJ, undefined, 7),
+        (False, module.ACL_USER, 1234, 5),
+        (False, module.ACL_GROUP_OBJ, undefined, 6),
+        (False, module.ACL_MASK, undefined, 4),
+        (False, module.ACL_OTHER, undefined, 0),
+    ]
+    assert module._parse_acl_spec("d:g:1234:rw,default:o::r") == [
+        (True, module.ACL_GROUP, 1234, 6),
+        (True, module.ACL_OTHER, undefined, 4),
+    ]
+    for spec in ("u:1234:rwz", "x::r", "m:1234:r", "u:1234"):
+        with pytest.raises(ValueError):
+            module._parse_acl_spec(spec)
+
+
+def test_acl_encoding(tmpfiles):
+    module = tmpfiles.load()
+    acl = module._acl_from_mode(0o751)
+    acl[(module.ACL_USER, 1234)] = 6
+    data = module._acl_encode(acl)
+    # version, then (tag, perms, id) entries sorted by tag
+    assert data[:4] == b"\x02\x00\x00\x00"
+    assert data[4:12] == b"\x01\x00\x07\x00\xff\xff\xff\xff"
+    assert data[12:20] == b"\x02\x00\x06\x00\xd2\x04\x00\x00"
+    assert len(data) == 4 + 4 * 8
+    assert module._acl_decode(data) == acl
+    assert module._acl_format(acl) == "u::rwx,u:1234:rw-,g::r-x,o::--x"
+    with pytest.raises(ValueError):
+        module._acl_decode(b"\x01\x00\x00\x00")
+
+
+def test_acl_mask_recalculation(tmpfiles):
+    module = tmpfiles.load()
+    mask = (module.ACL_MASK, module.ACL_UNDEFINED_ID)
+    directory = os.stat(tmpfiles.root)
+    access = module._acl_from_mode(0o640)
+
+    # no named entry, no mask
+    merged, default = module._acl_merge(
+        directory, access, {}, module._parse_acl_spec("o::r"), clear=False
+    )
+    assert mask not in merged
+    assert default == {}
+
+    # the mask is the union of the group and of the named entries
+    merged, _ = module._acl_merge(
+        directory, access, {}, module._parse_acl_spec("u:1234:-wx"), clear=False
+    )
+    assert merged[mask] == 0o7
+    # ... unless it is given
+    merged, _ = module._acl_merge(
+        directory, access, {}, module._parse_acl_spec("u:1234:-wx,m::r"), False
+    )
+    assert merged[mask] == 0o4
+
+    # a default ACL starts from the access one, and gets its own mask
+    _, default = module._acl_merge(
+        directory, access, {}, module._parse_acl_spec("d:g:1234:x"), clear=False
+    )
+    assert default == {**access, (module.ACL_GROUP, 1234): 1, mask: 0o5}
+
+    # clearing drops the named entries and the default ACL
+    merged, default = module._acl_merge(
+        directory,
+        {**access, (module.ACL_USER, 1234): 7, mask: 7},
+        {**access},
+        module._parse_acl_spec("g:1234:r"),
+        clear=True,
+    )
+    assert merged == {**access, (module.ACL_GROUP, 1234): 4, mask: 4}
+    assert default == {}
+
+
+def _acls(module, path):
+    return (
+        module._acl_read(str(path), module.ACL_XATTR_ACCESS, False),
+        module._acl_read(str(path), module.ACL_XATTR_DEFAULT, False),
+    )
+
+
+def test_acls(tmpfiles):
+    root = tmpfiles.root
+    module = tmpfiles.load()
+    try:
+        os.setxattr(
+            root,
+            module.ACL_XATTR_ACCESS,
+            module._acl_encode(module._acl_from_mode(0o755)),
+        )
+    except OSError as e:
+        pytest.skip(f"no POSIX ACL support: {e}")
+    tmpfiles.config(
+        "d {root}/dir 0750 - - -\n"
+        "a {root}/dir - - - - u:1234:rwx,d:g:1234:r-x\n"
+        "f {root}/file 0640 - - -\n"
+        "a+ {root}/file - - - - g:1234:r\n"
+        "d {root}/tree 0700 - - -\n"
+        "A {root}/tree - - - - u:1234:r\n"
+    )
+    (root / "tree").mkdir()
+    (root / "tree" / "file").write_text("")
+    status, output = tmpfiles.run("--create")
+    assert status == 0, output
+    assert "0 errors" in output
+
+    U, G, M = module.ACL_USER, module.ACL_GROUP, module.ACL_MASK
+    undefined = module.ACL_UNDEFINED_ID
+    access, default = _acls(module, root / "dir")
+    assert access == {
+        **module._acl_from_mode(0o750),
+        (U, 1234): 7,
+        (M, undefined): 7,
+    }
+    assert default == {
+        **module._acl_from_mode(0o750),
+        (G, 1234): 5,
+        (M, undefined): 5,
+    }
+    access, default = _acls(module, root / "file")
+    assert access == {
+        **module._acl_from_mode(0o640),
+        (G, 1234): 4,
+        (M, undefined): 4,
+    }
+    assert default is None
+    for path in (root / "tree", root / "tree" / "file"):
+        access, _default = _acls(module, path)
+        assert access[(U, 1234)] == 4
+
+    # a+ keeps the entries that are there, a replaces them
+    for path in (root / "file", root / "dir"):
+        access, _default = _acls(module, path)
+        os.setxattr(
+            path,
+            module.ACL_XATTR_ACCESS,
+            module._acl_encode({**access, (U, 42): 7, (M, undefined): 7}),
+        )
+    status, output = tmpfiles.run("--verify")
+    assert status == 1
+    assert f"{root}/dir: " in output
+    assert f"{root}/file: " not in output
+    tmpfiles.run("--create")
+    assert (U, 42) in _acls(module, root / "file")[0]
+    assert (U, 42) not in _acls(module, root / "dir")[0]
+
+    status, output = tmpfiles.run("--verify")
+    assert status == 0, output
+    assert "0 entries differ, 0 errors" in output
+
+
+@pytest.mark.parametrize(
+    "spec, expected",
+    [
+        # append only (a), immutable (i), no atime updates (A), no dump (d)
+        ("+ai", 0x80 | 0x40 | 0x20 | 0x10 | 0x1),
+        ("-A", 0x40 | 0x1),
+        ("-Ad", 0x1),
+        ("=d", 0x40),
+        ("=", 0),
+    ],
+)
+def test_attr_flags(tmpfiles, spec, expected):
+    module = tmpfiles.load()
+    value, mask = module._parse_attr_flags(spec)
+    assert not value & ~mask
+    # as applied to the current flags by _native_set_attrs_one()
+    current = 0x80 | 0x40 | 0x1
+    assert (current & ~mask) | value == expected
+
+
+def test_attr_flags_unsupported(tmpfiles):
+    module = tmpfiles.load()
+    assert module._parse_attrs("ai") == "+ai"
+    with pytest.raises(ValueError):
+        module._parse_attr_flags("+ah")
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_watch(tmpfiles):
+    root = tmpfiles.root
+    tmpfiles.config("d {root}/dir 0750 - - -\nf {root}/dir/file 0640 - - -\n")
+    module = tmpfiles.load()
+    module.WATCH_DEBOUNCE = 0.05
+    assert tmpfiles.run("--create", module=module)[0] == 0
+
+    def plan():
+        return module.read_tmpfiles_configs(module.list_tmpfiles_configs())
+
+    watcher = module.PlanWatcher(plan(), replan=plan)
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    try:
+        _wait_for(lambda: watcher.watches)
+        (root / "dir" / "file").unlink()
+        (root / "dir").rmdir()
+        _wait_for(lambda: (root / "dir" / "file").exists())
+        assert stat.S_IMODE((root / "dir").stat().st_mode) == 0o750
+
+        (root / "dir" / "file").chmod(0o666)
+        _wait_for(
+            lambda: stat.S_IMODE((root / "dir" / "file").stat().st_mode) == 0o640
+        )
+
+        # a new config line is applied, and its path watched
+        tmpfiles.config("d {root}/new 0700 - - -\n", name="new.conf")
+        _wait_for(lambda: (root / "new").is_dir())
+        (root / "new").rmdir()
+        _wait_for(lambda: (root / "new").is_dir())
+    finally:
+        watcher.stop()
+        thread.join(10)
+    assert not thread.is_alive()
@@ -0,0 +1,104 @@
+import json
+import sys
+
+import pytest
+
+from conftest import load_script
+
+
+@pytest.fixture
+def unit_dropins(tmp_path, monkeypatch, capsys):
+    """Return a function running `main()` of a fresh instance of the
+    script with the given arguments, and returning its output."""
+    etc = tmp_path / "etc"
+    etc.mkdir()
+    lib = tmp_path / "lib"
+    lib.mkdir()
+    (tmp_path / "build-id").write_text("build 1\n")
+
+    def run(*args):
+        monkeypatch.setitem(sys.modules, "tmpfiles", load_script("tmpfiles"))
+        module = load_script("unit_dropins")
+        module.UNIT_DROPIN_DIRS = (str(etc),)
+        argv = ["unit_dropins", "--output", tmp_path / "run", *args]
+        argv += ["--cache", tmp_path / "cache", "--build-id", tmp_path / "build-id"]
+        monkeypatch.setattr(sys, "argv", list(map(str, argv)))
+        module.main()
+        module.LOG.flush()
+        return capsys.readouterr().out
+
+    return run
+
+
+def _unit(tmp_path, name, service):
+    path = tmp_path / "lib" / name
+    path.write_text(f"[Unit]\nDescription={name}\n\n[Service]\n{service}")
+    return str(path)
+
+
+def _dropin(tmp_path, name):
+    path = tmp_path / "run" / f"{name}.d" / "zz-ipa-container.conf"
+    return path.read_text() if path.exists() else None
+
+
+def test_dropins(tmp_path, unit_dropins):
+    a = _unit(tmp_path, "a.service", "PrivateTmp=yes\nProtectSystem=full\n")
+    b = _unit(tmp_path, "b.service", "ExecStart=/bin/true\n")
+    c = _unit(tmp_path, "c.service", "PrivateTmp=yes\n")
+    (tmp_path / "lib" / "c.service.d").mkdir()
+    (tmp_path / "lib" / "c.service.d" / "10-off.conf").write_text(
+        "[Service]\nPrivateTmp=no\n"
+    )
+    output = unit_dropins(
+        "--private-tmp-off", a, b, c, "--protect-system-off", a, b
+    )
+    assert "1 drop-ins for 3 units" in output
+    assert _dropin(tmp_path, "a.service") == (
+        "# Generated by unit_dropins.py at container start\n"
+        "[Service]\nPrivateTmp=off\nProtectSystem=no\n"
+    )
+    assert _dropin(tmp_path, "b.service") is None
+    assert _dropin(tmp_path, "c.service") is None
+
+
+def test_dropins_cache(tmp_path, unit_dropins):
+    unit = _unit(tmp_path, "a.service", "PrivateTmp=yes\n")
+    etc = tmp_path / "etc" / "a.service.d"
+    assert "(cached)" not in unit_dropins("--private-tmp-off", unit)
+    assert _dropin(tmp_path, "a.service") is not None
+    assert "1 drop-ins for 1 units (cached)" in unit_dropins("--private-tmp-off", unit)
+
+    # a drop-in added in /etc turns PrivateTmp off by itself
+    etc.mkdir()
+    (etc / "override.conf").write_text("[Service]\nPrivateTmp=false\n")
+    assert "0 drop-ins for 1 units\n" in unit_dropins("--private-tmp-off", unit)
+    assert _dropin(tmp_path, "a.service") is None
+
+    # ... until it is modified
+    (etc / "override.conf").write_text("[Service]\nPrivateTmp=true\n")
+    assert "1 drop-ins for 1 units\n" in unit_dropins("--private-tmp-off", unit)
+    assert _dropin(tmp_path, "a.service") is not None
+
+    # a drop-in in /run is read too, but not ours
+    (etc / "override.conf").unlink()
+    (tmp_path / "run" / "a.service.d" / "50-other.conf").write_text(
+        "[Service]\nPrivateTmp=no\n"
+    )
+    assert "0 drop-ins for 1 units\n" in unit_dropins("--private-tmp-off", unit)
+
+    # the image changed
+    (tmp_path / "run" / "a.service.d" / "50-other.conf").unlink()
+    unit_dropins("--private-tmp-off", unit)
+    (tmp_path / "build-id").write_text("build 2\n")
+    assert "(cached)" not in unit_dropins("--private-tmp-off", unit)
+    assert json.loads((tmp_path / "cache").read_text())["key"][0] == "build 2"
+
+
+def test_dropins_precedence(tmp_path, unit_dropins):
+    unit = _unit(tmp_path, "a.service", "PrivateTmp=yes\n")
+    for directory, value in (("etc", "yes"), ("lib", "no")):
+        dropins = tmp_path / directory / "a.service.d"
+        dropins.mkdir()
+        (dropins / "10-tmp.conf").write_text(f"[Service]\nPrivateTmp={value}\n")
+    # the drop-in of /etc masks the one next to the unit
+    assert "1 drop-ins for 1 units" in unit_dropins("--private-tmp-off", unit)
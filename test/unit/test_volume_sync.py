@@ -0,0 +1,159 @@
+import hashlib
+import os
+import stat
+
+import pytest
+
+from conftest import run_script
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _volume(tmp_path):
+    """Return the arguments of volume_sync.py for a template and a
+    data volume, an image upgrade apart."""
+    template = tmp_path / "data-template"
+    data = tmp_path / "data"
+    for root in (template, data):
+        (root / "etc" / "dir").mkdir(parents=True)
+    # a.conf and c.conf are as the old image shipped them, b.conf was
+    # modified by the admin; the new image changed a.conf and b.conf,
+    # and no longer has c.conf
+    (template / "etc" / "a.conf").write_text("new a")
+    (template / "etc" / "b.conf").write_text("new b")
+    (data / "etc" / "a.conf").write_text("old a")
+    (data / "etc" / "b.conf").write_text("user b")
+    (data / "etc" / "c.conf").write_text("old c")
+    (template / "etc" / "dir").chmod(0o750)
+    (data / "etc" / "dir").chmod(0o700)
+
+    autoupdate = tmp_path / "volume-data-autoupdate"
+    autoupdate.write_text(
+        f"{_sha256('old a')}  /etc/a.conf\n"
+        f"{_sha256('old b')}  /etc/b.conf\n"
+        f"{_sha256('old c')}  /etc/c.conf\n"
+    )
+    data_list = tmp_path / "volume-data-list"
+    data_list.write_text("/etc/dir\n")
+    lists = ["--autoupdate-list", autoupdate, "--data-list", data_list]
+    manifest = tmp_path / "volume-data.manifest"
+    result = run_script(
+        "volume_sync",
+        "--write-manifest",
+        "--template",
+        template,
+        "--manifest",
+        manifest,
+        *lists,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    return [
+        "--data",
+        data,
+        "--template",
+        template,
+        "--manifest",
+        manifest,
+        "--cache",
+        tmp_path / "volume-sync.cache",
+        *lists,
+    ]
+
+
+def _contents(tmp_path):
+    etc = tmp_path / "data" / "etc"
+    files = {p.name: p.read_text() for p in etc.iterdir() if p.is_file()}
+    return files, stat.S_IMODE(os.lstat(etc / "dir").st_mode)
+
+
+def test_update_keeps_modified_files(tmp_path):
+    args = _volume(tmp_path)
+    result = run_script("volume_sync", "--update", *args)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert _contents(tmp_path) == ({"a.conf": "new a", "b.conf": "user b"}, 0o750)
+    assert "1 updated, 1 removed, 1 adjusted, 0 errors" in result.stdout
+
+    # nothing left to do
+    result = run_script("volume_sync", "--update", *args)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert _contents(tmp_path) == ({"a.conf": "new a", "b.conf": "user b"}, 0o750)
+    assert "0 updated, 0 removed, 0 adjusted, 0 errors" in result.stdout
+
+
+def test_update_dry_run(tmp_path):
+    args = _volume(tmp_path)
+    before = _contents(tmp_path)
+    result = run_script("volume_sync", "--update", "--dry-run", *args)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert _contents(tmp_path) == before
+    assert not (tmp_path / "volume-sync.cache").exists()
+
+
+def _tree(root):
+    """Return `{relative path: (type, uid, gid, mode, content)}`."""
+    tree = {}
+    for path in sorted(root.rglob("*")):
+        st = path.lstat()
+        if stat.S_ISLNK(st.st_mode):
+            content = os.readlink(path)
+        elif stat.S_ISREG(st.st_mode):
+            content = path.read_text()
+        else:
+            content = None
+        tree[str(path.relative_to(root))] = (
+            stat.S_IFMT(st.st_mode),
+            st.st_uid,
+            st.st_gid,
+            stat.S_IMODE(st.st_mode),
+            content,
+        )
+    return tree
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_populate(tmp_path, jobs):
+    if os.geteuid() == 0:
+        uid, gid = 1234, 5678
+    else:
+        uid, gid = os.getuid(), os.getgid()
+    template = tmp_path / "tmp-template"
+    (template / "dir" / "sub").mkdir(parents=True)
+    (template / "dir" / "sub" / "file").write_text("file")
+    (template / "dir" / "link").symlink_to("sub/file")
+    (template / "conf").mkdir()
+    (template / "conf" / "a.conf").write_text("a")
+    (template / "existing").mkdir()
+    (template / "existing" / "file").write_text("template")
+    (template / "existing" / "new").write_text("new")
+    for path in template.rglob("*"):
+        os.chown(path, uid, gid, follow_symlinks=False)
+    (template / "dir").chmod(0o750)
+    (template / "dir" / "sub" / "file").chmod(0o640)
+    (template / "existing").chmod(0o1777)
+    os.utime(template / "dir" / "sub" / "file", (1000000000, 1000000000))
+
+    volume = tmp_path / "tmp"
+    (volume / "existing").mkdir(parents=True, mode=0o700)
+    (volume / "existing" / "file").write_text("volume")
+    # a file where the template has a directory is left alone
+    (volume / "conf").write_text("conflict")
+
+    before = _tree(volume)
+
+    result = run_script("volume_sync", "--populate", volume, "--jobs", jobs)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "2 created, 1 adjusted, 0 errors" in result.stdout
+    expected = _tree(template)
+    del expected["conf/a.conf"]
+    expected["conf"] = before["conf"]
+    expected["existing/file"] = before["existing/file"]
+    assert _tree(volume) == expected
+    assert (volume / "dir" / "sub" / "file").lstat().st_mtime == 1000000000
+    # nothing is left behind by the copies
+    assert not list(volume.rglob(".#*"))
+
+    result = run_script("volume_sync", "--populate", volume)
+    assert "0 created, 0 adjusted, 0 errors" in result.stdout
+    assert _tree(volume) == expected